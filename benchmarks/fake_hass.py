@@ -0,0 +1,398 @@
+'''
+A local stand-in for a Home Assistant server, used by the benchmarks
+
+Serves the websocket API (auth, registries, get_states, subscribe_events/subscribe_entities, call_service)
+and the REST states/services endpoints on one port, with synthetic registries of any size
+Only the standard library is used, so the server itself never depends on the client libraries it measures
+'''
+from hashlib import sha1
+from base64 import b64encode
+from time import perf_counter_ns
+import threading
+import asyncio
+import random
+import struct
+import json
+
+WEBSOCKET_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+DOMAINS = ("light", "switch", "sensor", "binary_sensor", "fan", "cover")
+NAMES = ("Ceiling Light", "Lamp", "Desk Light", "Fan", "Motion", "Temperature", "Door", "Blinds", "Strip", "Button")
+
+def make_registries(entities=1000, areas=20, entities_per_device=3, seed=0):
+    '''
+    Build synthetic (areas, devices, entities, states) of the given size
+    '''
+    rng = random.Random(seed)
+
+    area_list = [{"area_id": f"area_{i}", "name": f"Area {i}"} for i in range(areas)]
+
+    device_list = []
+    entity_list = []
+    states = {}
+    for i in range(entities):
+        if i % entities_per_device == 0:
+            device_list.append({"id": f"device_{len(device_list)}", "area_id": rng.choice(area_list)["area_id"], "model": "Bench"})
+
+        device = device_list[-1]
+        area_name = next(area["name"] for area in area_list if area["area_id"] == device["area_id"])
+        domain = rng.choice(DOMAINS)
+        entity_id = f"{domain}.bench_{i}"
+
+        entity_list.append({"entity_id": entity_id,
+                            "device_id": device["id"],
+                            "area_id": None,
+                            "name": None,
+                            "original_name": f"{area_name} {rng.choice(NAMES)} {i}",
+                            "entity_category": None,
+                            "hidden_by": None,
+                            "disabled_by": None})
+
+        states[entity_id] = make_state(entity_id, "off", 0)
+
+    return area_list, device_list, entity_list, states
+
+def make_state(entity_id, state, counter, context=None):
+    '''
+    Build a state json shaped like a typical hass light
+    context: id of the context which changed it (defaults to one per state)
+    '''
+    timestamp = f"2024-01-01T00:00:{counter % 60:02d}.{counter:06d}+00:00"
+    return {"entity_id": entity_id,
+            "state": state,
+            "attributes": {"brightness": counter % 256,
+                           "color_mode": "hs",
+                           "hs_color": [counter % 360, 50.0],
+                           "supported_color_modes": ["hs", "color_temp"],
+                           "friendly_name": entity_id},
+            "last_changed": timestamp,
+            "last_updated": timestamp,
+            "context": {"id": context or f"context_{counter}", "parent_id": None, "user_id": None}}
+
+class FakeWebSocket:
+    def __init__(self, reader, writer):
+        '''
+        Server side of one websocket connection (RFC 6455 framing, text messages only)
+        '''
+        self.reader = reader
+        self.writer = writer
+
+    async def recv(self):
+        '''
+        Return the next text message, or None once the client closes
+        '''
+        message = b""
+        while True:
+            header = await self.reader.readexactly(2)
+            fin = header[0] & 0x80
+            opcode = header[0] & 0x0F
+            length = header[1] & 0x7F
+
+            if length == 126:
+                length = struct.unpack("!H", await self.reader.readexactly(2))[0]
+            elif length == 127:
+                length = struct.unpack("!Q", await self.reader.readexactly(8))[0]
+
+            mask = await self.reader.readexactly(4) if header[1] & 0x80 else None
+            payload = await self.reader.readexactly(length)
+            if mask:
+                payload = bytes(byte ^ mask[i % 4] for i, byte in enumerate(payload))
+
+            if opcode == 0x8:
+                self._send_frame(0x8, payload[:2])
+                return None
+            if opcode == 0x9:
+                self._send_frame(0xA, payload)
+                continue
+            if opcode == 0xA:
+                continue
+
+            message += payload
+            if fin:
+                return message.decode()
+
+    def _send_frame(self, opcode, payload):
+        '''
+        Write one unmasked frame
+        '''
+        length = len(payload)
+        if length < 126:
+            header = struct.pack("!BB", 0x80 | opcode, length)
+        elif length < 1 << 16:
+            header = struct.pack("!BBH", 0x80 | opcode, 126, length)
+        else:
+            header = struct.pack("!BBQ", 0x80 | opcode, 127, length)
+
+        self.writer.write(header + payload)
+
+    def send(self, msg):
+        '''
+        Send msg as a json text message (buffered, never blocks)
+        '''
+        self._send_frame(0x1, json.dumps(msg).encode())
+
+class FakeHass:
+    def __init__(self, entities=1000, areas=20, entities_per_device=3, seed=0, token="bench"):
+        '''
+        A fake hass server with synthetic registries (see make_registries)
+        Call start() to serve it on a background thread, then point Home at self.url
+
+        Every call_service is recorded in self.calls as (perf_counter_ns, msg), so benchmarks can time event -> service call latency
+        '''
+        self.areas, self.devices, self.entities, self.states = make_registries(entities, areas, entities_per_device, seed)
+        self.token = token
+
+        self.calls = []
+        self.call_received = None
+
+        # (websocket, subscription id, event_type) and (websocket, subscription id, entity_ids) of every subscription
+        self._event_subscriptions = []
+        self._entity_subscriptions = []
+        self._counter = 0
+
+        self.loop = None
+        self.port = None
+        self._server = None
+
+    @property
+    def url(self):
+        return f"127.0.0.1:{self.port}"
+
+    def start(self):
+        '''
+        Serve on a free local port, on a daemon thread with its own loop
+        '''
+        self.loop = asyncio.new_event_loop()
+        started = threading.Event()
+
+        def run():
+            asyncio.set_event_loop(self.loop)
+            self._server = self.loop.run_until_complete(asyncio.start_server(self._handle, "127.0.0.1", 0))
+            self.port = self._server.sockets[0].getsockname()[1]
+            started.set()
+            self.loop.run_forever()
+
+        threading.Thread(target=run, name="fake-hass", daemon=True).start()
+        started.wait()
+        return self
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+    def run(self, coro):
+        '''
+        Run coro on the server loop, and return its result
+        '''
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    async def _handle(self, reader, writer):
+        '''
+        Serve HTTP requests on a connection, switching to the websocket protocol on an upgrade
+        '''
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    return
+
+                method, path, _ = request_line.decode().split(" ", 2)
+                headers = {}
+                while True:
+                    line = (await reader.readline()).decode().strip()
+                    if not line:
+                        break
+                    name, value = line.split(":", 1)
+                    headers[name.strip().lower()] = value.strip()
+
+                if headers.get("upgrade", "").lower() == "websocket":
+                    await self._serve_websocket(reader, writer, headers)
+                    return
+
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                status, payload = self._rest(method, path, headers, body)
+
+                data = json.dumps(payload).encode()
+                writer.write(f"HTTP/1.1 {status}\r\nContent-Type: application/json\r\nContent-Length: {len(data)}\r\n\r\n".encode() + data)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    def _rest(self, method, path, headers, body):
+        '''
+        Handle a REST request, and return (status line, json payload)
+        '''
+        if headers.get("authorization") != f"Bearer {self.token}":
+            return "401 Unauthorized", {"message": "Unauthorized"}
+
+        if method == "GET" and path == "/api/states":
+            return "200 OK", list(self.states.values())
+
+        if method == "GET" and path.startswith("/api/states/"):
+            state = self.states.get(path[len("/api/states/"):])
+            return ("200 OK", state) if state else ("404 Not Found", {"message": "Entity not found."})
+
+        if method == "POST" and path.startswith("/api/services/"):
+            domain, service = path[len("/api/services/"):].split("/", 1)
+            data = json.loads(body or b"{}")
+            entity_id = data.pop("entity_id", None)
+            return "200 OK", self._call_service(domain, service, entity_id, data)[0]
+
+        return "404 Not Found", {"message": "Not found"}
+
+    async def _serve_websocket(self, reader, writer, headers):
+        '''
+        Finish the websocket handshake, authorize the client, and answer its messages
+        '''
+        accept = b64encode(sha1((headers["sec-websocket-key"] + WEBSOCKET_GUID).encode()).digest()).decode()
+        writer.write(("HTTP/1.1 101 Switching Protocols\r\n"
+                      "Upgrade: websocket\r\n"
+                      "Connection: Upgrade\r\n"
+                      f"Sec-WebSocket-Accept: {accept}\r\n\r\n").encode())
+
+        ws = FakeWebSocket(reader, writer)
+        ws.send({"type": "auth_required", "ha_version": "2024.1.0"})
+
+        auth = json.loads(await ws.recv())
+        if auth.get("access_token") != self.token:
+            ws.send({"type": "auth_invalid", "message": "Invalid access token"})
+            return
+        ws.send({"type": "auth_ok", "ha_version": "2024.1.0"})
+
+        try:
+            while True:
+                raw = await ws.recv()
+                if raw is None:
+                    return
+
+                self._websocket_message(ws, json.loads(raw))
+                await writer.drain()
+        finally:
+            self._event_subscriptions = [sub for sub in self._event_subscriptions if sub[0] is not ws]
+            self._entity_subscriptions = [sub for sub in self._entity_subscriptions if sub[0] is not ws]
+
+    def _websocket_message(self, ws, msg):
+        '''
+        Answer one websocket command
+        '''
+        msg_type = msg.get("type")
+        msg_id = msg.get("id")
+
+        def result(value):
+            ws.send({"id": msg_id, "type": "result", "success": True, "result": value})
+
+        if msg_type == "config/area_registry/list":
+            result(self.areas)
+        elif msg_type == "config/device_registry/list":
+            result(self.devices)
+        elif msg_type == "config/entity_registry/list":
+            result(self.entities)
+        elif msg_type == "config/entity_registry/get":
+            result(next((ent for ent in self.entities if ent["entity_id"] == msg.get("entity_id")), None))
+        elif msg_type == "get_states":
+            result(list(self.states.values()))
+
+        elif msg_type == "subscribe_events":
+            self._event_subscriptions.append((ws, msg_id, msg.get("event_type")))
+            result(None)
+
+        elif msg_type == "subscribe_entities":
+            entity_ids = msg.get("entity_ids")
+            self._entity_subscriptions.append((ws, msg_id, set(entity_ids) if entity_ids else None))
+            result(None)
+
+            # The first event is a snapshot of current states
+            ws.send({"id": msg_id, "type": "event", "event": {"a": {entity_id: self._compress(state) for entity_id, state in self.states.items()
+                                                                    if not entity_ids or entity_id in entity_ids}}})
+
+        elif msg_type == "unsubscribe_events":
+            subscription = msg.get("subscription")
+            self._event_subscriptions = [sub for sub in self._event_subscriptions if sub[1] != subscription or sub[0] is not ws]
+            self._entity_subscriptions = [sub for sub in self._entity_subscriptions if sub[1] != subscription or sub[0] is not ws]
+            result(None)
+
+        elif msg_type == "call_service":
+            entity_id = (msg.get("target") or {}).get("entity_id")
+            context = self._call_service(msg.get("domain"), msg.get("service"), entity_id, msg.get("service_data") or {})[1]
+            result({"context": {"id": context, "parent_id": None, "user_id": None}, "response": None})
+
+        else:
+            ws.send({"id": msg_id, "type": "result", "success": False, "error": {"code": "unknown_command", "message": "Unknown command."}})
+
+    def _compress(self, state):
+        '''
+        Compressed subscribe_entities form of a state
+        '''
+        return {"s": state["state"], "a": state["attributes"], "c": state["context"]["id"], "lc": 0, "lu": 0}
+
+    def _call_service(self, domain, service, entity_id, data):
+        '''
+        Record a service call and apply it to states. Return the changed states (like the REST API), and the call's context id
+        Like hass, every state the call changes carries its context
+        '''
+        self.calls.append((perf_counter_ns(), {"domain": domain, "service": service, "entity_id": entity_id, "data": data}))
+        if self.call_received:
+            self.call_received()
+
+        context = f"call_{len(self.calls)}"
+        if entity_id is None:
+            return [], context
+
+        changed = []
+        for target in ([entity_id] if isinstance(entity_id, str) else entity_id):
+            if target not in self.states:
+                continue
+
+            current = self.states[target]["state"]
+            new = {"turn_on": "on", "turn_off": "off", "toggle": "off" if current == "on" else "on"}.get(service, current)
+            changed.append(self.set_state(target, new, context))
+
+        return changed, context
+
+    def set_state(self, entity_id, state, context=None):
+        '''
+        Change the state of entity_id and send state_changed events to subscribers. Must run on the server loop
+        Return the new state
+        '''
+        self._counter += 1
+        old_state = self.states[entity_id]
+        new_state = make_state(entity_id, state, self._counter, context)
+        self.states[entity_id] = new_state
+
+        event = {"event_type": "state_changed",
+                 "data": {"entity_id": entity_id, "old_state": old_state, "new_state": new_state},
+                 "origin": "LOCAL",
+                 "time_fired": new_state["last_updated"],
+                 "context": new_state["context"]}
+
+        for ws, subscription, event_type in self._event_subscriptions:
+            if event_type in (None, "state_changed"):
+                ws.send({"id": subscription, "type": "event", "event": event})
+
+        for ws, subscription, entity_ids in self._entity_subscriptions:
+            if entity_ids is None or entity_id in entity_ids:
+                ws.send({"id": subscription, "type": "event", "event": {"c": {entity_id: {"+": {"s": state, "a": new_state["attributes"],
+                                                                                                  "c": new_state["context"]["id"], "lu": 0}}}}})
+
+        return new_state
+
+    async def stream(self, entity_ids, rate, count):
+        '''
+        Flip states of entity_ids (round robin) count times, at rate changes per second
+        Return the perf_counter_ns time of every change
+        '''
+        sent = []
+        interval = 1 / rate
+        start = self.loop.time()
+
+        for i in range(count):
+            delay = start + i * interval - self.loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+            entity_id = entity_ids[i % len(entity_ids)]
+            sent.append(perf_counter_ns())
+            self.set_state(entity_id, "off" if self.states[entity_id]["state"] == "on" else "on")
+
+        return sent
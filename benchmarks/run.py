@@ -0,0 +1,196 @@
+'''
+Benchmarks of hasspyapi against a local fake hass server (see fake_hass.py)
+
+    python benchmarks/run.py --entities 1000 --output results.json
+
+Results are written as json, so runs can be compared to track regressions
+'''
+from time import perf_counter_ns, sleep
+from pathlib import Path
+import statistics
+import threading
+import argparse
+import platform
+import tempfile
+import random
+import json
+import sys
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from fake_hass import FakeHass, make_state
+from hasspyapi.home import Home
+from hasspyapi.hass_command import HassCommand
+from hasspyapi.hass_event import StateChangedEvent, json_diff
+from hasspyapi.hass_event_listener import HassEventListener
+
+def summarize(samples_ns):
+    '''
+    Summarize timing samples (ns) in microseconds
+    '''
+    samples = sorted(samples_ns)
+    return {"count": len(samples),
+            "mean_us": statistics.fmean(samples) / 1e3,
+            "p50_us": samples[len(samples) // 2] / 1e3,
+            "p99_us": samples[min(len(samples) - 1, int(len(samples) * 0.99))] / 1e3,
+            "max_us": samples[-1] / 1e3}
+
+def time_calls(func, repeat):
+    '''
+    Call func repeat times, and return the time of every call (ns)
+    '''
+    samples = []
+    for _ in range(repeat):
+        start = perf_counter_ns()
+        func()
+        samples.append(perf_counter_ns() - start)
+
+    return samples
+
+def bench_startup(server, repeat):
+    '''
+    Time Home construction (connect, download registries, build devices), without and with a warm registry cache
+    '''
+    def start(**kwargs):
+        Home(server.url, server.token, live_registry=False, **kwargs).close()
+
+    cache_dir = tempfile.mkdtemp()
+    start(registry_cache=cache_dir)
+
+    return {"cold": summarize(time_calls(start, repeat)),
+            "cached": summarize(time_calls(lambda: start(registry_cache=cache_dir), repeat))}
+
+def bench_filter(home, areas, repeat):
+    '''
+    Time filters on the shared command (memoized), on fresh commands, and with wildcard patterns
+    '''
+    rng = random.Random(0)
+
+    def fresh():
+        HassCommand(home).filter(area=rng.choice(areas), type="light")
+
+    def wildcard():
+        HassCommand(home).filter(name="*Lamp*")
+
+    return {"memoized": summarize(time_calls(lambda: home.please().filter(area=areas[0], type="light"), repeat)),
+            "indexed": summarize(time_calls(fresh, repeat)),
+            "wildcard": summarize(time_calls(wildcard, max(1, repeat // 10)))}
+
+def bench_fire_event(entity_ids, trigger_counts, repeat):
+    '''
+    Time fire_event on one state_changed event against growing numbers of scoped and catch-all triggers
+    Events run right away (workers=0), and do nothing, so only dispatch is measured
+    '''
+    rng = random.Random(0)
+    results = {}
+
+    for trigger_count in trigger_counts:
+        for kind in ("scoped", "catch_all"):
+            listener = HassEventListener("", {}, workers=0)
+
+            for i in range(trigger_count):
+                entity_id = rng.choice(entity_ids)
+                if kind == "scoped":
+                    listener.trigger_when(entity_id=entity_id, to_state="on")(lambda msg: None)
+                else:
+                    listener.trigger_when(lambda msg, entity_id=entity_id: msg and msg.get("entity_id") == entity_id)(lambda msg: None)
+
+            events = []
+            for i in range(repeat):
+                entity_id = entity_ids[i % len(entity_ids)]
+                data = {"entity_id": entity_id, "old_state": make_state(entity_id, "off", i), "new_state": make_state(entity_id, "on", i + 1)}
+                events.append(StateChangedEvent(data, listener.diff_skip_keys, listener.lazy_diff))
+
+            samples = []
+            for event in events:
+                start = perf_counter_ns()
+                listener.fire_event(event)
+                samples.append(perf_counter_ns() - start)
+
+            results[f"{kind}_{trigger_count}"] = summarize(samples)
+
+    return results
+
+def bench_json_diff(repeat):
+    '''
+    Time json_diff of two consecutive states of a typical light
+    '''
+    old = make_state("light.bench", "off", 1)
+    new = make_state("light.bench", "on", 2)
+
+    return {"light_state": summarize(time_calls(lambda: json_diff(old, new), repeat))}
+
+def bench_end_to_end(server, transport, count, rate):
+    '''
+    Time hass event -> trigger -> service call, as seen by the server
+    '''
+    home = Home(server.url, server.token, transport=transport, live_registry=False)
+    listener = home.listener()
+
+    entity_ids = [entity["entity_id"] for entity in server.entities[:10]]
+    target = home.please().filter(entity_id=server.entities[10]["entity_id"])
+
+    @listener.trigger_when(entity_id=entity_ids)
+    def forward(event):
+        target.toggle()
+
+    done = threading.Event()
+    server.calls = []
+    server.call_received = lambda: len(server.calls) >= count and done.set()
+
+    listener.start(interval=None)
+    sleep(0.5)
+
+    sent = server.run(server.stream(entity_ids, rate, count))
+    done.wait(30)
+    server.call_received = None
+
+    # Let the last handler get its response before closing the connection
+    sleep(0.2)
+
+    received = [received for received, call in server.calls]
+    home.close()
+
+    return summarize([received - start for start, received in zip(sent, received)])
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--entities", type=int, default=1000, help="number of synthetic entities")
+    parser.add_argument("--areas", type=int, default=20, help="number of synthetic areas")
+    parser.add_argument("--repeat", type=int, default=1000, help="samples per micro benchmark")
+    parser.add_argument("--startup-repeat", type=int, default=10, help="samples of Home startup")
+    parser.add_argument("--triggers", type=int, nargs="+", default=[1, 10, 100, 1000], help="trigger counts for fire_event")
+    parser.add_argument("--events", type=int, default=200, help="events of the end to end benchmark")
+    parser.add_argument("--rate", type=float, default=50, help="events per second of the end to end benchmark")
+    parser.add_argument("--output", help="json file to write results to (default: stdout)")
+    args = parser.parse_args()
+
+    server = FakeHass(entities=args.entities, areas=args.areas).start()
+    entity_ids = list(server.states)
+
+    home = Home(server.url, server.token, live_registry=False)
+    areas = [area["name"] for area in server.areas]
+
+    results = {"startup": bench_startup(server, args.startup_repeat),
+               "filter": bench_filter(home, areas, args.repeat),
+               "fire_event": bench_fire_event(entity_ids, args.triggers, args.repeat),
+               "json_diff": bench_json_diff(args.repeat),
+               "end_to_end": {transport: bench_end_to_end(server, transport, args.events, args.rate) for transport in ("rest", "websocket")}}
+    home.close()
+
+    report = {"meta": {"python": platform.python_version(),
+                       "platform": platform.platform(),
+                       "params": vars(args)},
+              "results": results}
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        Path(args.output).write_text(output)
+    else:
+        print(output)
+
+    server.stop()
+
+if __name__ == "__main__":
+    main()
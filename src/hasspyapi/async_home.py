@@ -0,0 +1,95 @@
+import asyncio
+
+from .hass_async_command import AsyncHassCommand
+from .hass_async_event_listener import AsyncHassEventListener
+from .hass_async_service_layer import HassAsyncServiceLayer
+from .hass_state_store import HassStateStore
+from .hass_websocket_layer import HassWebSocketLayer
+from .home import Home
+
+class AsyncHome(Home):
+    # please() returns awaitable commands
+    command_class = AsyncHassCommand
+
+    def __init__(self, url, api_key, mirror_states=False, state_max_age=None, registry_cache=None, live_registry=True, metrics=False, json_codec="auto"):
+        '''
+        Async counterpart of Home, which lives on the caller's asyncio loop instead of a background thread
+        Everything (registries, states and service calls) goes over one websocket, so no call ever blocks a thread
+        Build it with `home = await AsyncHome.connect(url, api_key)`
+
+        mirror_states, state_max_age, registry_cache, live_registry, metrics and json_codec work like they do for Home
+        The websocket can only download every state at once, so without mirror_states each get_state/get_attributes downloads all states
+        '''
+        self._setup(url, api_key, registry_cache, metrics, json_codec)
+
+        self.mirror_states = mirror_states
+        self.state_max_age = state_max_age
+        self.live_registry = live_registry
+
+        # No REST transport, states are downloaded over the websocket
+        self.api_layer = None
+        self.state_store = None
+
+        self.ws = None
+        self.service_layer = None
+
+        # Async commands are never queued, and always sent
+        self.command_queue = None
+        self.skip_redundant = False
+
+    @classmethod
+    async def connect(cls, url, api_key, **kwargs):
+        '''
+        Create an AsyncHome (see __init__ for kwargs), connect it, and load its devices
+        '''
+        home = cls(url, api_key, **kwargs)
+        await home._connect()
+
+        return home
+
+    async def _connect(self):
+        '''
+        Authorize the websocket, seed the state mirror, and load devices (from the registry cache, if it has them)
+        '''
+        self.ws = await HassWebSocketLayer.authorize(self.ws_url, self.ws_headers, self.metrics, self.codec)
+
+        if self.metrics:
+            self._lag_watcher = asyncio.get_running_loop().create_task(self.metrics.watch_loop_lag())
+
+        self.service_layer = HassAsyncServiceLayer(self.ws)
+
+        if self.mirror_states:
+            self.state_store = HassStateStore(self.api_layer, max_age=self.state_max_age)
+            self.state_store.sync(await self.ws.call("get_states"))
+
+        if self.live_registry:
+            # Subscribe before loading, so no registry update is missed
+            await self._subscribe_registry_updates()
+
+        cached = self.registry_cache.load() if self.registry_cache else None
+        if cached:
+            self._load_cached_devices(cached)
+
+            # Check the cache is still current in the background
+            asyncio.get_running_loop().create_task(self._refresh_registries())
+        else:
+            await self._refresh_registries()
+
+    def listener(self, event_types=("state_changed",), subscribe_entities=False, workers=1, max_queue=1000, overflow="block", history=None, processes=0):
+        '''
+        Return a corresponding AsyncHassEventListener object on the home's websocket
+        Start it with `await listener.listen()` (or as a task), since the websocket belongs to the running loop
+        '''
+        listener = AsyncHassEventListener(self.ws_url, self.ws_headers, state_store=self.state_store, event_types=event_types, subscribe_entities=subscribe_entities,
+                                          connection=self.ws, workers=workers, max_queue=max_queue, overflow=overflow, metrics=self.metrics, history=history, processes=processes)
+        self._listeners.add(listener)
+
+        return listener
+
+    async def close(self):
+        '''
+        Close the websocket, and wait for the listeners on it to stop
+        '''
+        if self.metrics:
+            self._lag_watcher.cancel()
+        await self._close_connection()
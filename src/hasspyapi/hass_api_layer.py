@@ -1,9 +1,27 @@
+from urllib.parse import quote
+from time import perf_counter
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from .hass_history import DEFAULT_CHUNK, HistoryColumns, windows
+from .hass_json import JsonCodec
+
+# Number of states from which one bulk download of every state is cheaper than one request per state (see states_of)
+BULK_STATES_MIN = 8
 
 class HassApiLayer:
-    def __init__(self, url, api_key):
+    def __init__(self, url, api_key, pool_size=10, timeout=10, retries=3, backoff=0.3, metrics=None, codec=None):
         '''
         A layer between the hass REST API and Python
+
+        All requests go through one keep-alive session, so connections to hass are pooled and reused between calls
+        pool_size: maximum number of connections kept alive to the hass server
+        timeout: seconds to wait on hass, either a single number or a (connect, read) tuple
+        retries: number of retries on connection errors and transient 5xx responses
+        backoff: backoff factor in seconds between retries (doubles on every retry)
+        metrics: HassMetrics to record request latency and errors per endpoint in (None to not record them)
+        codec: JsonCodec to encode and decode request bodies with (defaults to the fastest one installed)
         '''
 
         self.api_url = f"http://{url}/api/"
@@ -12,28 +30,92 @@ class HassApiLayer:
             "Content-Type": "application/json",
         }
 
-    def _get(self, endpoint):
+        self.timeout = timeout
+        self.metrics = metrics
+        self.codec = codec or JsonCodec()
+
+        # Only retry when the request could not have been applied (connection refused, gateway errors)
+        # Read errors are not retried, since a non idempotent service (ex. toggle) may have already run
+        retry = Retry(total=retries,
+                      connect=retries,
+                      read=0,
+                      status=retries,
+                      backoff_factor=backoff,
+                      status_forcelist=(502, 503, 504),
+                      allowed_methods=frozenset(("GET", "POST")),
+                      raise_on_status=False)
+
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+
+        self.session = requests.Session()
+        self.session.headers.update(self.api_headers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def close(self):
+        '''
+        Close all pooled connections
+        '''
+        self.session.close()
+
+    def _endpoint_label(self, endpoint):
+        '''
+        Return endpoint without its entity_id (ex. states/light.desk -> states/{entity_id}), so metrics do not grow per entity
+        '''
+        if endpoint.startswith("states/"):
+            return "states/{entity_id}"
+        if endpoint.startswith("history/period/"):
+            return "history/period/{start}"
+        if endpoint.startswith("logbook/"):
+            return "logbook/{start}"
+
+        return endpoint
+
+    def _request(self, method, endpoint, **kwargs):
         '''
-        Safely query endpoint via hass REST API
+        Send a request to endpoint through the pooled session, recording its latency and errors if metrics are enabled
         '''
-        response = requests.get(self.api_url + endpoint, headers=self.api_headers)
+        if self.metrics is None:
+            return self.session.request(method, self.api_url + endpoint, timeout=self.timeout, **kwargs)
+
+        label = self._endpoint_label(endpoint)
+        start = perf_counter()
+        try:
+            response = self.session.request(method, self.api_url + endpoint, timeout=self.timeout, **kwargs)
+        except Exception:
+            self.metrics.count("rest_errors", endpoint=label)
+            raise
+        finally:
+            self.metrics.observe("rest_request_seconds", perf_counter() - start, endpoint=label)
+
+        if response.status_code != 200:
+            self.metrics.count("rest_errors", endpoint=label)
+
+        return response
+
+    def _get(self, endpoint, params=None):
+        '''
+        Safely query endpoint (with query params) via hass REST API
+        '''
+        response = self._request("GET", endpoint, params=params)
         if response.status_code != 200:
             raise RuntimeError(f"There was an error with endpoint {endpoint}: {response.text}")
         
-        return response.json()
+        return self.codec.loads(response.content)
     
     def _post(self, endpoint, entity_id, **data):
         '''
         Safely post data to endpoint via hass REST API
         All supported post jsons contain entity_id, so it is a required field
+        entity_id may be a single entity_id or a list of entity_ids (of the same domain)
         '''
         data = {"entity_id": entity_id, **data}
 
-        response = requests.post(self.api_url + endpoint, json=data, headers=self.api_headers)
+        response = self._request("POST", endpoint, data=self.codec.dumps(data))
         if response.status_code != 200:
             raise RuntimeError(f"There was an error posting to endpoint {endpoint}: {response.text}")
         
-        return response.json()
+        return self.codec.loads(response.content)
     
     def turn_on(self, entity_id, device_type, **attributes):
         '''
@@ -58,14 +140,108 @@ class HassApiLayer:
         Send a text command to Google Assistant SDK (if already set up in hass)
         '''
         data = {"command": command}
-        response = requests.post(self.api_url + "services/google_assistant_sdk/send_text_command", json=data, headers=self.api_headers)
+        response = self._request("POST", "services/google_assistant_sdk/send_text_command", data=self.codec.dumps(data))
         if response.status_code != 200:
             raise RuntimeError(f"There was an error sending google assistant command: {response.text}")
         
-        return response.json()
+        return self.codec.loads(response.content)
     
     def states(self, entity_id):
         '''
         Safely access the states service endpoint
         '''
-        return self._get(f"states/{entity_id}")
\ No newline at end of file
+        return self._get(f"states/{entity_id}")
+
+    def all_states(self):
+        '''
+        Safely access the states service endpoint for every entity at once
+        '''
+        return self._get("states")
+
+    def states_of(self, entity_ids):
+        '''
+        Return the full state json of each entity_id
+        A few states are read with one request each, and BULK_STATES_MIN or more with one bulk download of every state
+        '''
+        if len(entity_ids) < BULK_STATES_MIN:
+            return [self.states(entity_id) for entity_id in entity_ids]
+
+        states = {state["entity_id"]: state for state in self.all_states()}
+        return [states[entity_id] if entity_id in states else self.states(entity_id) for entity_id in entity_ids]
+
+    def render_template(self, template):
+        '''
+        Render a hass template on the server, and return the rendered text
+        '''
+        response = self._request("POST", "template", data=self.codec.dumps({"template": template}))
+        if response.status_code != 200:
+            raise RuntimeError(f"There was an error rendering template: {response.text}")
+
+        return response.text
+
+    def history(self, entity_ids, start, end=None, chunk=DEFAULT_CHUNK, attributes=False):
+        '''
+        Stream the state history of entity_ids (an entity_id or list of entity_ids) between start and end (datetimes, end defaults to now)
+        as a generator of states (entity_id, state, last_changed, and attributes if requested), in time order per entity
+
+        The range is requested in windows of chunk (a timedelta), so only one window is ever held in memory, however long the range
+        '''
+        if isinstance(entity_ids, str):
+            entity_ids = [entity_ids]
+
+        params = {"filter_entity_id": ",".join(entity_ids)}
+        if not attributes:
+            # Minimal responses leave out the attributes of every state but the first, so they are only asked for without attributes
+            params["minimal_response"] = ""
+            params["no_attributes"] = ""
+
+        first = True
+        for window_start, window_end in windows(start, end, chunk):
+            params["end_time"] = window_end.isoformat()
+            if not first:
+                # The state at the start of a window was the last state of the previous one
+                params["skip_initial_state"] = ""
+            first = False
+
+            for states in self._get(f"history/period/{quote(window_start.isoformat())}", params):
+                if not states:
+                    continue
+
+                if attributes:
+                    yield from states
+                    continue
+
+                # With minimal_response, only the first state of each entity has its entity_id
+                entity_id = states[0]["entity_id"]
+                for state in states:
+                    state["entity_id"] = entity_id
+                    yield state
+
+    def history_columns(self, entity_ids, start, end=None, chunk=DEFAULT_CHUNK, numpy=False):
+        '''
+        Collect the numeric history of entity_ids (ex. energy sensors) between start and end into columns (see HistoryColumns)
+        Return entity_id -> (timestamps, values), as array("d") or numpy arrays if numpy
+        '''
+        columns = HistoryColumns()
+        for state in self.history(entity_ids, start, end, chunk):
+            columns.add(state)
+
+        return columns.to_numpy() if numpy else columns.columns
+
+    def logbook(self, start, end=None, entity_ids=None, chunk=DEFAULT_CHUNK):
+        '''
+        Stream logbook entries between start and end (datetimes, end defaults to now) as a generator, in time order
+        entity_ids: an entity_id or list of entity_ids to only stream the entries of (None for every entry)
+        The range is requested in windows of chunk (a timedelta), like history, and hass filters each window by every entity at once
+        '''
+        if isinstance(entity_ids, str):
+            entity_ids = [entity_ids]
+
+        params = {}
+        if entity_ids is not None:
+            params["entity"] = ",".join(entity_ids)
+
+        for window_start, window_end in windows(start, end, chunk):
+            params["end_time"] = window_end.isoformat()
+
+            yield from self._get(f"logbook/{quote(window_start.isoformat())}", params)
@@ -0,0 +1,192 @@
+import asyncio
+
+from .hass_command import HassCommand
+from .hass_history import DEFAULT_CHUNK, HistoryColumns
+from .hass_template import TemplateWatch, parse_result
+
+class AsyncHassCommand(HassCommand):
+    def __init__(self, home, positions=None):
+        '''
+        Awaitable HassCommand, built by AsyncHome.please()
+        Filtering works like HassCommand. Service calls and state reads are coroutines, which send one request per device type,
+        all at once
+        '''
+        super().__init__(home, positions)
+
+    async def _call_batched(self, service, devices, **attributes):
+        '''
+        Call service (ex. self.service_layer.turn_on) once per device type, with every entity_id of that type at once
+        Unlike HassCommand, the calls of every device type are in flight concurrently
+
+        Return a dictionary of entity_id -> response for that device (see _split_responses)
+        '''
+        groups = self._group_by_type(devices)
+        responses = await asyncio.gather(*(service(entity_ids, device_type, **attributes) for device_type, entity_ids in groups.items()))
+
+        state_store = self.home.state_store
+
+        result = {}
+        for entity_ids, response in zip(groups.values(), responses):
+            if state_store:
+                state_store.apply_changes(response)
+
+            self._split_responses(entity_ids, response, result)
+
+        return result
+
+    async def get_attributes(self):
+        '''
+        Get a list of attributes for each device
+        If there is just one device, return the first element of such a list
+        '''
+        return self._refine([state["attributes"] for state in await self._full_states()])
+
+    async def get_state(self):
+        '''
+        Return a list of states for each device
+        If there is just one device, return the first element of such a list
+        '''
+        return self._refine(await self._states())
+
+    async def _states(self):
+        '''
+        Return a list of states for each device (never refined)
+        '''
+        return [state["state"] for state in await self._full_states()]
+
+    async def _full_states(self):
+        '''
+        Return a list of full state jsons for each device (never refined)
+        States are read from the home's state mirror when it is fresh. Any missing states are downloaded with one websocket request
+        The websocket can only download every state at once, so the download also refreshes a stale mirror for the reads after it
+        Raises KeyError for a device hass has no state for
+        '''
+        state_store = self.home.state_store
+
+        result = [state_store.get(device["entity_id"]) if state_store else None for device in self.devices]
+
+        missing = [i for i, state in enumerate(result) if state is None]
+        if missing:
+            all_states = await self.service_layer.all_states()
+            if state_store is not None:
+                state_store.sync(all_states)
+
+            states = {state["entity_id"]: state for state in all_states}
+            for i in missing:
+                entity_id = self.devices[i]["entity_id"]
+                if entity_id not in states:
+                    raise KeyError(f"{entity_id} has no state on the hass server")
+
+                result[i] = states[entity_id]
+
+        return result
+
+    async def turn_on(self, **attributes):
+        '''
+        Set attributes for all devices via given attributes, and turn devices on
+        Return list of responses
+        If there is just one device, return the first element of such a list
+        '''
+        responses = await self._call_batched(self.service_layer.turn_on, self.devices, **attributes)
+
+        return self._refine([responses[device["entity_id"]] for device in self.devices])
+
+    async def set_attributes(self, **attributes):
+        '''
+        Set attributes for all devices that are ON via given attributes
+        Devices that are not on do not turn on, or change attributes
+        Return list of responses
+        If there is just one device, return the first element of such a list
+        '''
+        states = await self._states()
+
+        on_devices = [device for state, device in zip(states, self.devices) if state == "on"]
+        responses = await self._call_batched(self.service_layer.turn_on, on_devices, **attributes)
+
+        result = []
+        for state, device in zip(states, self.devices):
+            if state == "on":
+                result.append(responses[device["entity_id"]])
+            else:
+                result.append({"state": "off"})
+
+        return self._refine(result)
+
+    async def turn_off(self):
+        '''
+        Turn off all devices
+        Return list of responses
+        If there is just one device, return the first element of such a list
+        '''
+        responses = await self._call_batched(self.service_layer.turn_off, self.devices)
+
+        return self._refine([responses[device["entity_id"]] for device in self.devices])
+
+    async def google_assistant(self, command):
+        '''
+        Send a text command to Google Assistant SDK (if already set up in hass)
+        '''
+        return await self.service_layer.google_assistant(command)
+
+    async def toggle(self, **attributes):
+        '''
+        Toggle all devices and set attributes
+        Return list of responses
+        If there is just one device, return the first element of such a list
+        '''
+        responses = await self._call_batched(self.service_layer.toggle, self.devices, **attributes)
+
+        return self._refine([responses[device["entity_id"]] for device in self.devices])
+
+    async def aggregate(self, function, attribute=None, value=None):
+        '''
+        Compute function over the state (or attribute) of all devices on the hass server (see HassCommand.aggregate)
+        '''
+        template = self._aggregate_template(function, attribute, value)
+
+        return parse_result(await self.service_layer.render_template(template), self.home.ws.codec)
+
+    async def watch_aggregate(self, function, callback, attribute=None, value=None):
+        '''
+        Like aggregate, but pushed: callback(value) is called with the aggregate now, and whenever it changes (see HassCommand.watch_aggregate)
+        '''
+        watch = TemplateWatch(self.home.ws, self._aggregate_template(function, attribute, value), callback)
+
+        return await watch.start()
+
+    async def unwatch(self, watch):
+        '''
+        Cancel a TemplateWatch returned by watch_aggregate
+        '''
+        await watch.cancel()
+
+    async def history(self, start, end=None, chunk=DEFAULT_CHUNK, attributes=False):
+        '''
+        Like HassCommand.history, as an async generator over the websocket (see HassAsyncServiceLayer.history)
+        ex. async for state in sensors.history(start): ...
+        '''
+        if not self.devices:
+            return
+
+        async for state in self.service_layer.history([device["entity_id"] for device in self.devices], start, end, chunk, attributes):
+            yield state
+
+    async def history_columns(self, start, end=None, chunk=DEFAULT_CHUNK, numpy=False):
+        '''
+        Like HassCommand.history_columns, over the websocket
+        '''
+        columns = HistoryColumns()
+        async for state in self.history(start, end, chunk):
+            columns.add(state)
+
+        return columns.to_numpy() if numpy else columns.columns
+
+    async def logbook(self, start, end=None, chunk=DEFAULT_CHUNK):
+        '''
+        Like HassCommand.logbook, as an async generator over the websocket (see HassAsyncServiceLayer.logbook)
+        '''
+        if not self.devices:
+            return
+
+        async for entry in self.service_layer.logbook(start, end, [device["entity_id"] for device in self.devices], chunk):
+            yield entry
@@ -0,0 +1,13 @@
+from .hass_event_listener import HassEventListener
+
+class AsyncHassEventListener(HassEventListener):
+    '''
+    HassEventListener on an AsyncHome's websocket, built by AsyncHome.listener()
+    The websocket belongs to the caller's loop, so the listener can only run on it (see listen)
+    '''
+
+    def start(self, interval=5):
+        '''
+        Not available: start listens on a thread of its own, which cannot use a websocket of the caller's loop
+        '''
+        raise RuntimeError("AsyncHome listeners run on the caller's loop. Use `await listener.listen()` (or run it as a task) instead of start()")
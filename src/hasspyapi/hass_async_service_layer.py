@@ -0,0 +1,119 @@
+import asyncio
+
+from .hass_history import DEFAULT_CHUNK, expand_state, from_timestamp, windows
+
+class HassAsyncServiceLayer:
+    def __init__(self, connection):
+        '''
+        Awaitable counterpart of HassWebSocketServiceLayer, for code already running on the connection's loop (see AsyncHome)
+        Service calls are websocket requests, so any number of them can be in flight at once
+
+        connection: an authorized HassWebSocketLayer, owned by the running loop
+        '''
+        self.connection = connection
+
+    async def call_service(self, domain, service, entity_id=None, **data):
+        '''
+        Call domain.service on entity_id (a single entity_id or a list of entity_ids) with service data
+        Return the states the call changed, like HassApiLayer (see HassWebSocketLayer.call_service)
+        '''
+        return await self.connection.call_service(domain, service, entity_id, **data)
+
+    async def all_states(self):
+        '''
+        Return the full state json of every entity, with one get_states request
+        '''
+        return await self.connection.call("get_states")
+
+    async def states(self, entity_ids):
+        '''
+        Return the full state json of each entity_id (None for unknown entities), with one get_states request
+        The websocket cannot fetch single states, so this always downloads every state. Prefer reading a state mirror (see AsyncHome)
+        '''
+        states = {state["entity_id"]: state for state in await self.all_states()}
+
+        return [states.get(entity_id) for entity_id in entity_ids]
+
+    async def history(self, entity_ids, start, end=None, chunk=DEFAULT_CHUNK, attributes=False):
+        '''
+        Async generator counterpart of HassApiLayer.history, with one history/history_during_period request per window
+        The websocket sends compressed states, which are expanded to the shape the REST API sends (see expand_state)
+        '''
+        if isinstance(entity_ids, str):
+            entity_ids = [entity_ids]
+
+        first = True
+        for window_start, window_end in windows(start, end, chunk):
+            # The state at the start of a window was the last state of the previous one
+            result = await self.connection.call("history/history_during_period", start_time=window_start.isoformat(), end_time=window_end.isoformat(),
+                                                entity_ids=entity_ids, include_start_time_state=first, significant_changes_only=False,
+                                                minimal_response=not attributes, no_attributes=not attributes)
+            first = False
+
+            for entity_id, states in result.items():
+                for state in states:
+                    yield expand_state(entity_id, state)
+
+    async def logbook(self, start, end=None, entity_ids=None, chunk=DEFAULT_CHUNK):
+        '''
+        Async generator counterpart of HassApiLayer.logbook, with one logbook/get_events request per window
+        Entry times are sent as ISO timestamps, like the REST API sends them
+        '''
+        if isinstance(entity_ids, str):
+            entity_ids = [entity_ids]
+
+        for window_start, window_end in windows(start, end, chunk):
+            msg = {"start_time": window_start.isoformat(), "end_time": window_end.isoformat()}
+            if entity_ids is not None:
+                msg["entity_ids"] = entity_ids
+
+            for entry in await self.connection.call("logbook/get_events", **msg):
+                if isinstance(entry.get("when"), (int, float)):
+                    entry["when"] = from_timestamp(entry["when"])
+                yield entry
+
+    async def render_template(self, template):
+        '''
+        Render a hass template on the server, and return its rendered value
+        The websocket has no one-shot render, so this subscribes until the first rendering arrives
+        '''
+        rendered = asyncio.get_running_loop().create_future()
+
+        def on_event(msg):
+            event = msg.get("event") or {}
+            if rendered.done():
+                return
+            if "error" in event:
+                rendered.set_exception(RuntimeError(f"There was an error rendering template: {event['error']}"))
+            else:
+                rendered.set_result(event.get("result"))
+
+        subscription = await self.connection.subscribe_template(template, on_event)
+        try:
+            return await rendered
+        finally:
+            await self.connection.unsubscribe(subscription)
+
+    async def turn_on(self, entity_id, device_type, **attributes):
+        '''
+        Call the turn_on service and pass in any available attributes (ex. hs_color, brightness etc.)
+        '''
+        return await self.call_service(device_type, "turn_on", entity_id, **attributes)
+
+    async def turn_off(self, entity_id, device_type):
+        '''
+        Call the turn_off service
+        '''
+        return await self.call_service(device_type, "turn_off", entity_id)
+
+    async def toggle(self, entity_id, device_type, **attributes):
+        '''
+        Call the toggle service and pass in any available attributes (ex. hs_color, brightness etc.)
+        '''
+        return await self.call_service(device_type, "toggle", entity_id, **attributes)
+
+    async def google_assistant(self, command):
+        '''
+        Send a text command to Google Assistant SDK (if already set up in hass)
+        '''
+        return await self.call_service("google_assistant_sdk", "send_text_command", command=command)
@@ -1,18 +1,46 @@
-from .hass_api_layer import HassApiLayer
+from array import array
+from time import monotonic
+
+from .hass_command_queue import WAIT_TIMEOUT
+from .hass_device import DeviceView
+from .hass_device_registry import FILTER_CACHE_SIZE
+from .hass_history import DEFAULT_CHUNK
+from .hass_plan import is_redundant
+from .hass_template import TemplateWatch, aggregate_template, parse_result
 
 class HassCommand:
-    def __init__(self, url, api_key, devices):
+    def __init__(self, home, positions=None):
         '''
         A pretty command builder and executor for home assistant API commands
+        All commands built from the same Home share its REST transport (and connection pool)
+        A command is a view over the home's shared device registry, so building one copies no devices
+
+        positions: sorted array of positions of this command's devices in the home's device registry (None for all devices)
         '''
 
-        self.url = url
-        self.api_key = api_key
+        self.home = home
+        self.url = home.url
+        self.api_key = home.api_key
+
+        self.registry = home.registry
+        self.positions = positions
+
+        # A sequence of Devices (see Device)
+        if positions is None:
+            self.devices = self.registry.devices
+        else:
+            self.devices = DeviceView(self.registry.devices, positions)
+
+        self.api_layer = home.api_layer
+
+        # Transport for service calls: the REST api_layer, or the home's websocket (see Home)
+        self.service_layer = home.service_layer
 
-        # A list of json objects corresponding to devices
-        self.devices = devices
+        # Memoized filter results: sorted kwargs -> HassCommand
+        self._filters = {}
 
-        self.api_layer = HassApiLayer(url, api_key)
+        # This command moved to a newer registry: (registry, HassCommand)
+        self._rebased = None
 
     def filter(self, **kwargs):
         '''
@@ -23,44 +51,45 @@ class HassCommand:
         For kwarg values that start/end with *, they are treated like the Kleene star (match anything)
 
         For kwarg values that start with !, the filter will filter out devices that match the subsequent string.
+
+        Results are memoized, so repeating the same filter on the same HassCommand is nearly free
         '''
+        if self.home.registry is not self.registry:
+            # Devices changed since this command was built. Filter the same devices in the current registry instead
+            return self._rebase().filter(**kwargs)
 
-        # Persist a new list of devices
-        devices = []
-        for device in self.devices:
-            for kwarg in kwargs:
-                if not device[kwarg]:
-                    # Device doesnt have the kwarg, so it cannot match
-                    break
-
-                if kwargs[kwarg].startswith("*") and kwargs[kwarg].endswith("*"):
-                    if kwargs[kwarg][1:-1] not in device[kwarg]:
-                        # kwargs[kwarg] not contained in device[kwarg]
-                        break
-
-                elif kwargs[kwarg].startswith("*"):
-                    if not device[kwarg].endswith(kwargs[kwarg][1:]):
-                        # device[kwarg] does not end with kwargs[kwarg]
-                        break
-
-                elif kwargs[kwarg].endswith("*"):
-                    if not device[kwarg].startswith(kwargs[kwarg][:-1]):
-                        # device[kwarg] does not start with kwargs[kwarg]
-                        break
-
-                elif kwargs[kwarg].startswith("!"):
-                    if device[kwarg] == kwargs[kwarg][1:]:
-                        # device[kwarg] matches kwargs[kwarg], which we do not want
-                        break
-                    
-                elif device[kwarg] != kwargs[kwarg]:
-                    # This is a nonmatch
-                    break
-            else:
-                # All kwargs match (loop not broken), this is a match
-                devices.append(device)
+        key = tuple(sorted(kwargs.items()))
+
+        command = self._filters.get(key)
+        if command:
+            return command
+
+        command = type(self)(self.home, self.registry.select(self.positions, kwargs))
+
+        if len(self._filters) >= FILTER_CACHE_SIZE:
+            # Filters built from changing values (ex. names from events) should not grow the cache forever
+            self._filters.clear()
+
+        self._filters[key] = command
 
-        return HassCommand(self.url, self.api_key, devices)
+        return command
+
+    def _rebase(self):
+        '''
+        Return a HassCommand with the same devices (those which still exist) in the home's current registry
+        '''
+        registry = self.home.registry
+        if self._rebased and self._rebased[0] is registry:
+            return self._rebased[1]
+
+        if self.positions is None:
+            command = type(self)(self.home)
+        else:
+            positions = (registry.position_of.get(device["entity_id"]) for device in self.devices)
+            command = type(self)(self.home, array("l", sorted(position for position in positions if position is not None)))
+
+        self._rebased = (registry, command)
+        return command
     
     def get(self):
         '''
@@ -93,86 +122,279 @@ class HassCommand:
             return lst[0]
         else:
             return lst
+
+    def _group_by_type(self, devices):
+        '''
+        Group the entity_ids of devices by device type (domain), preserving device order
+        '''
+        groups = {}
+        for device in devices:
+            groups.setdefault(device["type"], []).append(device["entity_id"])
+
+        return groups
+
+    def _split_responses(self, entity_ids, response, result):
+        '''
+        Save the response of a service call on entity_ids into result (entity_id -> response)
+        Every transport responds with the changed states, so each entity gets the changed states which belong to it
+        '''
+        # Split the changed states in the response back up by entity
+        changed = {}
+        for state in response:
+            changed.setdefault(state.get("entity_id"), []).append(state)
+
+        for entity_id in entity_ids:
+            result[entity_id] = changed.get(entity_id, [])
+
+    def _call_batched(self, service, devices, **attributes):
+        '''
+        Call service (ex. self.service_layer.turn_on) once per device type, with every entity_id of that type at once
+        hass services accept a list of entity_ids, so this sends one request per domain instead of one per device
+
+        Return a dictionary of entity_id -> response for that device (see _split_responses)
+        '''
+        state_store = self.home.state_store
+
+        result = {}
+        for device_type, entity_ids in self._group_by_type(devices).items():
+            response = service(entity_ids, device_type, **attributes)
+            if state_store:
+                state_store.apply_changes(response)
+
+            self._split_responses(entity_ids, response, result)
+
+        return result
     
+    def _drop_redundant(self, service, devices, attributes, states=None):
+        '''
+        Split devices into (devices to call, entity_ids to skip), skipping devices which already are in the state service leads to
+        states: full state jsons of devices (defaults to the home's state mirror while a listener keeps it live, otherwise nothing is skipped)
+
+        Nothing is skipped without skip_redundant on the home, nor with a command queue, since queued calls may still change the devices
+        '''
+        if not self.home.skip_redundant or self.home.command_queue is not None:
+            return devices, []
+
+        if states is None:
+            state_store = self.home.state_store
+            if not state_store or not state_store.live:
+                # A mirror without a listener misses changes made outside this process, so its states could drop needed calls
+                # Reading states instead would cost more than the calls it saves
+                return devices, []
+
+            states = [state_store.get(device["entity_id"]) for device in devices]
+
+        needed, skipped = [], []
+        for device, state in zip(devices, states):
+            if is_redundant(state, service, attributes):
+                skipped.append(device["entity_id"])
+            else:
+                needed.append(device)
+
+        return needed, skipped
+
+    def _call(self, service, devices, wait, **attributes):
+        '''
+        Call service (ex. "turn_on") on devices, and return a dictionary of entity_id -> response for that device
+
+        Without a command queue on the home, calls are sent right away (see _call_batched), and wait must be None
+        With a command queue (see CommandQueue), calls are queued, and the result depends on wait:
+            None: return right away, with a QueuedCommand per device instead of its response
+            "accepted" or "applied": wait until hass accepted (or applied) every call, and return the responses
+                Raises TimeoutError if that takes longer than WAIT_TIMEOUT seconds
+        '''
+        queue = self.home.command_queue
+        if queue is None:
+            if wait is not None:
+                raise RuntimeError(f"wait={wait!r} needs a command queue (see Home(queue_commands=True))")
+
+            devices, skipped = self._drop_redundant(service, devices, attributes)
+
+            result = self._call_batched(getattr(self.service_layer, service), devices, **attributes)
+            for entity_id in skipped:
+                # Like a REST call which changed nothing
+                result[entity_id] = []
+
+            return result
+
+        handles = {device["entity_id"]: queue.submit(device["entity_id"], device["type"], service, attributes) for device in devices}
+        if wait is None:
+            return handles
+
+        deadline = monotonic() + WAIT_TIMEOUT
+        return {entity_id: handle.result(wait, max(0, deadline - monotonic())) for entity_id, handle in handles.items()}
+
     def get_attributes(self):
         '''
         Get a list of attributes for each device
         If there is just one device, return the first element of such a list
         '''
-        result = []
-        for device in self.devices:
-            result.append(self.api_layer.states(device["entity_id"])["attributes"])
-
-        return self._refine(result)
+        return self._refine([state["attributes"] for state in self._full_states()])
         
     def get_state(self):
         '''
         Return a list of states for each device
         If there is just one device, return the first element of such a list
         '''
-        result = []
-        for device in self.devices:
-            result.append(self.api_layer.states(device["entity_id"])["state"])
-        
-        return self._refine(result)
+        return self._refine(self._states())
+
+    def _states(self):
+        '''
+        Return a list of states for each device (never refined)
+        '''
+        return [state["state"] for state in self._full_states()]
+
+    def _full_states(self):
+        '''
+        Return a list of full state jsons for each device (never refined)
+        States are read from the home's state mirror when it is fresh, falling back to the REST API otherwise
+        If many states are missing, they are read with one bulk request instead of one request each (see HassApiLayer.states_of)
+        '''
+        state_store = self.home.state_store
+
+        result = [state_store.get(device["entity_id"]) if state_store else None for device in self.devices]
+
+        # No mirror, mirror is stale, or mirror does not know these entities
+        missing = [i for i, state in enumerate(result) if state is None]
+        if missing:
+            states = self.api_layer.states_of([self.devices[i]["entity_id"] for i in missing])
+            for i, state in zip(missing, states):
+                result[i] = state
+
+        return result
     
-    def turn_on(self, **attributes):
+    def turn_on(self, wait=None, **attributes):
         '''
         Set attributes for all devices via given attributes, and turn devices on
+        One request is sent per device type
         Return list of responses
         If there is just one device, return the first element of such a list
+
+        wait: how long to wait on calls if the home queues commands (see _call)
         '''
-        result = []
-        for device in self.devices:
-            result.append(self.api_layer.turn_on(device["entity_id"], device["type"], **attributes))
+        responses = self._call("turn_on", self.devices, wait, **attributes)
 
-        return self._refine(result)
+        return self._refine([responses[device["entity_id"]] for device in self.devices])
     
-    def set_attributes(self, **attributes):
+    def set_attributes(self, wait=None, **attributes):
         '''
         Set attributes for all devices that are ON via given attributes
         Devices that are not on do not turn on, or change attributes
+        One request is sent per device type
         Return list of responses
         If there is just one device, return the first element of such a list
+
+        wait: how long to wait on calls if the home queues commands (see _call)
         '''
-        # Get device states. We only change attributes if device is on
-        states = self.get_state()
+        # Get device states. We only change attributes if device is on, and do not already have them
+        full_states = self._full_states()
+        states = [state["state"] for state in full_states]
+
+        on_devices = [(device, state) for state, device in zip(full_states, self.devices) if state["state"] == "on"]
+        devices, skipped = self._drop_redundant("turn_on", [device for device, state in on_devices], attributes, [state for device, state in on_devices])
+
+        responses = self._call("turn_on", devices, wait, **attributes)
+        for entity_id in skipped:
+            responses[entity_id] = []
 
         result = []
         for state, device in zip(states, self.devices):
             if state == "on":
-                result.append(self.api_layer.turn_on(device["entity_id"], device["type"], **attributes))
+                result.append(responses[device["entity_id"]])
             else:
                 result.append({"state": "off"})
 
         return self._refine(result)
     
-    def turn_off(self):
+    def turn_off(self, wait=None):
         '''
         Turn off all devices
+        One request is sent per device type
         Return list of responses
         If there is just one device, return the first element of such a list
+
+        wait: how long to wait on calls if the home queues commands (see _call)
         '''
-        result = []
-        for device in self.devices:
-            result.append(self.api_layer.turn_off(device["entity_id"], device["type"]))
+        responses = self._call("turn_off", self.devices, wait)
 
-        return self._refine(result)
+        return self._refine([responses[device["entity_id"]] for device in self.devices])
     
     def google_assistant(self, command):
         '''
         Send a text command to Google Assistant SDK (if already set up in hass)
         '''
-        return self.api_layer.google_assistant(command)
+        return self.service_layer.google_assistant(command)
+
+    def _aggregate_template(self, function, attribute, value):
+        return aggregate_template([device["entity_id"] for device in self.devices], function, attribute, value)
+
+    def aggregate(self, function, attribute=None, value=None):
+        '''
+        Compute function ("count", "any", "all", "min", "max" or "mean") over the state (or attribute) of all devices on the hass server
+        One request is sent, however many devices there are (see aggregate_template)
+
+        ex. lights.aggregate("count", value="on"), bedroom_sensors.aggregate("max", attribute="temperature")
+        '''
+        template = self._aggregate_template(function, attribute, value)
+        api_layer = self._rest_layer("Aggregate")
+
+        return parse_result(api_layer.render_template(template), api_layer.codec)
+
+    def watch_aggregate(self, function, callback, attribute=None, value=None):
+        '''
+        Like aggregate, but pushed: callback(value) is called with the aggregate now, and whenever it changes
+        callback runs on the home's loop thread. Return the TemplateWatch, which unwatch cancels
+        '''
+        watch = TemplateWatch(self.home.ws, self._aggregate_template(function, attribute, value), callback)
+
+        return self.home.loop.run(watch.start())
+
+    def unwatch(self, watch):
+        '''
+        Cancel a TemplateWatch returned by watch_aggregate
+        '''
+        self.home.loop.run(watch.cancel())
+
+    def _rest_layer(self, feature):
+        '''
+        Return the home's REST transport, which feature (ex. "History") needs
+        '''
+        if self.api_layer is None:
+            raise RuntimeError(f"{feature} needs the REST transport (see Home)")
+
+        return self.api_layer
+
+    def history(self, start, end=None, chunk=DEFAULT_CHUNK, attributes=False):
+        '''
+        Stream the state history of all devices between start and end (datetimes, end defaults to now) as a generator of states
+        The range is paged through in windows of chunk, so memory stays bounded (see HassApiLayer.history)
+        '''
+        return self._rest_layer("History").history([device["entity_id"] for device in self.devices], start, end, chunk, attributes)
+
+    def history_columns(self, start, end=None, chunk=DEFAULT_CHUNK, numpy=False):
+        '''
+        Return the numeric history of all devices (ex. sensors) as entity_id -> (timestamps, values) columns (see HassApiLayer.history_columns)
+        '''
+        return self._rest_layer("History").history_columns([device["entity_id"] for device in self.devices], start, end, chunk, numpy)
+
+    def logbook(self, start, end=None, chunk=DEFAULT_CHUNK):
+        '''
+        Stream the logbook entries of all devices between start and end as a generator, in time order
+        '''
+        if not self.devices:
+            return
+
+        yield from self._rest_layer("Logbook").logbook(start, end, [device["entity_id"] for device in self.devices], chunk)
     
-    def toggle(self, **attributes):
+    def toggle(self, wait=None, **attributes):
         '''
         Toggle all devices and set attributes
+        One request is sent per device type
         Return list of responses
         If there is just one device, return the first element of such a list
+
+        wait: how long to wait on calls if the home queues commands (see _call)
         '''
-        result = []
-        for device in self.devices:
-            result.append(self.api_layer.toggle(device["entity_id"], device["type"], **attributes))
+        responses = self._call("toggle", self.devices, wait, **attributes)
 
-        return self._refine(result)
\ No newline at end of file
+        return self._refine([responses[device["entity_id"]] for device in self.devices])
\ No newline at end of file
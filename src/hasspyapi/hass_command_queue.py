@@ -0,0 +1,313 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+from collections import OrderedDict, deque
+from threading import Condition, Thread
+from time import monotonic
+
+# Services which set a device to a target, so a newer call makes an older unsent one obsolete
+# toggle depends on the state it is sent in, so toggles are never coalesced
+COALESCED_SERVICES = ("turn_on", "turn_off")
+
+# The state each service leaves a device in (see QueuedCommand.result)
+TARGET_STATES = {"turn_on": "on", "turn_off": "off"}
+
+# Seconds HassCommand waits on queued calls by default (see QueuedCommand.result)
+WAIT_TIMEOUT = 30
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        '''
+        Allows rate events per second on average, and up to burst events at once
+        '''
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now):
+        '''
+        Return seconds until a token is available (0 if one is available now)
+        '''
+        self._refill(now)
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+class QueuedCommand:
+    def __init__(self, queue, entity_id):
+        '''
+        Handle of a service call on entity_id submitted to a CommandQueue
+        If the call is coalesced into a newer one, the handle follows the newer call
+        '''
+        self.queue = queue
+        self.entity_id = entity_id
+
+        # Resolved with the entity's response once hass accepted the call
+        self.accepted = Future()
+
+        # Mirrored state of the entity right before the call was sent, and the state the call leaves it in (None if unknown)
+        self.state_before = None
+        self.target_state = None
+
+    def result(self, wait="accepted", timeout=None):
+        '''
+        Wait until the call was accepted by hass ("accepted"), or until the home's state mirror shows it was applied ("applied")
+        Return the response of the call
+
+        A call which changed nothing (the device already was in its target state) counts as applied right away
+        timeout: seconds to wait in total (None to wait forever)
+        '''
+        if wait not in ("accepted", "applied"):
+            raise RuntimeError(f"Unknown wait {wait}, expected accepted or applied")
+
+        deadline = monotonic() + timeout if timeout is not None else None
+        response = self.accepted.result(timeout)
+
+        if wait == "applied":
+            state_store = self.queue.state_store
+            if state_store is None:
+                raise RuntimeError("Waiting for applied commands needs a state mirror (see Home(mirror_states=True))")
+
+            def applied(state):
+                if state is None or self.target_state not in (None, state.get("state")):
+                    return False
+
+                # A newer state arrived after the call was sent, or hass changed nothing since it was already applied
+                return state is not self.state_before or not response
+
+            remaining = max(0, deadline - monotonic()) if deadline is not None else None
+            if not state_store.wait_for(self.entity_id, applied, remaining):
+                raise TimeoutError(f"{self.entity_id} did not reach its new state in {timeout} seconds")
+
+        return response
+
+class _PendingCall:
+    def __init__(self, entity_id, device_type, service, attributes):
+        '''
+        An unsent service call on one entity, and the handles waiting on it
+        '''
+        self.entity_id = entity_id
+        self.device_type = device_type
+        self.service = service
+        self.attributes = dict(attributes)
+        self.handles = []
+
+    def merge(self, service, attributes):
+        '''
+        Coalesce a newer call into this one (last write wins)
+        '''
+        if service == self.service == "turn_on":
+            self.attributes.update(attributes)
+        else:
+            self.service = service
+            self.attributes = dict(attributes)
+
+    def group_key(self):
+        '''
+        Calls with the same key can be sent as one call on every entity_id
+        '''
+        return (self.device_type, self.service, tuple(sorted((key, repr(value)) for key, value in self.attributes.items())))
+
+class CommandQueue:
+    def __init__(self, service_layer, state_store=None, entity_rate=None, entity_burst=1, global_rate=None, global_burst=10, max_in_flight=4):
+        '''
+        An outbound queue of service calls, so rapid-fire callers (ex. dimmer handlers) never flood hass with obsolete calls
+
+        Each entity has its own queue. While a call waits to be sent, newer turn_on/turn_off calls on the same entity are merged into it
+        (last write wins, turn_on attributes are merged). An entity has at most one call in flight, and calls on one entity keep their order
+        Ready calls with the same service and attributes are sent together, as one call per device type
+
+        service_layer: transport to send calls with (HassApiLayer or HassWebSocketServiceLayer)
+        state_store: the home's HassStateStore, used to wait for calls to be applied
+        entity_rate, entity_burst: calls per second (and burst) allowed per entity (None for no limit)
+        global_rate, global_burst: calls per second (and burst) allowed in total (None for no limit)
+        max_in_flight: maximum number of calls waiting on hass at once
+        '''
+        self.service_layer = service_layer
+        self.state_store = state_store
+
+        self.entity_rate = entity_rate
+        self.entity_burst = entity_burst
+        self.global_bucket = TokenBucket(global_rate, global_burst) if global_rate else None
+        self.max_in_flight = max_in_flight
+
+        # entity_id -> deque of unsent _PendingCalls (oldest first), in round robin order
+        self._pending = OrderedDict()
+        self._entity_buckets = {}
+
+        # Entities with a call in flight, and the number of calls in flight
+        self._busy = set()
+        self._in_flight = 0
+
+        self._condition = Condition()
+        self._executor = ThreadPoolExecutor(max_in_flight, thread_name_prefix="hasspyapi-command")
+        self._thread = None
+
+        # Metrics (see stats)
+        self.submitted = 0
+        self.coalesced = 0
+        self.sent = 0
+
+    def submit(self, entity_id, device_type, service, attributes):
+        '''
+        Queue a call of service (ex. "turn_on") on entity_id with attributes, and return its QueuedCommand
+        '''
+        if self._thread is None:
+            self.start()
+
+        handle = QueuedCommand(self, entity_id)
+
+        with self._condition:
+            self.submitted += 1
+            calls = self._pending.setdefault(entity_id, deque())
+
+            if calls and calls[-1].service in COALESCED_SERVICES and service in COALESCED_SERVICES:
+                calls[-1].merge(service, attributes)
+                self.coalesced += 1
+            else:
+                calls.append(_PendingCall(entity_id, device_type, service, attributes))
+
+            calls[-1].handles.append(handle)
+            self._condition.notify()
+
+        return handle
+
+    def start(self):
+        '''
+        Start the dispatch thread (once)
+        '''
+        with self._condition:
+            if self._thread is None:
+                self._thread = Thread(target=self._dispatch, name="hasspyapi-commands", daemon=True)
+                self._thread.start()
+
+    def _entity_bucket(self, entity_id):
+        if self.entity_rate is None:
+            return None
+
+        bucket = self._entity_buckets.get(entity_id)
+        if bucket is None:
+            bucket = self._entity_buckets[entity_id] = TokenBucket(self.entity_rate, self.entity_burst)
+
+        return bucket
+
+    def _take_ready(self, now):
+        '''
+        Remove and return groups of calls which can be sent now, and the seconds until more can be sent (None to wait for a change)
+        Must hold self._condition
+        '''
+        groups = {}
+        wait = None
+
+        for entity_id in list(self._pending):
+            calls = self._pending[entity_id]
+            if entity_id in self._busy:
+                continue
+
+            bucket = self._entity_bucket(entity_id)
+            delay = bucket.delay(now) if bucket else 0
+            if delay:
+                wait = delay if wait is None else min(wait, delay)
+                continue
+
+            call = calls[0]
+            key = call.group_key()
+            if key not in groups:
+                # A new group is a new call to hass
+                if self._in_flight + len(groups) >= self.max_in_flight:
+                    break
+
+                if self.global_bucket:
+                    delay = self.global_bucket.delay(now)
+                    if delay:
+                        wait = delay if wait is None else min(wait, delay)
+                        break
+                    self.global_bucket.take(now)
+
+                groups[key] = []
+
+            calls.popleft()
+            if bucket:
+                bucket.take(now)
+            groups[key].append(call)
+            self._busy.add(entity_id)
+
+            # Round robin, so one busy entity never starves the others
+            del self._pending[entity_id]
+            if calls:
+                self._pending[entity_id] = calls
+
+        self._in_flight += len(groups)
+        return list(groups.values()), wait
+
+    def _dispatch(self):
+        '''
+        Dispatch thread: send calls as soon as rate limits and in flight limits allow
+        '''
+        while True:
+            with self._condition:
+                groups, wait = self._take_ready(monotonic())
+                while not groups:
+                    self._condition.wait(wait)
+                    groups, wait = self._take_ready(monotonic())
+
+            for group in groups:
+                self._executor.submit(self._send, group)
+
+    def _send(self, group):
+        '''
+        Send a group of calls (same device type, service and attributes) as one call, and resolve their handles
+        '''
+        first = group[0]
+        entity_ids = [call.entity_id for call in group]
+
+        for call in group:
+            before = self.state_store.states.get(call.entity_id) if self.state_store else None
+            for handle in call.handles:
+                handle.state_before = before
+                handle.target_state = TARGET_STATES.get(call.service)
+
+        try:
+            service = getattr(self.service_layer, first.service)
+            if first.service == "turn_off":
+                response = service(entity_ids, first.device_type)
+            else:
+                response = service(entity_ids, first.device_type, **first.attributes)
+
+            if self.state_store:
+                self.state_store.apply_changes(response)
+
+            for call in group:
+                # The changed states of every entity in the call
+                result = [state for state in response if state.get("entity_id") == call.entity_id]
+
+                for handle in call.handles:
+                    handle.accepted.set_result(result)
+
+        except Exception as exc:
+            for call in group:
+                for handle in call.handles:
+                    handle.accepted.set_exception(exc)
+
+        finally:
+            with self._condition:
+                self.sent += 1
+                self._in_flight -= 1
+                self._busy.difference_update(entity_ids)
+                self._condition.notify()
+
+    def stats(self):
+        '''
+        Return a dictionary of queue metrics
+        '''
+        with self._condition:
+            return {"pending": sum(len(calls) for calls in self._pending.values()),
+                    "in_flight": self._in_flight,
+                    "submitted": self.submitted,
+                    "coalesced": self.coalesced,
+                    "sent": self.sent}
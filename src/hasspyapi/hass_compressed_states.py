@@ -0,0 +1,93 @@
+from datetime import datetime, timezone
+
+def _isoformat(timestamp):
+    '''
+    Convert a compressed (epoch seconds) timestamp to the isoformat used by state_changed events
+    '''
+    return datetime.fromtimestamp(timestamp, timezone.utc).isoformat()
+
+def _context(context):
+    '''
+    Expand a compressed context (just an id, or a dictionary) to a full context
+    '''
+    if isinstance(context, dict):
+        return {"id": context.get("id"), "parent_id": context.get("parent_id"), "user_id": context.get("user_id")}
+
+    return {"id": context, "parent_id": None, "user_id": None}
+
+class CompressedStateTracker:
+    def __init__(self):
+        '''
+        Keeps the full state of every entity from a subscribe_entities subscription
+        hass only sends state diffs on such a subscription, so they are applied here to rebuild state_changed style data
+        '''
+        # entity_id -> full state json
+        self.states = {}
+
+    def _expand(self, entity_id, compressed):
+        '''
+        Expand a compressed state addition to a full state json
+        '''
+        last_changed = compressed.get("lc")
+        last_updated = compressed.get("lu", last_changed)
+
+        return {"entity_id": entity_id,
+                "state": compressed.get("s"),
+                "attributes": compressed.get("a", {}),
+                "last_changed": _isoformat(last_changed) if last_changed is not None else None,
+                "last_updated": _isoformat(last_updated) if last_updated is not None else None,
+                "context": _context(compressed.get("c"))}
+
+    def _patch(self, old_state, diff):
+        '''
+        Apply a compressed diff ({"+": additions, "-": removals}) to a copy of old_state
+        '''
+        new_state = dict(old_state)
+        additions = diff.get("+", {})
+        removals = diff.get("-", {})
+
+        if "s" in additions:
+            new_state["state"] = additions["s"]
+        if "lc" in additions:
+            new_state["last_changed"] = new_state["last_updated"] = _isoformat(additions["lc"])
+        if "lu" in additions:
+            new_state["last_updated"] = _isoformat(additions["lu"])
+        if "c" in additions:
+            new_state["context"] = _context(additions["c"])
+
+        if "a" in additions or "a" in removals:
+            attributes = dict(old_state.get("attributes", {}))
+            attributes.update(additions.get("a", {}))
+            for key in removals.get("a", []):
+                attributes.pop(key, None)
+            new_state["attributes"] = attributes
+
+        return new_state
+
+    def apply(self, event):
+        '''
+        Apply a subscribe_entities event ({"a": additions, "c": changes, "r": removals})
+        Return a list of state_changed style data ({entity_id, old_state, new_state}), one per changed entity
+        '''
+        changes = []
+
+        for entity_id, compressed in event.get("a", {}).items():
+            new_state = self._expand(entity_id, compressed)
+            changes.append({"entity_id": entity_id, "old_state": self.states.get(entity_id), "new_state": new_state})
+            self.states[entity_id] = new_state
+
+        for entity_id, diff in event.get("c", {}).items():
+            old_state = self.states.get(entity_id)
+            if old_state is None:
+                # A change to an entity we never saw added, nothing to apply it to
+                continue
+
+            new_state = self._patch(old_state, diff)
+            changes.append({"entity_id": entity_id, "old_state": old_state, "new_state": new_state})
+            self.states[entity_id] = new_state
+
+        for entity_id in event.get("r", []):
+            old_state = self.states.pop(entity_id, None)
+            changes.append({"entity_id": entity_id, "old_state": old_state, "new_state": None})
+
+        return changes
@@ -0,0 +1,72 @@
+from collections.abc import Mapping, Sequence
+from sys import intern
+
+from .hass_device_registry import DEVICE_KEYS
+
+def _intern(value):
+    '''
+    Intern value if it is a string, so devices share one copy of repeated areas, types and names
+    '''
+    return intern(value) if isinstance(value, str) else value
+
+class Device(Mapping):
+    __slots__ = DEVICE_KEYS
+
+    def __init__(self, entity_id, name, area_id, area, type):
+        '''
+        A compact, read-only device record {entity_id, name, area_id, area, type}
+        Reads like the device dictionaries it replaces (device["area"], device.get("name"), dict(device))
+        It is not a dict though, so use to_dict for code which needs one (ex. json.dumps)
+        '''
+        self.entity_id = entity_id
+        self.name = _intern(name)
+        self.area_id = _intern(area_id)
+        self.area = _intern(area)
+        self.type = _intern(type)
+
+    def __getitem__(self, key):
+        if key not in DEVICE_KEYS:
+            raise KeyError(key)
+
+        return getattr(self, key)
+
+    def __iter__(self):
+        return iter(DEVICE_KEYS)
+
+    def __len__(self):
+        return len(DEVICE_KEYS)
+
+    def to_dict(self):
+        '''
+        Return the device as a plain dictionary
+        '''
+        return {key: getattr(self, key) for key in DEVICE_KEYS}
+
+    def __repr__(self):
+        return repr(self.to_dict())
+
+class DeviceView(Sequence):
+    __slots__ = ("devices", "positions")
+
+    def __init__(self, devices, positions):
+        '''
+        The devices at positions of a registry's device list, without copying them into a new list
+        '''
+        self.devices = devices
+        self.positions = positions
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return DeviceView(self.devices, self.positions[index])
+
+        return self.devices[self.positions[index]]
+
+    def __iter__(self):
+        devices = self.devices
+        return (devices[position] for position in self.positions)
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __repr__(self):
+        return repr(list(self))
@@ -0,0 +1,120 @@
+from functools import lru_cache
+from operator import attrgetter
+from array import array
+
+# Device attributes which can be filtered on
+DEVICE_KEYS = ("entity_id", "name", "area_id", "area", "type")
+
+# Device attributes which are hash indexed for exact matches
+INDEXED_KEYS = ("area", "area_id", "type", "name")
+
+# Maximum number of memoized filter results kept per HassCommand
+FILTER_CACHE_SIZE = 256
+
+@lru_cache(maxsize=4096)
+def compile_pattern(pattern):
+    '''
+    Compile a filter value into (exact, predicate), parsing the pattern only once
+    exact is the value to look up in an index if pattern is a plain value, otherwise None
+    predicate(value) returns whether a (truthy) device value matches pattern
+
+    For values that start/end with *, they are treated like the Kleene star (match anything)
+    For values that start with !, the predicate matches values which do not match the subsequent string
+    '''
+    if not isinstance(pattern, str):
+        return pattern, lambda value: value == pattern
+
+    if pattern.startswith("*") and pattern.endswith("*"):
+        part = pattern[1:-1]
+        return None, lambda value: part in value
+
+    elif pattern.startswith("*"):
+        part = pattern[1:]
+        return None, lambda value: value.endswith(part)
+
+    elif pattern.endswith("*"):
+        part = pattern[:-1]
+        return None, lambda value: value.startswith(part)
+
+    elif pattern.startswith("!"):
+        part = pattern[1:]
+        return None, lambda value: value != part
+
+    return pattern, lambda value: value == pattern
+
+class DeviceRegistry:
+    def __init__(self, devices):
+        '''
+        Holds the list of Devices {entity_id, name, area, area_id, type} of a home (see Device)
+        Exact values of area, area_id, type and name are hash indexed, so filters do not need to scan every device
+        Devices are referred to by their position in self.devices, and sets of devices by compact position arrays
+
+        A registry never changes. When hass registries change, Home builds a new one
+        '''
+        self.devices = devices
+
+        self._build_indexes()
+
+    def _build_indexes(self):
+        '''
+        Build a map of key -> value -> sorted list of positions for every indexed key
+        '''
+        self.indexes = {key: {} for key in INDEXED_KEYS}
+
+        # Map of entity_ids to positions
+        self.position_of = {}
+
+        for position, device in enumerate(self.devices):
+            self.position_of[device["entity_id"]] = position
+
+            for key, index in self.indexes.items():
+                index.setdefault(device.get(key), array("l")).append(position)
+
+    def select(self, positions, filters):
+        '''
+        Return the sorted array of positions (out of positions, or all devices if None) whose devices match every filter
+        filters is a dictionary of device key -> pattern (see compile_pattern)
+        '''
+        # Exact matches on indexed keys give candidate lists straight from an index
+        # The smallest one drives the search, and every other filter is checked per candidate
+        driver = None
+        checks = []
+        for key, pattern in filters.items():
+            if key not in DEVICE_KEYS:
+                raise KeyError(f"Cannot filter on unknown device attribute {key}, expected one of {DEVICE_KEYS}")
+
+            exact, predicate = compile_pattern(pattern)
+            checks.append((attrgetter(key), predicate))
+
+            if exact and key in self.indexes:
+                hits = self.indexes[key].get(exact, ())
+                if driver is None or len(hits) < len(driver[1]):
+                    driver = (len(checks) - 1, hits)
+
+        if driver is not None and (positions is None or len(driver[1]) < len(positions)):
+            # The index lookup already guarantees its own filter
+            del checks[driver[0]]
+            candidates = driver[1]
+
+            if positions is not None:
+                parent = set(positions)
+                candidates = (position for position in candidates if position in parent)
+
+        elif positions is not None:
+            candidates = positions
+
+        else:
+            candidates = range(len(self.devices))
+
+        result = array("l")
+        for position in candidates:
+            device = self.devices[position]
+            for getter, predicate in checks:
+                value = getter(device)
+                if not value or not predicate(value):
+                    # Device doesnt have the key, or does not match
+                    break
+            else:
+                result.append(position)
+
+        return result
@@ -0,0 +1,154 @@
+from collections import deque
+from collections.abc import Mapping
+
+from .hass_json import LazyJson
+
+# Keys which change on (almost) every state_changed event, skipped by default when diffing
+NOISY_KEYS = frozenset(("last_updated", "last_reported", "context"))
+
+def json_diff(old, new, skip_keys=NOISY_KEYS):
+    '''
+    Construct a flattened json diff of old and new, returned as (old_diff, new_diff)
+    old_diff: dictionary mapping leaf keys to old values (if changed)
+    new_diff: dictionary mapping leaf keys to new values (if changed)
+
+    Every changed leaf is saved under its leaf key (ex. brightness) and, when nested, under its full path (ex. attributes.brightness)
+    If nested leaves share a leaf key, the shallowest one keeps the leaf key, so top level keys (ex. state) are never shadowed
+    Keys in skip_keys are not compared at any level
+
+    Results in a flattened event containing only changes, which helps clean up poor event structure
+    '''
+    old_diff, new_diff = {}, {}
+
+    # Walk breadth first, so shallower leaves claim their leaf keys first
+    pending = deque(((None, None, old, new),))
+    while pending:
+        path, key, old, new = pending.popleft()
+
+        if old is new:
+            continue
+
+        if isinstance(old, dict) and isinstance(new, dict):
+            if old == new:
+                # Equal subtrees are compared in C, without walking them
+                continue
+
+            for child in old.keys() | new.keys():
+                if child in skip_keys:
+                    continue
+
+                child_path = child if path is None else f"{path}.{child}"
+                pending.append((child_path, child, old.get(child), new.get(child)))
+
+        elif old != new:
+            # old and new are leaves (or only one is a dict). Save under the leaf key, and the full path if nested
+            if key not in new_diff:
+                old_diff[key] = old
+                new_diff[key] = new
+
+            if path != key:
+                old_diff[path] = old
+                new_diff[path] = new
+
+    return old_diff, new_diff
+
+def resolve(state, path):
+    '''
+    Return the value at a dotted path (ex. attributes.brightness) of a raw state json, or None if it does not exist
+    Paths which are not top level keys of the state are looked up in its attributes (ex. brightness)
+    '''
+    if state is None:
+        return None
+
+    parts = path.split(".")
+    value = state if parts[0] in state else state.get("attributes")
+
+    for part in parts:
+        if not isinstance(value, dict):
+            return None
+        value = value.get(part)
+
+    return value
+
+class StateChangedEvent(Mapping):
+    KEYS = ("entity_id", "old_state", "new_state", "raw_old_state", "raw_new_state")
+
+    def __init__(self, data, skip_keys=NOISY_KEYS, lazy=True):
+        '''
+        The message passed to trigger conditions and events for a state_changed event
+
+        old_state/new_state hold the flattened diff of the raw states (see json_diff)
+        raw_old_state/raw_new_state hold the untouched states from hass
+        They may arrive undecoded (LazyJson, see JsonCodec.loads_event), and are then decoded on first access
+
+        If lazy, the diff is only computed when old_state or new_state is first accessed
+        '''
+        self.entity_id = data.get("entity_id")
+        self._raw_old_state = data.get("old_state")
+        self._raw_new_state = data.get("new_state")
+
+        self.skip_keys = skip_keys
+        self._diff = None
+
+        if not lazy:
+            self.diff()
+
+    @property
+    def raw_old_state(self):
+        if isinstance(self._raw_old_state, LazyJson):
+            self._raw_old_state = self._raw_old_state.decode()
+
+        return self._raw_old_state
+
+    @property
+    def raw_new_state(self):
+        if isinstance(self._raw_new_state, LazyJson):
+            self._raw_new_state = self._raw_new_state.decode()
+
+        return self._raw_new_state
+
+    def state_json(self, key, codec):
+        '''
+        Return the raw state key ("old_state" or "new_state") as json bytes, or None if there is no state
+        States which arrived undecoded are returned as they arrived, without decoding them
+        '''
+        state = self._raw_old_state if key == "old_state" else self._raw_new_state
+        if state is None:
+            return None
+
+        if isinstance(state, LazyJson):
+            return state.raw.encode() if isinstance(state.raw, str) else state.raw
+
+        return codec.dumps(state).encode()
+
+    def diff(self):
+        '''
+        Return (old_diff, new_diff), computing it on first use
+        '''
+        if self._diff is None:
+            self._diff = json_diff(self.raw_old_state, self.raw_new_state, self.skip_keys)
+
+        return self._diff
+
+    def __getitem__(self, key):
+        if key == "entity_id":
+            return self.entity_id
+        if key == "old_state":
+            return self.diff()[0]
+        if key == "new_state":
+            return self.diff()[1]
+        if key == "raw_old_state":
+            return self.raw_old_state
+        if key == "raw_new_state":
+            return self.raw_new_state
+
+        raise KeyError(key)
+
+    def __iter__(self):
+        return iter(self.KEYS)
+
+    def __len__(self):
+        return len(self.KEYS)
+
+    def __repr__(self):
+        return f"StateChangedEvent({dict(self)})"
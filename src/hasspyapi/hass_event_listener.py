@@ -1,144 +1,660 @@
-from time import sleep, time_ns
-from threading import Thread
+from time import perf_counter, sleep, time_ns
+from threading import RLock, Thread
+from functools import partial
+from queue import Queue
+from operator import attrgetter
 import traceback
 import asyncio
+import heapq
 
+from .hass_compressed_states import CompressedStateTracker
+from .hass_event import NOISY_KEYS, StateChangedEvent
+from .hass_handler_pool import DispatchQueue, HandlerPool
+from .hass_json import scan_string
+from .hass_recorder import EventRecorder
+from .hass_scheduler import DeadlineScheduler
+from .hass_trigger import ANY, Trigger, TriggerScope
+from .hass_trigger_shards import TriggerShards
 from .hass_websocket_layer import HassWebSocketLayer
 
 class HassEventListener:
-    def __init__(self, ws_url, ws_headers):
+    def __init__(self, ws_url, ws_headers, state_store=None, event_types=("state_changed",), subscribe_entities=False, diff_skip_keys=NOISY_KEYS, lazy_diff=True,
+                 connection=None, loop=None, clock=time_ns, workers=1, max_queue=1000, overflow="block", metrics=None, history=None, processes=0):
         '''
         Creates a websocket subscribed to events, and defines decorators which call functions on recieving certain events
+        If state_store (HassStateStore) is given, every state_changed event is also applied to it, keeping it current
+
+        event_types: event types hass should send (None for every event on the bus). Only state_changed events fire triggers
+        subscribe_entities: use the compact subscribe_entities protocol instead of subscribe_events
+            The subscription is limited to the entities of scoped triggers when every trigger has entity_ids (see trigger_when)
+
+        Triggers get a StateChangedEvent per state_changed event:
+        diff_skip_keys: keys left out of the old_state/new_state diff (by default, noisy keys like last_updated and context)
+        lazy_diff: only compute the diff when a trigger accesses old_state/new_state
+
+        connection (HassWebSocketLayer) and loop (HassEventLoop): listen on an existing shared connection, owned by loop, instead of opening one
+        clock: function returning the current time in ns, used for duration triggers
+
+        conditions_met and events can also be coroutine functions. They run on the listening loop (see listen), so many async automations
+        need no thread per blocking call
+
+        Trigger events run on a pool of worker threads, so slow events never hold up recieving and checking events (see HandlerPool):
+        workers: number of worker threads (0 to run events right away on the dispatch thread)
+        max_queue: maximum number of events waiting for a worker, and of recieved events waiting for their conditions to be checked
+        overflow: what to do when the queue is full: "block", "drop_oldest" or "coalesce"
+            Recieved events are never waited on, since that would stall the listening loop: they are dropped or coalesced (see DispatchQueue)
+
+        metrics: HassMetrics to record condition and event times of every trigger in (None to not record them)
+
+        history: StateHistory to keep recent states of entities in, so conditions can query windows of the past (ex. time in state, mean)
+            It is updated as events arrive, before triggers are checked. Its clock follows the listener's clock
+
+        processes: number of worker processes to evaluate conditions_met on (0 to evaluate them in this process, see TriggerShards)
+            Conditions that cannot be pickled (lambdas, closures) are reported and evaluated in this process
+            Workers start with the listener, so register every CPU heavy trigger before starting. Sharded conditions may only depend on msg,
+            so processes cannot be combined with history or a state_store
         '''
+        if processes and (history is not None or state_store is not None):
+            raise RuntimeError("Sharded conditions run in other processes, which cannot see the listener's history or state mirror. Use processes=0 with them")
+
         self.ws_url = ws_url
         self.ws_headers = ws_headers
+        self.state_store = state_store
+
+        self.event_types = event_types
+        self.subscribe_entities = subscribe_entities
+
+        self.diff_skip_keys = diff_skip_keys
+        self.lazy_diff = lazy_diff
+
+        self.connection = connection
+        self.loop = loop
+
+        # Live websocket, its asyncio loop and our listening task (while listening), and our subscriptions on it
+        self._ws = None
+        self._loop = None
+        self._task = None
+        self._subscriptions = []
+
+        # subscribe_entities state: entities subscribed so far (None = every entity), subscriptions which sent their snapshot, and full states
+        self._subscribed_entities = set()
+        self._snapshots_seen = set()
+        self._subscription_lock = None
+        self._compressed_states = CompressedStateTracker()
+
+        # Recieved events waiting for the dispatch thread, bounded like the handler pool (see DispatchQueue)
+        self._dispatch_queue = DispatchQueue(max_queue, overflow)
+
+        # A list of Triggers, in registration order
+        # During listening, if an event matches a trigger's conditions, its event is called
+        self.triggers = []
+
+        # Dispatch index, so an event only reaches the triggers which can care about it
+        # Scoped triggers are keyed by entity_id (or domain if they only have a domain). Everything else is a catch-all
+        self._by_entity = {}
+        self._by_domain = {}
+        self._catch_all = []
+
+        # Deadlines of duration triggers, and a lock so deadlines and events never evaluate triggers at once
+        self.clock = clock
+        self.scheduler = DeadlineScheduler(clock)
+        self._lock = RLock()
+
+        self.metrics = metrics
+        self.pool = HandlerPool(workers, max_queue, overflow, metrics) if workers else None
+
+        # EventRecorder capturing recieved event messages (see record)
+        self.recorder = None
 
-        # A list of tuples of functions (conditions_met, event)
-        # During listening, if an event matches conditions_met, the event is called
-        self.events = []
+        self.history = history
+        if history is not None:
+            history.clock = clock
 
-        # Save the last time conditions were not met for each function
-        # If an event is fired due to duration, last_false is set to None until condition_met fails
-        self.last_false = []
+        self.shards = TriggerShards(self, processes, metrics=metrics) if processes else None
 
-        # Save the required duration for each event to be fired
-        self.duration = []
+    def record(self, path):
+        '''
+        Append every event message this listener recieves to a capture file at path, which EventReplay can replay later
+        Return the EventRecorder
+        '''
+        self.recorder = EventRecorder(path)
+        return self.recorder
+
+    def stop_recording(self):
+        '''
+        Stop recording, and close the capture file
+        '''
+        recorder, self.recorder = self.recorder, None
+        if recorder:
+            recorder.close()
 
-    def trigger_when(self, conditions_met, duration=None):
+    def trigger_when(self, conditions_met=None, duration=None, entity_id=None, domain=None, attribute=None, from_state=ANY, to_state=ANY, serialize=False):
         '''
         A function decorator which will save a set of conditions and event to be called when conditions are met
         If duration (seconds), then the event is fired when conditions are met for duration seconds (just once)
+            A deadline is armed when conditions become met, and the event fires right when it expires (unless conditions stopped being met)
 
         conditions_met should return:
             true if conditions are met
             false if conditions are not met
             None if the event is not valid for the event (for instance, the event doesnt match the right device, or if the event exists but we arent listening to a device)
+
+        Optionally, a declarative scope (see TriggerScope) limits which events reach the trigger:
+            entity_id: an entity_id, list of entity_ids, or HassCommand
+            domain: a domain (ex. "light") or list of domains
+            attribute, from_state, to_state: only match when attribute changes (from from_state) to to_state
+        Scoped triggers are only evaluated for events of their entities/domains. conditions_met is optional for scoped triggers
+
+        If serialize, calls of this event never overlap and keep their order, even with several workers
         '''
+        scope = None
+        if entity_id is not None or domain is not None or attribute is not None or from_state is not ANY or to_state is not ANY:
+            scope = TriggerScope(entity_id, domain, attribute, from_state, to_state)
+
+        if conditions_met is None and scope is None:
+            raise RuntimeError("trigger_when needs conditions_met, a scope, or both")
+
         def decorator(event):
-            self.events.append((conditions_met, event))
-            self.last_false.append(time_ns()) # Assume the last false is now
-            self.duration.append(duration)
+            trigger = Trigger(len(self.triggers), conditions_met, event, duration, scope, serialize)
+            self.triggers.append(trigger)
+
+            if scope and scope.entity_ids is not None:
+                for scoped_entity_id in scope.entity_ids:
+                    self._by_entity.setdefault(scoped_entity_id, []).append(trigger)
+            elif scope and scope.domains is not None:
+                for scoped_domain in scope.domains:
+                    self._by_domain.setdefault(scoped_domain, []).append(trigger)
+            else:
+                self._catch_all.append(trigger)
+
+            if self._ws and self.subscribe_entities:
+                # Already listening, so the subscription may need to grow to reach this trigger
+                asyncio.run_coroutine_threadsafe(self._extend_entity_subscription(), self._loop)
+
             return event
 
         return decorator
-    
+
+    def _route(self, msg):
+        '''
+        Return the triggers which can care about msg, in registration order
+        '''
+        if msg is None:
+            # Periodic check, which only catch-all triggers (opaque conditions, ex. time of day) can care about
+            return self._catch_all
+
+        entity_id = msg.get("entity_id") or ""
+        buckets = [bucket for bucket in (self._by_entity.get(entity_id),
+                                         self._by_domain.get(entity_id.split(".")[0]),
+                                         self._catch_all) if bucket]
+
+        if len(buckets) == 1:
+            return buckets[0]
+
+        # Every bucket is already in registration order
+        return heapq.merge(*buckets, key=attrgetter("index"))
+
     def fire_event(self, msg):
         '''
-        Fire off all events if conditions are met
+        Fire off all events (which can care about msg) if conditions are met
         Also handle duration checks
         '''
-        for i, (conditions_met, event) in enumerate(self.events):
+        self._finish(*self._begin(msg))
+
+    def _begin(self, msg):
+        '''
+        First half of fire_event: route msg, and send the sharded conditions which can care about it to the workers
+        Return the arguments of _finish: msg, the routed triggers (None without shards), results so far, and the future of the sharded results
+        '''
+        if not self.shards:
+            return msg, None, {}, None
+
+        with self._lock:
+            triggers = list(self._route(msg))
+            results, requests = self.shards.match(triggers, msg)
+
+        # Sharded conditions are all evaluated at once on the worker processes, without holding up deadlines meanwhile
+        return msg, triggers, results, self.shards.send(requests, msg)
+
+    def _finish(self, msg, triggers, results, pending):
+        '''
+        Second half of fire_event: wait for the sharded results, check the other conditions, handle durations and fire events
+        '''
+        if pending is not None:
+            results.update(pending.result())
+
+        # Events run after the lock is released, so a full (blocking) handler pool never holds up deadlines
+        fired = []
+        with self._lock:
+            if triggers is None:
+                triggers = self._route(msg)
+
+            for trigger in triggers:
+                c_met = results[trigger.index] if trigger.index in results else self._check(trigger, msg)
+
+                if trigger.duration:
+                    self._check_duration(trigger, c_met, msg)
+                elif c_met:
+                    # Conditions are met, so we fire event
+                    fired.append(trigger)
+
+        for trigger in fired:
+            self._run_event(trigger, msg)
+
+    def _check(self, trigger, msg):
+        '''
+        Return trigger.check(msg), awaiting coroutine conditions on the listening loop
+        Called in try-except to avoid conditions_met from breaking the loop (counts as not met)
+        '''
+        # Only timed when metrics are collected
+        start = perf_counter() if self.metrics is not None else None
+        try:
+            c_met = trigger.check(msg)
+
+            if asyncio.iscoroutine(c_met):
+                # Only the dispatch and scheduler threads check triggers, so the loop is never waiting on itself
+                c_met = self._run_on_loop(c_met).result()
+        except:
+            print(traceback.format_exc())
             c_met = False
-            ignore_c_met = False # ignore c_met if duration is not long enough, or if duration is too long (event already fired)
+            if self.metrics is not None:
+                self.metrics.count("trigger_errors", trigger=trigger.name, stage="condition")
+
+        if self.metrics is not None:
+            self.metrics.observe("trigger_condition_seconds", perf_counter() - start, trigger=trigger.name)
+
+        return c_met
+
+    def _run_on_loop(self, coro):
+        '''
+        Schedule coro on the listening loop (or the shared loop before listening), and return a concurrent.futures.Future of its result
+        '''
+        loop = self._loop or (self.loop.loop if self.loop else None)
+        if loop is None:
+            coro.close()
+            raise RuntimeError("Coroutine triggers need a running listener (see listen) or a shared loop")
 
-            # Call in try-except to avoid conditions_met from breaking the loop
+        return asyncio.run_coroutine_threadsafe(coro, loop)
+
+    def _check_duration(self, trigger, c_met, msg):
+        '''
+        Arm a deadline when conditions of a duration trigger become met, and cancel it when they stop being met
+        '''
+        if c_met:
+            if trigger.fired or trigger.deadline:
+                # Event has fired already due to duration and has not been false yet, or is already waiting on its deadline
+                return
+
+            when = self.clock() + int(trigger.duration * 1e9)
+            trigger.deadline = self.scheduler.arm(when, partial(self._expire, trigger, msg))
+
+        elif c_met is not None:
+            # conditions are not met and it is valid, so we reset
+            if trigger.deadline:
+                self.scheduler.cancel(trigger.deadline)
+            trigger.deadline = None
+            trigger.fired = False
+
+    def _expire(self, trigger, msg):
+        '''
+        Deadline callback: conditions of trigger have been met for its duration, so fire its event with msg (the event which met them)
+        Conditions are checked one last time, in case they depend on more than events
+        '''
+        with self._lock:
+            deadline = trigger.deadline
+            results, requests = self.shards.match([trigger], None) if self.shards else ({}, {})
+
+            if not requests:
+                trigger.deadline = None
+                c_met = results[trigger.index] if trigger.index in results else self._check(trigger, None)
+                fire = self._expired(trigger, c_met)
+            else:
+                fire = None
+
+        if fire is None:
+            # Sharded conditions are evaluated without holding the lock. The deadline stays armed meanwhile, so events do not arm another one
+            c_met = self.shards.evaluate(requests, None).get(trigger.index, False)
+
+            with self._lock:
+                if trigger.deadline is not deadline:
+                    # Conditions stopped being met during the check, which cancelled the deadline
+                    return
+
+                trigger.deadline = None
+                fire = self._expired(trigger, c_met)
+
+        # Like fire_event, the event runs outside the lock
+        if fire:
+            self._run_event(trigger, msg)
+
+    def _expired(self, trigger, c_met):
+        '''
+        Settle an expired duration trigger, and return whether to fire its event: not if its last check (c_met) was not met. Must hold self._lock
+        '''
+        if c_met is not None and not c_met:
+            trigger.fired = False
+            return False
+
+        # Should no longer be triggered until conditions stop being met
+        trigger.fired = True
+        return True
+
+    def _run_event(self, trigger, msg):
+        '''
+        Call a trigger's event on the handler pool (or right away, without a pool)
+        Coroutine events run on the listening loop instead
+        '''
+        if asyncio.iscoroutinefunction(trigger.event):
             try:
-                c_met = conditions_met(msg)
+                self._run_on_loop(self._run_async_event(trigger, msg))
             except:
                 print(traceback.format_exc())
+            return
 
-            if c_met and self.duration[i] and not self.last_false[i]:
-                # Event has fired already due to duration and has not yet been false yet
-                ignore_c_met = True
-
-            elif c_met and self.duration[i]:
-                # This has a duration and a last_false (so it can still be triggered)
-
-                # check if duration has passed
-                if time_ns() - self.last_false[i] > self.duration[i] * 1e9:
-                    # Enough time has passed. Set last_false to None since it should no longer be triggered
-                    self.last_false[i] = None
-                else:
-                    # Not enough time has passed
-                    ignore_c_met = True
-
-            if c_met and not ignore_c_met:
-                # Conditions are met and we do not ignore, so we fire event
-                try:
-                    event(msg)
-                except:
-                    print(traceback.format_exc())
-            elif c_met is not None and not ignore_c_met:
-                # conditions are not met, it is valid, and we should not ignore it, so we reset time
-                self.last_false[i] = time_ns()
-
-    def _json_diff(self, result_old, result_new, original_key, old, new):
-        '''
-        Construct a json diff of old and new, save in result_old and result_new
-        result_old: dictionary mapping leaf keys to old values (if changed)
-        result_new: dictionary mapping leaf keys to new values (if changed)
-        original_key: current key of the current json (None if root)
-        old: old json
-        new: new json
-
-        Results in a flattened event containing only changes, which helps clean up poor event structure
-        '''
-        if isinstance(old, dict) and isinstance(new, dict):
-            old_diff, new_diff = {}, {}
-            keys = set(old.keys()) | set(new.keys())
-            for key in keys:
-                self._json_diff(result_old, result_new, key, old.get(key), new.get(key))
-        else:
-            # old and new should be strings. If they differ, add to result_old and result_new
-            if old != new:
-                result_old[original_key] = old
-                result_new[original_key] = new
+        if self.pool:
+            self.pool.submit(trigger, msg)
+            return
+
+        start = perf_counter() if self.metrics is not None else None
+        try:
+            trigger.event(msg)
+        except:
+            print(traceback.format_exc())
+            if self.metrics is not None:
+                self.metrics.count("trigger_errors", trigger=trigger.name, stage="handler")
+
+        if self.metrics is not None:
+            self.metrics.observe("trigger_handler_seconds", perf_counter() - start, trigger=trigger.name)
+
+    async def _run_async_event(self, trigger, msg):
+        '''
+        Await a trigger's coroutine event. Serialized triggers wait for their previous call
+        '''
+        start = perf_counter() if self.metrics is not None else None
+        try:
+            if trigger.serialize:
+                if trigger.lock is None:
+                    trigger.lock = asyncio.Lock()
+
+                async with trigger.lock:
+                    await trigger.event(msg)
+            else:
+                await trigger.event(msg)
+        except:
+            print(traceback.format_exc())
+            if self.metrics is not None:
+                self.metrics.count("trigger_errors", trigger=trigger.name, stage="handler")
+
+        if self.metrics is not None:
+            self.metrics.observe("trigger_handler_seconds", perf_counter() - start, trigger=trigger.name)
+
+    def stats(self):
+        '''
+        Return a dictionary of dispatch metrics: events waiting to be checked, handler pool queue metrics, and shard metrics
+        '''
+        stats = {"pending_events": self._dispatch_queue.qsize(),
+                 "dropped_events": self._dispatch_queue.dropped,
+                 "coalesced_events": self._dispatch_queue.coalesced}
+        if self.pool:
+            stats.update(self.pool.stats())
+        if self.shards:
+            stats.update(self.shards.stats())
+
+        return stats
 
     async def _listen(self):
         '''
         Private helper function which subscribes a websocket and recieves event messages
         '''
-        async with await HassWebSocketLayer.authorize(self.ws_url, self.ws_headers) as ws:
-            await ws.subscribe()
-            
-            while True:
-                msg = await ws.recv()
+        try:
+            if self.connection:
+                await self._listen_on(self.connection)
+            else:
+                async with await HassWebSocketLayer.authorize(self.ws_url, self.ws_headers) as ws:
+                    await self._listen_on(ws)
+        finally:
+            if self.shards:
+                self.shards.close()
+
+    async def _listen_on(self, ws):
+        '''
+        Private helper function which subscribes on ws, and handles its events until the connection closes
+        '''
+        self._subscription_lock = asyncio.Lock()
+        self._loop = asyncio.get_running_loop()
+        self._ws = ws
+
+        if self.subscribe_entities:
+            await self._extend_entity_subscription()
+        else:
+            # Frames no trigger can care about are dropped before they are decoded
+            # Without a state mirror, states are only decoded once a trigger looks at them
+            lazy = self.state_store is None
+            for event_type in self.event_types or (None,):
+                self._subscriptions.append(await ws.subscribe(event_type, self._handle_message, self._wants_frame, lazy))
+
+        if self.state_store:
+            # Resync now that we are subscribed, so no change is missed between the sync and the first event
+            # The states are downloaded on the websocket we already have, so the loop never blocks on REST
+            self.state_store.sync(await ws.call("get_states"))
+            self.state_store.set_live(True)
+
+        # The connection renews our subscriptions when it reconnects, but events sent while it was down are lost
+        ws.connection_callbacks.append(self._on_connection)
+        self._task = asyncio.current_task()
+
+        try:
+            await ws.wait_closed()
+        finally:
+            ws.connection_callbacks.remove(self._on_connection)
+            self._task = None
+            self._ws = None
+            self._subscriptions = []
+            if self.state_store:
+                self.state_store.set_live(False)
+
+    def _on_connection(self, connected):
+        '''
+        Connection callback: the mirror cannot be trusted while the connection is down, and is resynced once it is back
+        '''
+        if not self.state_store:
+            return
+
+        if connected:
+            self._loop.create_task(self._resync())
+        else:
+            self.state_store.set_live(False)
+
+    async def _resync(self):
+        try:
+            self.state_store.sync(await self._ws.call("get_states"))
+            self.state_store.set_live(True)
+        except Exception:
+            print(traceback.format_exc())
+
+    def _wants_frame(self, raw):
+        '''
+        Prefilter of our subscribe_events subscriptions: return whether a raw event frame can matter to the state store, a trigger, or the recorder
+        Frames which cannot be scanned cheaply are always kept
+        '''
+        if self.recorder is not None:
+            return True
+
+        event_type = scan_string(raw, "event_type")
+        if event_type is not None and event_type != "state_changed":
+            # Only state_changed events fire triggers
+            return False
+
+        if self.state_store or self._catch_all or (self.history and self.history.entity_ids is None):
+            return True
+
+        # The first entity_id of a state_changed frame is the one in its data
+        entity_id = scan_string(raw, "entity_id")
+        if entity_id is None:
+            return True
+
+        return (entity_id in self._by_entity or entity_id.split(".")[0] in self._by_domain
+                or (self.history is not None and entity_id in self.history.entity_ids))
+
+    def _wanted_entities(self):
+        '''
+        Return the set of entity_ids triggers can care about, or None if that requires every entity
+        '''
+        if self.state_store or self._catch_all or self._by_domain or (self.history and self.history.entity_ids is None):
+            return None
+
+        wanted = set(self._by_entity)
+        if self.history:
+            wanted |= self.history.entity_ids
+
+        return wanted
+
+    async def _extend_entity_subscription(self):
+        '''
+        Make sure the subscribe_entities subscription covers every entity that triggers can care about
+        '''
+        async with self._subscription_lock:
+            wanted = self._wanted_entities()
+            if self._subscribed_entities is None:
+                # Already subscribed to everything
+                return
+
+            if wanted is None:
+                # Replace the partial subscriptions with one for every entity
+                for subscription in self._subscriptions:
+                    await self._ws.unsubscribe(subscription)
+                self._subscriptions = []
+                missing = None
+
+            else:
+                missing = wanted - self._subscribed_entities
+                if not missing:
+                    return
+
+            self._subscriptions.append(await self._ws.subscribe_entities(missing, self._handle_message))
+
+            if missing is None:
+                self._subscribed_entities = None
+            else:
+                self._subscribed_entities |= missing
+
+    def _handle_message(self, msg):
+        '''
+        Subscription callback: handle an event message of one of our subscriptions
+        '''
+        if self.recorder is not None:
+            self.recorder.write(self.clock(), msg)
+
+        event = msg.get("event")
+
+        if "event_type" not in event:
+            # Compressed subscribe_entities event
+            changes = self._compressed_states.apply(event)
+
+            # The first event of a subscription is a snapshot of current states, which does not fire triggers
+            snapshot = msg.get("id") not in self._snapshots_seen
+            self._snapshots_seen.add(msg.get("id"))
+
+            for data in changes:
+                self._handle_state_changed(data, fire=not snapshot)
+
+        elif event.get("event_type") == "state_changed":
+            self._handle_state_changed(event.get("data"))
+
+    def _handle_state_changed(self, data, fire=True):
+        '''
+        Apply the data of a state_changed event to the state store, and fire events on it
+        '''
+        if self.state_store:
+            self.state_store.update(data)
+
+        history = self.history is not None and self.history.tracks(data.get("entity_id"))
+        if not fire and not history:
+            return
+
+        event = StateChangedEvent(data, self.diff_skip_keys, self.lazy_diff)
+        if history and event.raw_new_state is not None:
+            self.history.push(event.entity_id, self.clock(), event.raw_new_state)
+
+        if fire:
+            # Triggers run on the dispatch thread, so handlers never block the (shared) connection
+            self._dispatch_queue.put(event)
 
-                if msg.get("type") == "event" and msg.get("event").get("event_type") == "state_changed":
-                    msg = msg.get("event").get("data")
+    def _dispatch(self):
+        '''
+        Fire events for every recieved state_changed event, in order
+        With shards, events are pipelined: the next events are sent to the workers while the results of earlier ones are pending,
+        and up to shards.max_in_flight events wait for their results on a second thread, which finishes them in order
+        '''
+        if not self.shards:
+            while True:
+                self.fire_event(self._dispatch_queue.get())
 
-                    old_state = {}
-                    new_state = {}
-                    self._json_diff(old_state, new_state, None, msg.get("old_state"), msg.get("new_state"))
+        pending = Queue(self.shards.max_in_flight)
+        Thread(target=self._finish_pending, args=(pending,), daemon=True).start()
 
-                    msg = {'entity_id': msg.get("entity_id"),
-                           'old_state': old_state,
-                           'new_state': new_state}
+        while True:
+            pending.put(self._begin(self._dispatch_queue.get()))
 
-                    self.fire_event(msg)
+    def _finish_pending(self, pending):
+        while True:
+            self._finish(*pending.get())
 
     def _periodically_check(self, interval):
         '''
-        Every interval seconds, fire all events with None as parameter
+        Every interval seconds, fire all catch-all events with None as parameter (for conditions which do not depend on events)
         '''
         while True:
             self.fire_event(None)
 
             sleep(interval)
 
+    async def _periodically_check_async(self, interval):
+        '''
+        Like _periodically_check, but as a task on the listening loop. The check itself runs on the dispatch thread
+        '''
+        while True:
+            self._dispatch_queue.put(None)
+
+            await asyncio.sleep(interval)
+
+    def _start_workers(self):
+        '''
+        Start the scheduler, handler pool and dispatch threads, which run triggers
+        '''
+        if self.shards:
+            self.shards.start()
+        self.scheduler.start()
+        if self.pool:
+            self.pool.start()
+        Thread(target=self._dispatch, daemon=True).start()
+
+    async def listen(self, interval=5):
+        '''
+        Async counterpart of start: listen on the running loop until the connection closes
+        Use this with AsyncHome, whose connection lives on the caller's loop (ex. asyncio.create_task(listener.listen()))
+        '''
+        self._start_workers()
+
+        checks = asyncio.get_running_loop().create_task(self._periodically_check_async(interval)) if interval else None
+        try:
+            await self._listen()
+        finally:
+            if checks:
+                checks.cancel()
+
     def start(self, interval=5):
         '''
         Call functions marked by trigger_when when conditions_met passes on events from hass, and every `interval` seconds
+        Only triggers without a scope are checked every `interval` seconds. Pass interval=None to only check triggers on events
         '''
-        Thread(target=asyncio.run, args=(self._listen(),)).start()
-        Thread(target=self._periodically_check, args=(interval,)).start()
\ No newline at end of file
+        self._start_workers()
+
+        if self.loop:
+            # Listen on the shared loop. The thread waits on it, so the process keeps running while listening (like the loop-less case)
+            Thread(target=self.loop.run, args=(self._listen(),)).start()
+        else:
+            Thread(target=asyncio.run, args=(self._listen(),)).start()
+
+        if interval:
+            Thread(target=self._periodically_check, args=(interval,)).start()
\ No newline at end of file
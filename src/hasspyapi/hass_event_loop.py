@@ -0,0 +1,42 @@
+from threading import Thread, current_thread
+import asyncio
+
+class HassEventLoop:
+    def __init__(self):
+        '''
+        An asyncio loop running in a background (daemon) thread
+        Owns a home's shared websocket connection, so synchronous code can run coroutines on it from any thread
+        '''
+        self.loop = asyncio.new_event_loop()
+        self.thread = Thread(target=self.loop.run_forever, name="hasspyapi-loop", daemon=True)
+        self.thread.start()
+
+    def submit(self, coro):
+        '''
+        Schedule coro on the loop, and return a concurrent.futures.Future of its result
+        '''
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro, timeout=None):
+        '''
+        Run coro on the loop and block until its result is ready
+        Must not be called from the loop's own thread
+        '''
+        if current_thread() is self.thread:
+            coro.close()
+            raise RuntimeError("Cannot block on the hasspyapi loop from its own thread")
+
+        return self.submit(coro).result(timeout)
+
+    def call_soon(self, callback, *args):
+        '''
+        Call callback(*args) on the loop, from any thread
+        '''
+        self.loop.call_soon_threadsafe(callback, *args)
+
+    def stop(self):
+        '''
+        Stop the loop and wait for its thread to exit
+        '''
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
@@ -0,0 +1,226 @@
+from threading import Condition, Thread
+from collections import deque
+from time import perf_counter
+import traceback
+
+# What submit does when the queue is full
+OVERFLOW_POLICIES = ("block", "drop_oldest", "coalesce")
+
+class HandlerPool:
+    def __init__(self, workers=1, max_queue=1000, overflow="block", metrics=None):
+        '''
+        Runs trigger events on a pool of worker threads, fed by a bounded queue
+
+        workers: number of worker threads. With one worker, events run one at a time in the order they were triggered
+        max_queue: maximum number of queued (not yet running) events
+        overflow: what happens when the queue is full
+            block: wait until a worker frees up space
+            drop_oldest: drop the oldest queued event
+            coalesce: replace the queued event of the same trigger with the new one (or drop the oldest, if there is none)
+        metrics: HassMetrics to record event run times in (None to not record them)
+        '''
+        if overflow not in OVERFLOW_POLICIES:
+            raise RuntimeError(f"Unknown overflow policy {overflow}, expected one of {OVERFLOW_POLICIES}")
+
+        self.workers = workers
+        self.max_queue = max_queue
+        self.overflow = overflow
+        self.metrics = metrics
+
+        # Queued jobs [trigger, msg], oldest first
+        self._queue = deque()
+        self._condition = Condition()
+
+        # Serialized triggers which currently have a job running
+        self._running = set()
+        self._threads = []
+
+        # Metrics (see stats)
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.max_depth = 0
+
+    def start(self):
+        '''
+        Start the worker threads (once)
+        '''
+        with self._condition:
+            while len(self._threads) < self.workers:
+                thread = Thread(target=self._work, name=f"hasspyapi-handler-{len(self._threads)}", daemon=True)
+                self._threads.append(thread)
+                thread.start()
+
+    def submit(self, trigger, msg):
+        '''
+        Queue trigger.event(msg) to run on a worker, applying the overflow policy if the queue is full
+        '''
+        if not self._threads:
+            self.start()
+
+        with self._condition:
+            self.submitted += 1
+
+            if len(self._queue) >= self.max_queue:
+                if self.overflow == "block":
+                    while len(self._queue) >= self.max_queue:
+                        self._condition.wait()
+
+                elif self.overflow == "coalesce" and self._replace(trigger, msg):
+                    return
+
+                else:
+                    self._queue.popleft()
+                    self.dropped += 1
+
+            self._queue.append([trigger, msg])
+            self.max_depth = max(self.max_depth, len(self._queue))
+            self._condition.notify_all()
+
+    def _replace(self, trigger, msg):
+        '''
+        Replace the msg of the newest queued job of trigger, and return whether there was one. Must hold self._condition
+        '''
+        for job in reversed(self._queue):
+            if job[0] is trigger:
+                job[1] = msg
+                self.coalesced += 1
+                return True
+
+        return False
+
+    def _take(self):
+        '''
+        Remove and return the oldest job which can run now, or None. Must hold self._condition
+        Jobs of a serialized trigger wait while another job of the same trigger is running
+        '''
+        for i, job in enumerate(self._queue):
+            trigger = job[0]
+            if trigger.serialize and trigger in self._running:
+                continue
+
+            del self._queue[i]
+            if trigger.serialize:
+                self._running.add(trigger)
+            return job
+
+        return None
+
+    def _work(self):
+        '''
+        Worker thread: run queued jobs forever
+        '''
+        while True:
+            with self._condition:
+                job = self._take()
+                while job is None:
+                    self._condition.wait()
+                    job = self._take()
+
+                # Space was freed for blocked submitters
+                self._condition.notify_all()
+
+            trigger, msg = job
+            start = perf_counter() if self.metrics is not None else None
+            try:
+                trigger.event(msg)
+                failed = False
+            except:
+                print(traceback.format_exc())
+                failed = True
+
+            if self.metrics is not None:
+                self.metrics.observe("trigger_handler_seconds", perf_counter() - start, trigger=trigger.name)
+                if failed:
+                    self.metrics.count("trigger_errors", trigger=trigger.name, stage="handler")
+
+            with self._condition:
+                self.completed += 1
+                self.failed += failed
+                if trigger.serialize:
+                    self._running.discard(trigger)
+                    # The trigger's next job can run now
+                    self._condition.notify_all()
+
+    def stats(self):
+        '''
+        Return a dictionary of queue metrics
+        '''
+        with self._condition:
+            return {"depth": len(self._queue),
+                    "max_depth": self.max_depth,
+                    "submitted": self.submitted,
+                    "completed": self.completed,
+                    "failed": self.failed,
+                    "dropped": self.dropped,
+                    "coalesced": self.coalesced,
+                    "workers": len(self._threads)}
+
+class DispatchQueue:
+    def __init__(self, max_queue=1000, overflow="block"):
+        '''
+        Bounded queue of recieved events waiting for a listener's dispatch thread, with the interface of queue.SimpleQueue
+
+        Events are put from the listening loop, which also serves calls and coroutine conditions, so putting never blocks:
+        when the queue is full, the overflow policy is applied before any condition runs on the event
+            drop_oldest and block: drop the oldest queued event (a blocking HandlerPool still never drops events which passed their conditions)
+            coalesce: replace the queued event of the same entity with the new one (or drop the oldest, if there is none)
+        '''
+        if overflow not in OVERFLOW_POLICIES:
+            raise RuntimeError(f"Unknown overflow policy {overflow}, expected one of {OVERFLOW_POLICIES}")
+
+        self.max_queue = max_queue
+        self.overflow = overflow
+
+        self._queue = deque()
+        self._condition = Condition()
+
+        # Metrics (see HassEventListener.stats)
+        self.dropped = 0
+        self.coalesced = 0
+
+    def put(self, msg):
+        '''
+        Queue msg (a StateChangedEvent, or None for a periodic check), applying the overflow policy if the queue is full
+        '''
+        with self._condition:
+            if len(self._queue) >= self.max_queue:
+                if self.overflow == "coalesce" and msg is not None and self._replace(msg):
+                    return
+
+                self._queue.popleft()
+                self.dropped += 1
+
+            self._queue.append(msg)
+            self._condition.notify()
+
+    def _replace(self, msg):
+        '''
+        Replace the newest queued event of msg's entity with msg, and return whether there was one. Must hold self._condition
+        '''
+        for i in range(len(self._queue) - 1, -1, -1):
+            queued = self._queue[i]
+            if queued is not None and queued.entity_id == msg.entity_id:
+                self._queue[i] = msg
+                self.coalesced += 1
+                return True
+
+        return False
+
+    def get(self):
+        '''
+        Remove and return the oldest event, waiting for one if there is none
+        '''
+        with self._condition:
+            while not self._queue:
+                self._condition.wait()
+
+            return self._queue.popleft()
+
+    def empty(self):
+        return not self._queue
+
+    def qsize(self):
+        return len(self._queue)
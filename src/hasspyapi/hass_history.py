@@ -0,0 +1,106 @@
+from datetime import datetime, timedelta, timezone
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Default length of one history/logbook request when paging through a time range
+DEFAULT_CHUNK = timedelta(days=1)
+
+def to_utc(when):
+    '''
+    Return when (a datetime, naive meaning local time) as an aware UTC datetime
+    '''
+    if when.tzinfo is None:
+        when = when.astimezone()
+
+    return when.astimezone(timezone.utc)
+
+def windows(start, end=None, chunk=DEFAULT_CHUNK):
+    '''
+    Split start..end (datetimes, end defaults to now) into consecutive (window_start, window_end) pairs of at most chunk
+    '''
+    start = to_utc(start)
+    end = to_utc(end) if end is not None else datetime.now(timezone.utc)
+
+    if chunk <= timedelta(0):
+        raise RuntimeError(f"History chunk must be positive, not {chunk}")
+
+    while start < end:
+        window_end = min(start + chunk, end)
+        yield start, window_end
+        start = window_end
+
+def timestamp(value):
+    '''
+    Return an ISO timestamp from hass (ex. 2024-01-01T00:00:01.000001+00:00) as seconds since the epoch
+    '''
+    return datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+
+def from_timestamp(value):
+    '''
+    Return seconds since the epoch (as the websocket sends them) as an ISO timestamp, like the REST API sends
+    '''
+    return datetime.fromtimestamp(value, timezone.utc).isoformat()
+
+def expand_state(entity_id, state):
+    '''
+    Return a compressed history state from the websocket ({s, a, lc, lu}, lc left out when it equals lu) in the shape the REST API sends
+    '''
+    last_updated = state.get("lu")
+    last_changed = state.get("lc", last_updated)
+
+    expanded = {"entity_id": entity_id, "state": state.get("s")}
+    if "a" in state:
+        expanded["attributes"] = state["a"]
+    if last_changed is not None:
+        expanded["last_changed"] = from_timestamp(last_changed)
+    if last_updated is not None:
+        expanded["last_updated"] = from_timestamp(last_updated)
+
+    return expanded
+
+def to_number(state):
+    '''
+    Return the numeric value of a state string, or None if it is not a number (ex. unavailable)
+    '''
+    try:
+        return float(state)
+    except (TypeError, ValueError):
+        return None
+
+class HistoryColumns:
+    def __init__(self):
+        '''
+        Columnar history of numeric sensors: entity_id -> (timestamps, values), both array("d")
+        Each point costs 16 bytes, however many entities and months are collected
+        Non numeric states (ex. unavailable, unknown) are skipped
+        '''
+        self.columns = {}
+
+    def add(self, state):
+        '''
+        Add one history state (with entity_id, state and last_changed)
+        '''
+        value = to_number(state.get("state"))
+        if value is None:
+            return
+
+        column = self.columns.get(state["entity_id"])
+        if column is None:
+            column = self.columns[state["entity_id"]] = (array("d"), array("d"))
+
+        column[0].append(timestamp(state["last_changed"]))
+        column[1].append(value)
+
+    def to_numpy(self):
+        '''
+        Return entity_id -> (timestamps, values) as numpy arrays, sharing memory with the columns
+        '''
+        if numpy is None:
+            raise RuntimeError("NumPy columns need numpy installed")
+
+        return {entity_id: (numpy.frombuffer(timestamps, dtype=numpy.float64), numpy.frombuffer(values, dtype=numpy.float64))
+                for entity_id, (timestamps, values) in self.columns.items()}
@@ -0,0 +1,134 @@
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+# Codecs in order of preference for "auto"
+CODECS = ("orjson", "msgspec", "json")
+
+if msgspec is not None:
+    # Shape of a state_changed event frame, where the (large) states are kept undecoded
+    class _StateChangedData(msgspec.Struct):
+        entity_id: str = None
+        old_state: msgspec.Raw = msgspec.Raw(b"null")
+        new_state: msgspec.Raw = msgspec.Raw(b"null")
+
+    class _StateChangedEvent(msgspec.Struct):
+        event_type: str = None
+        data: _StateChangedData = None
+
+    class _EventFrame(msgspec.Struct):
+        id: int = None
+        type: str = None
+        event: _StateChangedEvent = None
+
+def scan_id(raw):
+    '''
+    Return the message id of a raw websocket frame without decoding it, or None if it cannot be found cheaply
+    hass sends the id first, ex. {"id":5,"type":"event",...}
+    '''
+    if not raw.startswith('{"id":'):
+        return None
+
+    end = raw.find(",", 6)
+    try:
+        # int() ignores the space of non compact json
+        return int(raw[6:end])
+    except ValueError:
+        return None
+
+def scan_string(raw, key):
+    '''
+    Return the first string value of key in a raw json frame without decoding it, or None if it cannot be found cheaply
+    '''
+    # Compact json (as hass sends it), or json with the default ": " separator
+    for separator in (':"', ': "'):
+        start = raw.find(f'"{key}"{separator}')
+        if start != -1:
+            break
+    else:
+        return None
+
+    start += len(key) + 2 + len(separator)
+    end = raw.find('"', start)
+    if end == -1 or "\\" in raw[start:end]:
+        return None
+
+    return raw[start:end]
+
+class LazyJson:
+    __slots__ = ("raw", "codec")
+
+    def __init__(self, raw, codec):
+        '''
+        An undecoded json value, decoded by the codec on demand (see StateChangedEvent)
+        '''
+        self.raw = raw
+        self.codec = codec
+
+    def decode(self):
+        return self.codec.loads(self.raw)
+
+class JsonCodec:
+    def __init__(self, name="auto"):
+        '''
+        Encodes and decodes json for the websocket and REST transports
+
+        name: "orjson", "msgspec", "json" (the standard library), or "auto" for the fastest one installed
+        With msgspec, state_changed frames can be decoded lazily: the old and new states stay undecoded until they are used (see loads_event)
+        '''
+        if name == "auto":
+            name = next(codec for codec in CODECS if codec == "json" or globals()[codec] is not None)
+
+        if name == "orjson" and orjson is not None:
+            self.loads = orjson.loads
+            self.dumps = lambda obj: orjson.dumps(obj).decode()
+
+        elif name == "msgspec" and msgspec is not None:
+            encoder = msgspec.json.Encoder()
+            self.loads = msgspec.json.decode
+            self.dumps = lambda obj: encoder.encode(obj).decode()
+            self._event_decoder = msgspec.json.Decoder(_EventFrame)
+
+        elif name == "json":
+            self.loads = json.loads
+            self.dumps = json.dumps
+
+        else:
+            raise RuntimeError(f"Unknown or missing json codec {name}, expected one of {CODECS}")
+
+        self.name = name
+
+        # Whether loads_event keeps states undecoded
+        self.lazy = name == "msgspec"
+
+    def loads_event(self, raw):
+        '''
+        Decode a state_changed event frame, keeping its old and new states as LazyJson if the codec supports it
+        Frames of any other shape are decoded fully
+        '''
+        if not self.lazy:
+            return self.loads(raw)
+
+        try:
+            frame = self._event_decoder.decode(raw)
+        except msgspec.ValidationError:
+            return self.loads(raw)
+
+        if frame.event is None or frame.event.event_type != "state_changed" or frame.event.data is None:
+            return self.loads(raw)
+
+        data = frame.event.data
+        return {"id": frame.id,
+                "type": frame.type,
+                "event": {"event_type": "state_changed",
+                          "data": {"entity_id": data.entity_id,
+                                   "old_state": LazyJson(data.old_state, self),
+                                   "new_state": LazyJson(data.new_state, self)}}}
@@ -0,0 +1,185 @@
+from time import monotonic, perf_counter
+from threading import Lock
+from bisect import bisect_left
+import asyncio
+import json
+
+# Upper bounds (seconds) of histogram buckets. Observations above the last bound only count towards +Inf
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Prefix of every exported metric name
+PREFIX = "hasspyapi_"
+
+class Histogram:
+    def __init__(self):
+        '''
+        Count and sum of timings (seconds), bucketed by BUCKETS
+        '''
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.buckets[bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def snapshot(self):
+        return {"count": self.count,
+                "sum": self.sum,
+                "mean": self.sum / self.count if self.count else 0.0,
+                "max": self.max,
+                "buckets": dict(zip([str(bound) for bound in BUCKETS] + ["+Inf"], self.buckets))}
+
+class HassMetrics:
+    def __init__(self, rate_window=10):
+        '''
+        Timings and counters recorded by a Home and everything built from it (see Home(metrics=True))
+        Every metric is keyed by name and a tuple of (label, value) pairs
+
+        Recorded metrics:
+            trigger_condition_seconds, trigger_handler_seconds (histograms, per trigger), trigger_errors (counter, per trigger)
+            rest_request_seconds (histogram, per endpoint), rest_errors (counter, per endpoint)
+            websocket_messages (counter), websocket_messages_rate (messages per second), websocket_decode_seconds (histogram)
+            loop_lag_seconds (histogram): how late the background loop runs a callback, see watch_loop_lag
+
+        When metrics are disabled, no HassMetrics exists at all, so instrumented code only pays for an `is None` check
+        rate_window: seconds over which receive rates are averaged
+        '''
+        self.rate_window = rate_window
+
+        self.histograms = {}
+        self.counters = {}
+        self._lock = Lock()
+
+        # name -> [window start, messages in window, rate of the last full window]
+        self._rates = {}
+
+    def observe(self, name, seconds, **labels):
+        '''
+        Record a timing (seconds) in histogram name
+        '''
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    def count(self, name, amount=1, **labels):
+        '''
+        Add amount to counter name
+        '''
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def mark(self, name):
+        '''
+        Count one occurrence of name, and keep its rate per second (averaged over rate_window)
+        '''
+        now = monotonic()
+        with self._lock:
+            self.counters[(name, ())] = self.counters.get((name, ()), 0) + 1
+
+            window = self._rates.get(name)
+            if window is None:
+                window = self._rates[name] = [now, 0, 0.0]
+
+            if now - window[0] >= self.rate_window:
+                window[2] = window[1] / (now - window[0])
+                window[0] = now
+                window[1] = 0
+            window[1] += 1
+
+    def rate(self, name):
+        '''
+        Return the rate per second of name over the last full window (or the current one, before a window is full)
+        '''
+        with self._lock:
+            window = self._rates.get(name)
+            if window is None:
+                return 0.0
+
+            if window[2]:
+                return window[2]
+
+            elapsed = monotonic() - window[0]
+            return window[1] / elapsed if elapsed else 0.0
+
+    async def watch_loop_lag(self, interval=0.5):
+        '''
+        Run on an event loop forever, recording how late it wakes up from each sleep (loop_lag_seconds)
+        A blocked loop (ex. a slow subscription callback) shows up as lag
+        '''
+        while True:
+            start = perf_counter()
+            await asyncio.sleep(interval)
+            self.observe("loop_lag_seconds", max(0.0, perf_counter() - start - interval))
+
+    def snapshot(self):
+        '''
+        Return every metric as {name: [{labels, value}]}, where value is a number (counters) or a histogram dictionary
+        '''
+        result = {}
+        with self._lock:
+            for (name, labels), value in self.counters.items():
+                result.setdefault(name, []).append({"labels": dict(labels), "value": value})
+
+            for (name, labels), histogram in self.histograms.items():
+                result.setdefault(name, []).append({"labels": dict(labels), "value": histogram.snapshot()})
+
+        for name in list(self._rates):
+            result[f"{name}_rate"] = [{"labels": {}, "value": self.rate(name)}]
+
+        return result
+
+    def to_json(self):
+        '''
+        Dump every metric as json (see snapshot)
+        '''
+        return json.dumps(self.snapshot())
+
+    def to_prometheus(self):
+        '''
+        Dump every metric in the Prometheus text format
+        '''
+        def escape(value):
+            return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+        def format_labels(labels, extra=()):
+            pairs = [f'{key}="{escape(value)}"' for key, value in list(labels) + list(extra)]
+            return "{" + ",".join(pairs) + "}" if pairs else ""
+
+        lines = []
+        with self._lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, histogram.snapshot()) for key, histogram in self.histograms.items())
+
+        typed = set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                lines.append(f"# TYPE {PREFIX}{name}_total counter")
+                typed.add(name)
+            lines.append(f"{PREFIX}{name}_total{format_labels(labels)} {value}")
+
+        for (name, labels), histogram in histograms:
+            if name not in typed:
+                lines.append(f"# TYPE {PREFIX}{name} histogram")
+                typed.add(name)
+
+            cumulative = 0
+            for bound, amount in histogram["buckets"].items():
+                cumulative += amount
+                lines.append(f"{PREFIX}{name}_bucket{format_labels(labels, (('le', bound),))} {cumulative}")
+            lines.append(f"{PREFIX}{name}_sum{format_labels(labels)} {histogram['sum']}")
+            lines.append(f"{PREFIX}{name}_count{format_labels(labels)} {histogram['count']}")
+
+        for name in sorted(self._rates):
+            lines.append(f"# TYPE {PREFIX}{name}_rate gauge")
+            lines.append(f"{PREFIX}{name}_rate {self.rate(name)}")
+
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,136 @@
+import asyncio
+
+# turn_on data which changes how a call is applied, not the state it leads to
+MODIFIER_KEYS = frozenset(("transition", "flash"))
+
+def _normalize(value):
+    '''
+    Make requested values comparable to state attributes from json (tuples become lists)
+    '''
+    if isinstance(value, tuple):
+        return [_normalize(item) for item in value]
+
+    return value
+
+def is_redundant(state, service, attributes):
+    '''
+    Return whether calling service (ex. "turn_on") with attributes would not change state (a full state json, or None if unknown)
+    Only turn_on and turn_off can be redundant. Attributes which hass does not report back (ex. brightness_pct) are never redundant
+    '''
+    if state is None:
+        return False
+
+    if service == "turn_off":
+        return state.get("state") == "off"
+
+    if service == "turn_on":
+        if state.get("state") != "on":
+            return False
+
+        current = state.get("attributes") or {}
+        for key, value in attributes.items():
+            if key in MODIFIER_KEYS:
+                continue
+            if key not in current or current[key] != _normalize(value):
+                return False
+
+        return True
+
+    return False
+
+class HassPlan:
+    def __init__(self, home):
+        '''
+        A set of target states for many devices (ex. a "good night" scene), applied with as few calls as possible
+
+        Add targets with turn_on/turn_off (a later target for the same device replaces an earlier one), then apply the plan:
+        targets are sent as one call per device type, service and attributes, through the home's command queue if it has one
+        Devices already in their target state are skipped like any HassCommand call would skip them (see HassCommand._drop_redundant)
+        '''
+        self.home = home
+
+        # entity_id -> (device, service, attributes), in the order devices were first added
+        self.targets = {}
+
+    def turn_on(self, command, **attributes):
+        '''
+        Turn on the devices of command (a HassCommand) with attributes
+        '''
+        return self._add(command, "turn_on", attributes)
+
+    def turn_off(self, command):
+        '''
+        Turn off the devices of command (a HassCommand)
+        '''
+        return self._add(command, "turn_off", {})
+
+    def _add(self, command, service, attributes):
+        for device in command.devices:
+            self.targets[device["entity_id"]] = (device, service, attributes)
+
+        # Chainable, ex. plan.turn_off(lights).turn_on(lamp, brightness=20)
+        return self
+
+    def _groups(self, states=None):
+        '''
+        Return (service, attributes, devices) for every service and attributes among the targets, without the devices they would not change
+
+        states: entity_id -> full state json to diff against (defaults to the home's state mirror, see HassCommand._drop_redundant)
+        '''
+        command = self.home.please()
+
+        groups = {}
+        for entity_id, (device, service, attributes) in self.targets.items():
+            key = (service, tuple(sorted((name, repr(value)) for name, value in attributes.items())))
+            if key not in groups:
+                groups[key] = (service, attributes, [])
+            groups[key][2].append(device)
+
+        result = []
+        for service, attributes, devices in groups.values():
+            known = None if states is None else [states.get(device["entity_id"]) for device in devices]
+            devices, skipped = command._drop_redundant(service, devices, attributes, known)
+            if devices:
+                result.append((service, attributes, devices))
+
+        return result
+
+    def calls(self, states=None):
+        '''
+        Return the list of calls (device_type, service, entity_ids, attributes) which apply would send
+
+        states: entity_id -> full state json to diff against (see _groups)
+        '''
+        command = self.home.please()
+
+        return [(device_type, service, entity_ids, attributes) for service, attributes, devices in self._groups(states)
+                for device_type, entity_ids in command._group_by_type(devices).items()]
+
+    def apply(self, states=None, wait=None):
+        '''
+        Send the calls of the plan (see calls), and return a dictionary of entity_id -> response for every device that was called
+
+        wait: how long to wait on calls if the home queues commands (see HassCommand._call)
+        '''
+        command = self.home.please()
+
+        result = {}
+        for service, attributes, devices in self._groups(states):
+            result.update(command._call(service, devices, wait, **attributes))
+
+        return result
+
+    async def apply_async(self, states=None):
+        '''
+        Like apply, for AsyncHome: every call of the plan is in flight at once
+        '''
+        command = self.home.please()
+
+        responses = await asyncio.gather(*(command._call_batched(getattr(self.home.service_layer, service), devices, **attributes)
+                                           for service, attributes, devices in self._groups(states)))
+
+        result = {}
+        for response in responses:
+            result.update(response)
+
+        return result
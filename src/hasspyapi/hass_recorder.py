@@ -0,0 +1,153 @@
+from time import perf_counter, sleep
+import struct
+import mmap
+import json
+
+from .hass_json import LazyJson
+
+# Every capture starts with this header, followed by records of (time ns, length, json message)
+MAGIC = b"HASSREC1"
+RECORD_HEADER = struct.Struct("<QI")
+
+class EventRecorder:
+    def __init__(self, path):
+        '''
+        Appends event messages to a capture file at path, for replaying them later (see EventReplay)
+        Records are length prefixed, so a capture can be appended to across runs and read without parsing every message
+        '''
+        self.path = path
+        self.file = open(path, "ab")
+
+        if self.file.tell() == 0:
+            self.file.write(MAGIC)
+
+        self.records = 0
+
+    def write(self, when, msg):
+        '''
+        Append msg (a websocket event message) recieved at time when (ns)
+        '''
+        data = json.dumps(msg, separators=(",", ":"), default=self._default).encode()
+        self.file.write(RECORD_HEADER.pack(when, len(data)) + data)
+        self.records += 1
+
+    @staticmethod
+    def _default(value):
+        # States of lazily decoded events (see JsonCodec.loads_event)
+        if isinstance(value, LazyJson):
+            return value.decode()
+
+        raise TypeError(f"{type(value).__name__} is not json serializable")
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+class EventReplay:
+    def __init__(self, path):
+        '''
+        Reads a capture written by EventRecorder, and feeds it to a HassEventListener
+        The capture is memory mapped and read one record at a time, so captures larger than memory can be replayed
+        '''
+        self.path = path
+
+        # Virtual time of the replay (ns), see clock
+        self.now = None
+
+    def __iter__(self):
+        '''
+        Yield (time ns, msg) of every record, in order
+        '''
+        with open(self.path, "rb") as file:
+            if not file.read(len(MAGIC)) == MAGIC:
+                raise RuntimeError(f"{self.path} is not an event capture")
+
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                position = len(MAGIC)
+                while position + RECORD_HEADER.size <= len(data):
+                    when, length = RECORD_HEADER.unpack_from(data, position)
+                    position += RECORD_HEADER.size
+
+                    if position + length > len(data):
+                        # Partially written last record (the recorder was stopped while writing)
+                        return
+
+                    yield when, json.loads(data[position:position + length])
+                    position += length
+
+    def clock(self):
+        '''
+        Virtual clock of the replay (ns): the time of the event being replayed
+        '''
+        return self.now
+
+    def run(self, listener, speed=None, until=None):
+        '''
+        Replay every event to listener, and return {events, seconds, events_per_second}
+
+        speed: None to replay as fast as possible, 1 for real time, or a factor (ex. 10 for 10x faster than real time)
+        until: time (ns, like the capture) to end the replay at, running the deadlines armed before it
+            None to run every deadline still armed after the last event, so durations met at the end of the capture fire
+        Time is virtual: the listener's clock follows the capture, so duration triggers fire at the right point of the capture whatever the speed
+
+        The listener must not be listening (see start/listen). Conditions are checked on the calling thread, one event at a time
+        '''
+        listener.clock = self.clock
+        listener.scheduler.clock = self.clock
+        if listener.history is not None:
+            listener.history.clock = self.clock
+
+        start = perf_counter()
+        first = None
+        events = 0
+
+        for when, msg in self:
+            if first is None:
+                first = when
+                self.now = when
+
+            self._advance(listener, when, start, first, speed)
+
+            listener._handle_message(msg)
+            while not listener._dispatch_queue.empty():
+                listener.fire_event(listener._dispatch_queue.get())
+            events += 1
+
+        if first is not None:
+            if until is None:
+                deadline = listener.scheduler.next_deadline()
+                while deadline is not None:
+                    self._advance(listener, deadline, start, first, speed)
+                    deadline = listener.scheduler.next_deadline()
+
+            elif until > self.now:
+                self._advance(listener, until, start, first, speed)
+
+        seconds = perf_counter() - start
+        return {"events": events,
+                "seconds": seconds,
+                "events_per_second": events / seconds if seconds else 0.0}
+
+    def _advance(self, listener, when, start, first, speed):
+        '''
+        Move virtual time to when, running any deadlines on the way, and waiting for real time to catch up if replaying at a speed
+        '''
+        scheduler = listener.scheduler
+
+        while True:
+            deadline = scheduler.next_deadline()
+            target = deadline if deadline is not None and deadline <= when else when
+
+            if speed:
+                delay = start + (target - first) / 1e9 / speed - perf_counter()
+                if delay > 0:
+                    sleep(delay)
+
+            self.now = target
+            if target == when:
+                scheduler.run_due(when)
+                return
+
+            scheduler.run_due(target)
@@ -0,0 +1,73 @@
+from hashlib import sha1
+import gzip
+import json
+import os
+
+# Bump when the layout of cache files changes, so old files are ignored
+CACHE_FORMAT = 1
+
+# The only registry fields used to build devices (see Home._build_devices)
+AREA_FIELDS = ("area_id", "name")
+DEVICE_FIELDS = ("id", "area_id", "model")
+ENTITY_FIELDS = ("entity_id", "device_id", "area_id", "name", "original_name", "entity_category", "hidden_by", "disabled_by")
+
+# Column order of cached device rows
+DEVICE_ROW_KEYS = ("entity_id", "name", "area_id", "area", "type")
+
+def trim(entries, fields):
+    '''
+    Keep only fields of every registry entry
+    '''
+    return [{field: entry.get(field) for field in fields} for entry in entries]
+
+def registry_hash(areas, devices, entities):
+    '''
+    Hash trimmed registries, so a cache can tell whether hass changed since it was written
+    '''
+    data = json.dumps([areas, devices, entities], sort_keys=True, separators=(",", ":"))
+    return sha1(data.encode()).hexdigest()
+
+class RegistryCache:
+    def __init__(self, cache_dir, url):
+        '''
+        An on-disk cache of a server's (trimmed) registries and built device rows, so Home can start without downloading them
+        Each server gets its own gzipped json file in cache_dir
+        '''
+        self.cache_dir = cache_dir
+        self.path = os.path.join(cache_dir, f"registry-{sha1(url.encode()).hexdigest()[:16]}.json.gz")
+
+    def load(self):
+        '''
+        Return the cached {hash, areas, devices, entities, rows}, or None if there is no usable cache
+        '''
+        try:
+            with gzip.open(self.path, "rt", encoding="utf-8") as file:
+                data = json.load(file)
+        except (OSError, ValueError):
+            # Missing or corrupt cache
+            return None
+
+        if data.get("format") != CACHE_FORMAT:
+            return None
+
+        return data
+
+    def save(self, digest, areas, devices, entities, devices_built):
+        '''
+        Atomically write trimmed registries and the built devices (as rows of DEVICE_ROW_KEYS) to the cache
+        '''
+        data = {"format": CACHE_FORMAT,
+                "hash": digest,
+                "areas": areas,
+                "devices": devices,
+                "entities": entities,
+                "rows": [[device[key] for key in DEVICE_ROW_KEYS] for device in devices_built]}
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        temp_path = f"{self.path}.{os.getpid()}.tmp"
+        with gzip.open(temp_path, "wt", encoding="utf-8") as file:
+            json.dump(data, file, separators=(",", ":"))
+
+        # Concurrent script processes may write at once. Replacing is atomic, so readers never see a partial file
+        os.replace(temp_path, self.path)
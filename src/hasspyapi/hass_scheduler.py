@@ -0,0 +1,119 @@
+from threading import Condition, Thread
+from time import time_ns
+from itertools import count
+import traceback
+import heapq
+
+class Deadline:
+    def __init__(self, when, callback):
+        '''
+        A callback armed to run at time when (ns, on the scheduler's clock)
+        '''
+        self.when = when
+        self.callback = callback
+        self.cancelled = False
+
+class DeadlineScheduler:
+    def __init__(self, clock=time_ns):
+        '''
+        Runs callbacks at deadlines, using a heap ordered by deadline
+        The thread only wakes up when the earliest deadline expires (or a sooner one is armed), so idle time costs nothing
+
+        clock: function returning the current time in ns. The thread waits in real time, so virtual clocks should call run_due instead
+        '''
+        self.clock = clock
+
+        # Heap of (when, sequence, Deadline). Cancelled deadlines stay in the heap until they reach the top
+        self._heap = []
+        self._sequence = count()
+        self._condition = Condition()
+        self._thread = None
+
+    def arm(self, when, callback):
+        '''
+        Run callback() at time when (ns), and return its Deadline (see cancel)
+        '''
+        deadline = Deadline(when, callback)
+
+        with self._condition:
+            heapq.heappush(self._heap, (when, next(self._sequence), deadline))
+            if self._heap[0][2] is deadline:
+                # New earliest deadline, the thread needs to wait less
+                self._condition.notify()
+
+        return deadline
+
+    def cancel(self, deadline):
+        '''
+        Cancel an armed deadline (does nothing if it already ran)
+        '''
+        deadline.cancelled = True
+
+    def _pop_due(self, now):
+        '''
+        Pop the earliest deadline if it is due by now, otherwise return None. Must hold self._condition
+        '''
+        while self._heap and self._heap[0][2].cancelled:
+            heapq.heappop(self._heap)
+
+        if self._heap and self._heap[0][0] <= now:
+            return heapq.heappop(self._heap)[2]
+
+        return None
+
+    def run_due(self, now=None):
+        '''
+        Run every deadline which is due by now (defaults to the clock)
+        '''
+        if now is None:
+            now = self.clock()
+
+        while True:
+            with self._condition:
+                deadline = self._pop_due(now)
+
+            if deadline is None:
+                return
+
+            self._run(deadline)
+
+    def next_deadline(self):
+        '''
+        Return the time (ns) of the earliest armed deadline, or None
+        '''
+        with self._condition:
+            while self._heap and self._heap[0][2].cancelled:
+                heapq.heappop(self._heap)
+
+            return self._heap[0][0] if self._heap else None
+
+    def _run(self, deadline):
+        '''
+        Run a deadline's callback, without letting it break the scheduler
+        '''
+        try:
+            deadline.callback()
+        except:
+            print(traceback.format_exc())
+
+    def _wait_and_run(self):
+        '''
+        Scheduler thread: sleep until the earliest deadline, and run it
+        '''
+        while True:
+            with self._condition:
+                deadline = self._pop_due(self.clock())
+                while deadline is None:
+                    timeout = (self._heap[0][0] - self.clock()) / 1e9 if self._heap else None
+                    self._condition.wait(timeout)
+                    deadline = self._pop_due(self.clock())
+
+            self._run(deadline)
+
+    def start(self):
+        '''
+        Start the scheduler thread (once)
+        '''
+        if self._thread is None:
+            self._thread = Thread(target=self._wait_and_run, name="hasspyapi-scheduler", daemon=True)
+            self._thread.start()
@@ -0,0 +1,457 @@
+from threading import Lock
+from time import time_ns
+from array import array
+import math
+
+# Distinct (non numeric) states per entity whose time-in-state is kept as prefix sums. Rarer states are counted by scanning
+MAX_TRACKED_STATES = 8
+
+# State code of numeric states (ex. sensor values), which live in the "state" column instead
+NUMERIC = -1
+
+def to_number(value):
+    '''
+    Return value as a float, or NaN if it is not a number
+    '''
+    if isinstance(value, bool):
+        return math.nan
+
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return math.nan
+
+class _Column:
+    def __init__(self, capacity, leaves):
+        '''
+        A numeric column of a StateRing (the state, or an attribute)
+
+        values: value of every entry (NaN if missing)
+        integral, covered: value * seconds and seconds with a value, summed over every entry before each entry (prefix sums, for time weighted means)
+        low, high: min/max segment trees over the ring slots (for windowed min/max)
+        '''
+        self.values = array("d", bytes(8 * capacity))
+        self.integral = array("d", bytes(8 * capacity))
+        self.covered = array("d", bytes(8 * capacity))
+
+        self.leaves = leaves
+        self.low = array("d", [math.inf]) * (2 * leaves)
+        self.high = array("d", [-math.inf]) * (2 * leaves)
+
+    def push(self, slot, previous, seconds, value):
+        '''
+        Write value to slot. previous is the slot of the entry before it (None for the first entry), which lasted seconds
+        '''
+        if previous is None:
+            self.integral[slot] = self.covered[slot] = 0.0
+        else:
+            held = self.values[previous]
+            if held == held:
+                self.integral[slot] = self.integral[previous] + held * seconds
+                self.covered[slot] = self.covered[previous] + seconds
+            else:
+                self.integral[slot] = self.integral[previous]
+                self.covered[slot] = self.covered[previous]
+
+        self.values[slot] = value
+
+        # NaN never wins a min or max
+        node = self.leaves + slot
+        self.low[node] = value if value == value else math.inf
+        self.high[node] = value if value == value else -math.inf
+
+        node //= 2
+        while node:
+            self.low[node] = min(self.low[2 * node], self.low[2 * node + 1])
+            self.high[node] = max(self.high[2 * node], self.high[2 * node + 1])
+            node //= 2
+
+    def extreme(self, tree, pick, first, last):
+        '''
+        Return pick (min or max) of tree over slots first..last (inclusive)
+        '''
+        result = None
+        first += self.leaves
+        last += self.leaves + 1
+
+        while first < last:
+            if first & 1:
+                result = tree[first] if result is None else pick(result, tree[first])
+                first += 1
+            if last & 1:
+                last -= 1
+                result = tree[last] if result is None else pick(result, tree[last])
+            first //= 2
+            last //= 2
+
+        return result
+
+class StateRing:
+    def __init__(self, capacity, columns):
+        '''
+        A fixed size ring buffer of the most recent states of one entity: when each arrived (ns), a state code, and numeric columns
+        Memory is allocated once, so an entity never grows past capacity entries
+
+        columns: names of the numeric columns ("state", and selected attributes)
+        '''
+        if capacity < 2:
+            raise RuntimeError(f"State history capacity must be at least 2, not {capacity}")
+
+        self.capacity = capacity
+
+        leaves = 1
+        while leaves < capacity:
+            leaves *= 2
+
+        self.times = array("q", bytes(8 * capacity))
+        self.codes = array("i", bytes(4 * capacity))
+        self.columns = {name: _Column(capacity, leaves) for name in columns}
+
+        # Non numeric state string <-> code, for the states of entries in the ring only, so an entity never has more than capacity codes
+        # references counts the entries of each code. Codes of states which left the ring are reused (see code)
+        self.code_of = {}
+        self.states = []
+        self.references = []
+        self._free = []
+
+        # code -> seconds spent in that state before each entry (prefix sums), for up to MAX_TRACKED_STATES states
+        self.durations = {}
+
+        # code -> time (ns) the entity last entered that state, and time (ns) of its last state change
+        self.entered = {}
+        self.changed_at = None
+
+        # Physical slot of the oldest entry, and number of entries
+        self.start = 0
+        self.count = 0
+
+    def slot(self, index):
+        '''
+        Return the physical slot of the index-th oldest entry
+        '''
+        return (self.start + index) % self.capacity
+
+    def code(self, state):
+        '''
+        Return the code of a non numeric state (a string), giving it a free code if no entry of the ring has it
+        '''
+        code = self.code_of.get(state)
+        if code is None:
+            if self._free:
+                code = self._free.pop()
+                self.states[code] = state
+            else:
+                code = len(self.states)
+                self.states.append(state)
+                self.references.append(0)
+
+            self.code_of[state] = code
+
+        return code
+
+    def _release(self, code):
+        '''
+        Forget a code which no entry has anymore. Its prefix sums only ever differ between entries of the ring, so they can go too
+        '''
+        del self.code_of[self.states[code]]
+        self.states[code] = None
+        self.durations.pop(code, None)
+        self.entered.pop(code, None)
+        self._free.append(code)
+
+    def push(self, when, code, values):
+        '''
+        Append an entry at time when (ns) with state code (see code, or NUMERIC) and column values (name -> float)
+        overwriting the oldest entry when full
+        '''
+        previous = self.slot(self.count - 1) if self.count else None
+        seconds = (when - self.times[previous]) / 1e9 if previous is not None else 0.0
+
+        if code != NUMERIC:
+            self.references[code] += 1
+
+        if self.count < self.capacity:
+            slot = self.slot(self.count)
+            self.count += 1
+            overwritten = None
+        else:
+            slot = self.start
+            self.start = (self.start + 1) % self.capacity
+            overwritten = self.codes[slot]
+
+        previous_code = self.codes[previous] if previous is not None else None
+
+        if code != NUMERIC and self.references[code] == 1 and code not in self.durations and len(self.durations) < MAX_TRACKED_STATES:
+            # Only states no other entry of the ring is in can start being tracked: entries before this one spent no time in it
+            self.durations[code] = array("d", bytes(8 * self.capacity))
+
+        for tracked, durations in self.durations.items():
+            if previous is None:
+                durations[slot] = 0.0
+            else:
+                durations[slot] = durations[previous] + (seconds if previous_code == tracked else 0.0)
+
+        for name, column in self.columns.items():
+            column.push(slot, previous, seconds, values.get(name, math.nan))
+
+        if previous is None or code != previous_code or (code == NUMERIC and values["state"] != self.columns["state"].values[previous]):
+            self.changed_at = when
+            if code != previous_code:
+                self.entered[code] = when
+
+        self.times[slot] = when
+        self.codes[slot] = code
+
+        if overwritten is not None and overwritten != NUMERIC:
+            self.references[overwritten] -= 1
+            if not self.references[overwritten]:
+                self._release(overwritten)
+
+    def first_since(self, since):
+        '''
+        Return the index of the oldest entry at or after since (ns), or count if there is none (binary search)
+        '''
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.times[self.slot(middle)] < since:
+                low = middle + 1
+            else:
+                high = middle
+
+        return low
+
+    def window_sum(self, since, prefix, held):
+        '''
+        Return the sum from since to the latest entry of a piecewise constant quantity, from its prefix sums (prefix, an array per slot)
+        and held(slot), the quantity an entry contributes per second. Also return the slot of the latest entry
+        '''
+        first = self.first_since(since)
+        last = self.slot(self.count - 1)
+
+        total = 0.0
+        if first < self.count:
+            total += prefix[last] - prefix[self.slot(first)]
+
+            if first > 0:
+                # The entry before the window was still in effect when the window started
+                total += held(self.slot(first - 1)) * (self.times[self.slot(first)] - since) / 1e9
+
+        return total, last
+
+class StateHistory:
+    def __init__(self, capacity=128, attributes=(), entity_ids=None, clock=time_ns):
+        '''
+        Bounded recent state history of entities, kept by a HassEventListener (see HassEventListener(history=...))
+        so conditions can ask about the past without any I/O, ex. "was this motion sensor on in the last 10 minutes"
+
+        Each entity gets a StateRing of capacity entries: the time, state, and numeric value of the state and of selected attributes
+        Queries cost O(log capacity): one binary search for the window start, then prefix sums (time in state, means) or segment trees (min, max)
+
+        attributes: numeric attributes to keep (ex. ("brightness", "illuminance"))
+        entity_ids: an entity_id, list of entity_ids or HassCommand to keep history of (None for every entity with a state_changed event)
+        clock: function returning the current time in ns (the listener's clock, so replays use virtual time)
+        '''
+        self.capacity = capacity
+        self.attributes = tuple(attributes)
+        self.entity_ids = self._as_set(entity_ids)
+        self.clock = clock
+
+        self.rings = {}
+        self.lock = Lock()
+
+    def _as_set(self, value):
+        '''
+        Convert a string, collection of strings or HassCommand to a frozenset (None stays None)
+        '''
+        if value is None:
+            return None
+        if isinstance(value, str):
+            return frozenset((value,))
+        if hasattr(value, "devices"):
+            return frozenset(device["entity_id"] for device in value.devices)
+
+        return frozenset(value)
+
+    def tracks(self, entity_id):
+        '''
+        Return whether history is kept for entity_id
+        '''
+        return self.entity_ids is None or entity_id in self.entity_ids
+
+    def push(self, entity_id, when, state):
+        '''
+        Add a full state json of entity_id, recieved at time when (ns)
+        '''
+        values = {"state": to_number(state.get("state"))}
+        attributes = state.get("attributes") or {}
+        for attribute in self.attributes:
+            values[attribute] = to_number(attributes.get(attribute))
+
+        with self.lock:
+            ring = self.rings.get(entity_id)
+            if ring is None:
+                ring = self.rings[entity_id] = StateRing(self.capacity, ("state",) + self.attributes)
+
+            code = NUMERIC if values["state"] == values["state"] else ring.code(state.get("state"))
+            ring.push(when, code, values)
+
+    def _since(self, window, now):
+        now = self.clock() if now is None else now
+        return now - int(window * 1e9), now
+
+    def state(self, entity_id):
+        '''
+        Return the latest state of entity_id (a string, or a float for numeric states), or None if it has no history
+        '''
+        with self.lock:
+            ring = self.rings.get(entity_id)
+            if ring is None or not ring.count:
+                return None
+
+            last = ring.slot(ring.count - 1)
+            code = ring.codes[last]
+            return ring.columns["state"].values[last] if code == NUMERIC else ring.states[code]
+
+    def last_changed(self, entity_id, state=None):
+        '''
+        Return the time (ns, on the history's clock) entity_id last changed state, or last entered state if given
+        None if it is not in its history
+        '''
+        with self.lock:
+            ring = self.rings.get(entity_id)
+            if ring is None:
+                return None
+
+            if state is None:
+                return ring.changed_at
+
+            code = ring.code_of.get(state)
+            return ring.entered.get(code) if code is not None else None
+
+    def time_in_state(self, entity_id, state, window, now=None):
+        '''
+        Return the seconds entity_id spent in state during the last window seconds
+        Time before the oldest entry of the ring is unknown, and not counted
+        '''
+        since, now = self._since(window, now)
+
+        with self.lock:
+            ring = self.rings.get(entity_id)
+            code = ring.code_of.get(state) if ring is not None else None
+            if code is None or not ring.count:
+                return 0.0
+
+            codes = ring.codes
+            durations = ring.durations.get(code)
+            if durations is None:
+                return self._scan_time_in_state(ring, code, since, now)
+
+            total, last = ring.window_sum(since, durations, lambda slot: 1.0 if codes[slot] == code else 0.0)
+            if codes[last] == code:
+                # The latest state lasts until now
+                total += (now - max(ring.times[last], since)) / 1e9
+
+            return total
+
+    def _scan_time_in_state(self, ring, code, since, now):
+        '''
+        time_in_state for a state without prefix sums (see MAX_TRACKED_STATES), in O(window entries)
+        '''
+        total = 0.0
+        end = now
+        for index in range(ring.count - 1, -1, -1):
+            slot = ring.slot(index)
+            start = max(ring.times[slot], since)
+            if ring.codes[slot] == code and end > start:
+                total += (end - start) / 1e9
+            if ring.times[slot] <= since:
+                break
+            end = ring.times[slot]
+
+        return total
+
+    def _extreme(self, entity_id, window, attribute, now, high):
+        since, now = self._since(window, now)
+
+        with self.lock:
+            ring = self.rings.get(entity_id)
+            if ring is None or not ring.count:
+                return None
+
+            column = ring.columns[attribute or "state"]
+            tree, pick = (column.high, max) if high else (column.low, min)
+
+            # Include the entry which was in effect when the window started
+            first = ring.first_since(since)
+            if first > 0 and (first == ring.count or ring.times[ring.slot(first)] > since):
+                first -= 1
+            first_slot, last_slot = ring.slot(first), ring.slot(ring.count - 1)
+
+            if first_slot <= last_slot:
+                result = column.extreme(tree, pick, first_slot, last_slot)
+            else:
+                # The window wraps around the end of the ring
+                result = pick(column.extreme(tree, pick, first_slot, ring.capacity - 1), column.extreme(tree, pick, 0, last_slot))
+
+            return None if math.isinf(result) else result
+
+    def min(self, entity_id, window, attribute=None, now=None):
+        '''
+        Return the lowest numeric value of the state (or attribute) of entity_id during the last window seconds, or None if there is none
+        '''
+        return self._extreme(entity_id, window, attribute, now, high=False)
+
+    def max(self, entity_id, window, attribute=None, now=None):
+        '''
+        Return the highest numeric value of the state (or attribute) of entity_id during the last window seconds, or None if there is none
+        '''
+        return self._extreme(entity_id, window, attribute, now, high=True)
+
+    def mean(self, entity_id, window, attribute=None, now=None):
+        '''
+        Return the time weighted mean of the state (or attribute) of entity_id during the last window seconds, or None if there is none
+        Time without a numeric value (ex. unavailable) is left out
+        '''
+        since, now = self._since(window, now)
+
+        with self.lock:
+            ring = self.rings.get(entity_id)
+            if ring is None or not ring.count:
+                return None
+
+            column = ring.columns[attribute or "state"]
+            values = column.values
+
+            def value(slot):
+                return values[slot] if values[slot] == values[slot] else 0.0
+
+            def covered(slot):
+                return 1.0 if values[slot] == values[slot] else 0.0
+
+            total, last = ring.window_sum(since, column.integral, value)
+            seconds = ring.window_sum(since, column.covered, covered)[0]
+
+            # The latest value lasts until now
+            tail = (now - max(ring.times[last], since)) / 1e9
+            total += value(last) * tail
+            seconds += covered(last) * tail
+
+            if seconds <= 0:
+                # No time has passed, so the latest value is the mean
+                return values[last] if values[last] == values[last] else None
+
+            return total / seconds
+
+    def changes(self, entity_id, window, now=None):
+        '''
+        Return the number of state_changed events of entity_id during the last window seconds (at most capacity)
+        '''
+        since, now = self._since(window, now)
+
+        with self.lock:
+            ring = self.rings.get(entity_id)
+            if ring is None:
+                return 0
+
+            return ring.count - ring.first_since(since)
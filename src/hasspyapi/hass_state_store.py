@@ -0,0 +1,130 @@
+from threading import Condition, Lock
+from time import monotonic
+
+class HassStateStore:
+    def __init__(self, api_layer, max_age=None):
+        '''
+        An in-memory mirror of hass entity states, so reading states does not cost a REST round trip
+
+        The mirror is seeded with a single bulk states call, then kept current by a HassEventListener feeding it state_changed events
+        max_age: seconds the mirror stays fresh after a sync or update when no listener is feeding it (None = never fresh without a listener)
+
+        While a listener is connected, the mirror is always fresh. Otherwise, reads are only served while it is younger than max_age
+        States returned by service calls are written back (see apply_changes), so a read right after a call sees its result
+        '''
+        self.api_layer = api_layer
+        self.max_age = max_age
+
+        # entity_id -> full state json (entity_id, state, attributes, last_changed, last_updated, context)
+        self.states = {}
+        self.lock = Lock()
+
+        # Notified on every update, see wait_for
+        self.changed = Condition(self.lock)
+
+        # monotonic time of the last bulk sync or event update
+        self.updated_at = None
+
+        # Whether a listener is currently subscribed and feeding events to the mirror
+        self.live = False
+
+    def sync(self, states=None):
+        '''
+        Replace the mirror with a fresh bulk download of all states
+        States which were updated by events after the download was taken are kept
+
+        states: already downloaded states (ex. over the websocket) to use instead of downloading them over REST
+        '''
+        if states is None:
+            states = self.api_layer.all_states()
+
+        with self.lock:
+            old_states = self.states
+            self.states = {}
+            for state in states:
+                self._set(state, old_states.get(state["entity_id"]))
+
+            self.updated_at = monotonic()
+
+    def _set(self, state, current):
+        '''
+        Save state unless current is newer
+        hass timestamps are isoformat UTC strings, so they compare in time order
+        '''
+        if current is not None and current.get("last_updated", "") > state.get("last_updated", ""):
+            state = current
+
+        self.states[state["entity_id"]] = state
+
+    def update(self, data):
+        '''
+        Apply the data of a state_changed event
+        '''
+        entity_id = data.get("entity_id")
+        new_state = data.get("new_state")
+
+        with self.lock:
+            if new_state is None:
+                # Entity was removed
+                self.states.pop(entity_id, None)
+            else:
+                self._set(new_state, self.states.get(entity_id))
+
+            self.updated_at = monotonic()
+            self.changed.notify_all()
+
+    def apply_changes(self, states):
+        '''
+        Apply the changed states a service call responded with
+        This does not make the mirror any fresher, since other entities may have changed meanwhile
+        '''
+        if not states:
+            return
+
+        with self.lock:
+            for state in states:
+                self._set(state, self.states.get(state["entity_id"]))
+
+            self.changed.notify_all()
+
+    def set_live(self, live):
+        '''
+        Mark whether a listener is feeding events into the mirror
+        '''
+        self.live = live
+
+    def age(self):
+        '''
+        Return seconds since the last sync or update (None if the mirror was never synced)
+        '''
+        if self.updated_at is None:
+            return None
+
+        return monotonic() - self.updated_at
+
+    def is_fresh(self):
+        '''
+        Return whether the mirror can currently be trusted for reads
+        '''
+        if self.live:
+            return True
+
+        age = self.age()
+        return age is not None and self.max_age is not None and age <= self.max_age
+
+    def wait_for(self, entity_id, predicate, timeout=None):
+        '''
+        Wait until predicate(state) is true for the mirrored state of entity_id (None if unknown), or timeout seconds pass
+        Return whether predicate became true
+        '''
+        with self.lock:
+            return self.changed.wait_for(lambda: predicate(self.states.get(entity_id)), timeout)
+
+    def get(self, entity_id):
+        '''
+        Return the full state json of entity_id, or None if the mirror is stale or does not know the entity
+        '''
+        if not self.is_fresh():
+            return None
+
+        return self.states.get(entity_id)
@@ -0,0 +1,109 @@
+import json
+
+# Aggregates which can be rendered by hass (see aggregate_template)
+AGGREGATES = ("count", "any", "all", "min", "max", "mean")
+
+# States which count as having no value
+UNKNOWN_STATES = ("unavailable", "unknown")
+
+def aggregate_template(entity_ids, function, attribute=None, value=None):
+    '''
+    Return a hass template which computes function over the state (or attribute) of entity_ids, and renders the result as json
+
+    count: number of entities whose value equals value, or which have a known value if value is None
+    any, all: whether any/all entities have value (by default "on" for states)
+    min, max, mean: over the numeric values (None if there are none)
+    '''
+    if function not in AGGREGATES:
+        raise RuntimeError(f"Unknown aggregate {function}, expected one of {AGGREGATES}")
+
+    if function in ("any", "all") and value is None:
+        if attribute is not None:
+            raise RuntimeError(f"{function} of an attribute needs a value to compare to")
+        value = "on"
+
+    path = "state" if attribute is None else f"attributes.{attribute}"
+
+    # json literals are valid jinja literals
+    # Entities are picked from states by entity_id: expand() would also expand groups into their members, and sort and dedupe them
+    lines = [f"{{% set entities = states | selectattr('entity_id', 'in', {json.dumps(list(entity_ids))}) | list %}}",
+             f"{{% set values = entities | map(attribute={json.dumps(path)}, default=none) | list %}}"]
+
+    if value is not None:
+        lines.append(f"{{% set matches = values | select('eq', {json.dumps(value)}) | list | count %}}")
+
+    if function == "count":
+        if value is None:
+            lines.append(f"{{% set result = values | reject('none') | reject('in', {json.dumps(UNKNOWN_STATES)}) | list | count %}}")
+        else:
+            lines.append("{% set result = matches %}")
+    elif function == "any":
+        lines.append("{% set result = matches > 0 %}")
+    elif function == "all":
+        lines.append("{% set result = matches == values | count %}")
+    else:
+        lines.append("{% set numbers = values | map('float', none) | reject('none') | list %}")
+        if function == "mean":
+            lines.append("{% set result = (numbers | sum / numbers | count) if numbers else none %}")
+        else:
+            lines.append(f"{{% set result = (numbers | {function}) if numbers else none %}}")
+
+    lines.append("{{ result | to_json }}")
+    return "".join(lines)
+
+def parse_result(result, codec):
+    '''
+    Return the value of a rendered template
+    hass may already parse rendered results into Python types (websocket), or send them as text (REST)
+    '''
+    if isinstance(result, str):
+        return codec.loads(result)
+
+    return result
+
+class TemplateWatch:
+    def __init__(self, connection, template, callback):
+        '''
+        A render_template subscription on connection (a HassWebSocketLayer), which calls callback(value) whenever the rendered value changes
+        hass re-renders the template whenever an entity it reads changes, so nothing is polled
+
+        callback runs on the connection's loop, so it should hand off slow work
+        '''
+        self.connection = connection
+        self.template = template
+        self.callback = callback
+
+        # Last rendered value, and the subscription id (while subscribed)
+        self.value = None
+        self.subscription = None
+        self._rendered = False
+
+    async def start(self):
+        '''
+        Subscribe to the template. callback is called with its first value right away
+        '''
+        self.subscription = await self.connection.subscribe_template(self.template, self._on_event)
+        return self
+
+    def _on_event(self, msg):
+        event = msg.get("event") or {}
+        if "error" in event:
+            print(f"Template subscription {self.subscription} failed: {event['error']}")
+            return
+
+        value = parse_result(event.get("result"), self.connection.codec)
+        if self._rendered and value == self.value:
+            # Only push changes of the aggregate
+            return
+
+        self._rendered = True
+        self.value = value
+        self.callback(value)
+
+    async def cancel(self):
+        '''
+        Cancel the subscription
+        '''
+        if self.subscription is not None:
+            subscription, self.subscription = self.subscription, None
+            await self.connection.unsubscribe(subscription)
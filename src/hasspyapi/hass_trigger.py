@@ -0,0 +1,145 @@
+from .hass_event import StateChangedEvent, resolve
+
+# Default for from_state/to_state, so None can still be matched
+ANY = object()
+
+class TriggerScope:
+    def __init__(self, entity_id=None, domain=None, attribute=None, from_state=ANY, to_state=ANY):
+        '''
+        A declarative description of which state_changed events a trigger cares about
+
+        entity_id: an entity_id, a list of entity_ids, or a HassCommand (uses the entity_ids of its devices)
+        domain: a domain (ex. "light") or a list of domains
+        attribute: the changed key or path to look at (ex. "state", "brightness", "attributes.brightness"). Defaults to "state" when from_state/to_state are given
+        from_state/to_state: required old/new value of attribute (or a list/tuple/set of accepted values)
+        '''
+        self.entity_ids = self._as_set(entity_id)
+        self.domains = self._as_set(domain)
+
+        if attribute is None and (from_state is not ANY or to_state is not ANY):
+            attribute = "state"
+
+        # Raw states are looked up by path. Flattened diffs only have leaf keys, so they use the last part of the path
+        self.path = attribute
+        self.attribute = attribute.split(".")[-1] if attribute else None
+        self.from_state = from_state
+        self.to_state = to_state
+
+    def _as_set(self, value):
+        '''
+        Convert a string, collection of strings or HassCommand to a frozenset (None stays None)
+        '''
+        if value is None:
+            return None
+        if isinstance(value, str):
+            return frozenset((value,))
+        if hasattr(value, "devices"):
+            return frozenset(device["entity_id"] for device in value.devices)
+
+        return frozenset(value)
+
+    def _accepts(self, expected, value):
+        '''
+        Return whether value is the expected value (or one of the expected values)
+        '''
+        if expected is ANY:
+            return True
+        if isinstance(expected, (list, tuple, set, frozenset)):
+            return value in expected
+
+        return value == expected
+
+    def matches(self, msg):
+        '''
+        Return whether msg (a StateChangedEvent, or a flattened state_changed dictionary) satisfies this scope
+
+        True if it does, False if the event concerns this scope but does not satisfy it (ex. wrong to_state),
+        and None if the event is not relevant at all (wrong entity, or attribute did not change)
+        '''
+        if not msg:
+            return None
+
+        entity_id = msg.get("entity_id")
+        if self.entity_ids is not None and entity_id not in self.entity_ids:
+            return None
+        if self.domains is not None and entity_id.split(".")[0] not in self.domains:
+            return None
+
+        if self.attribute is None:
+            return True
+
+        if isinstance(msg, StateChangedEvent):
+            # Look at the raw states, so the diff does not need to be computed
+            old_value = resolve(msg.raw_old_state, self.path)
+            new_value = resolve(msg.raw_new_state, self.path)
+            if old_value == new_value:
+                # Attribute did not change
+                return None
+
+            return self._accepts(self.from_state, old_value) and self._accepts(self.to_state, new_value)
+
+        old_state = msg.get("old_state") or {}
+        new_state = msg.get("new_state") or {}
+        if self.attribute not in new_state and self.attribute not in old_state:
+            # Attribute did not change
+            return None
+
+        return self._accepts(self.from_state, old_state.get(self.attribute)) and self._accepts(self.to_state, new_state.get(self.attribute))
+
+class Trigger:
+    def __init__(self, index, conditions_met, event, duration=None, scope=None, serialize=False):
+        '''
+        A registered trigger: conditions_met and/or scope decide when event is called
+        index is the registration order, which is preserved when firing events
+        If serialize, calls of event never overlap (see HandlerPool)
+        '''
+        self.index = index
+        self.conditions_met = conditions_met
+        self.event = event
+        self.duration = duration
+        self.scope = scope
+        self.serialize = serialize
+
+        # asyncio.Lock serializing coroutine events (created on the listening loop)
+        self.lock = None
+
+        # Label of the trigger in metrics (see HassMetrics)
+        self.name = f"{index}:{getattr(event, '__qualname__', repr(event))}"
+
+        # Armed Deadline while conditions of a duration trigger are met (see DeadlineScheduler)
+        # If an event is fired due to duration, fired is set until conditions stop being met
+        self.deadline = None
+        self.fired = False
+
+        # The last result of the scope on a relevant event, used to recheck duration triggers when their deadline expires (msg is None)
+        self.last_match = None
+
+    def check_scope(self, msg):
+        '''
+        Return True if msg passes the scope (or there is none), so conditions_met decides. Otherwise return the result of check (False/None)
+        '''
+        if not self.scope:
+            return True
+
+        if msg is None:
+            # Deadline recheck. The scope only holds between events for duration checks
+            return self.last_match if self.duration else None
+
+        matched = self.scope.matches(msg)
+        if matched is not None:
+            self.last_match = matched
+
+        return matched
+
+    def check(self, msg):
+        '''
+        Return whether conditions are met for msg (True/False), or None if msg is not relevant to this trigger
+        '''
+        matched = self.check_scope(msg)
+        if not matched:
+            return matched
+
+        if self.conditions_met:
+            return self.conditions_met(msg)
+
+        return True
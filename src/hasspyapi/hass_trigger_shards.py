@@ -0,0 +1,473 @@
+from multiprocessing.connection import wait
+from concurrent.futures import Future
+from time import monotonic, perf_counter
+from threading import Lock, Thread
+from collections import deque
+import multiprocessing
+import traceback
+import asyncio
+import pickle
+
+from .hass_event import StateChangedEvent
+from .hass_json import JsonCodec, LazyJson
+
+# Seconds the collector waits on workers at most, so it notices restarted workers and new deadlines
+COLLECT_INTERVAL = 0.05
+
+def _serve(connection, conditions, codec_name, skip_keys, lazy_diff, timed):
+    '''
+    Worker process: evaluate conditions (trigger index -> pickled conditions_met) for every request from the listener, until the listener goes away
+
+    Requests are a json header [seq, trigger indices, whether there is an event, entity_id],
+    then the old and new state json of the event as they arrived (empty for no state)
+    Periodic and deadline checks have no event, and check None
+    Replies are [seq, results], with one [result (True/False/None), seconds (None unless timed), failed] per index
+    Once its conditions are loaded, the worker sends [0, []], so the listener knows it is ready
+    '''
+    codec = JsonCodec(codec_name)
+
+    # A condition which cannot be imported here always fails, instead of crashing (and restarting) the worker on every request
+    loaded = {}
+    for index, condition in conditions.items():
+        try:
+            loaded[index] = pickle.loads(condition)
+        except:
+            print(traceback.format_exc())
+            loaded[index] = None
+
+    try:
+        connection.send_bytes(codec.dumps([0, []]).encode())
+    except (EOFError, OSError):
+        return
+
+    while True:
+        try:
+            seq, indices, event, entity_id = codec.loads(connection.recv_bytes())
+            if event:
+                old_state, new_state = connection.recv_bytes(), connection.recv_bytes()
+        except (EOFError, OSError):
+            break
+
+        msg = None
+        if event:
+            # States stay undecoded until a condition reads them
+            msg = StateChangedEvent({"entity_id": entity_id,
+                                     "old_state": LazyJson(old_state, codec) if old_state else None,
+                                     "new_state": LazyJson(new_state, codec) if new_state else None}, skip_keys, lazy_diff)
+
+        results = []
+        for index in indices:
+            start = perf_counter() if timed else None
+            try:
+                c_met = loaded[index](msg)
+                failed = False
+            except:
+                print(traceback.format_exc())
+                c_met = False
+                failed = True
+
+            results.append([None if c_met is None else bool(c_met), perf_counter() - start if timed else None, failed])
+
+        try:
+            connection.send_bytes(codec.dumps([seq, results]).encode())
+        except (EOFError, OSError):
+            break
+
+class TriggerShards:
+    def __init__(self, listener, processes, timeout=2, max_in_flight=32, metrics=None):
+        '''
+        Evaluates conditions_met of a listener's triggers on worker processes, so CPU heavy conditions run in parallel, outside the GIL
+
+        Workers are fresh interpreters (forkserver, or spawn where there is no forkserver), never forks of the threaded listener process
+        Conditions are sent to them by reference, so only importable conditions are sharded: module level functions, not lambdas or closures
+        Workers import the modules of their conditions, so scripts need an `if __name__ == "__main__":` guard
+        A sharded condition must only depend on msg: it cannot see the listener's state history or mirror, nor any other state of the listener process
+        Other conditions (coroutine conditions, and triggers registered after the workers started) are still checked in the listener process
+        A condition which cannot be sent (ex. a lambda) is reported when the workers start
+
+        Triggers are partitioned round robin between processes. The listener keeps scopes, durations and events (which call hass),
+        and only sends events which pass a trigger's scope, with their states as the raw json they arrived as
+
+        Requests are pipelined: send returns right away, and a collector thread resolves requests as workers answer,
+        so the listener can send the next events while workers evaluate the previous ones
+
+        processes: number of worker processes
+        timeout: seconds a worker may spend on one request before it is considered hung, and restarted
+        max_in_flight: maximum number of events the listener sends before their results are back (see HassEventListener._dispatch)
+        metrics: HassMetrics to record condition times, condition errors and worker restarts in (None to not record them)
+
+        A worker which crashes (or hangs) is restarted. Its pending results count as conditions not met, and the connection is untouched
+        '''
+        methods = multiprocessing.get_all_start_methods()
+        self.context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+
+        self.listener = listener
+        self.processes = processes
+        self.timeout = timeout
+        self.max_in_flight = max_in_flight
+        self.metrics = metrics
+        self.codec = JsonCodec()
+
+        # trigger index -> shard, and per shard trigger index -> pickled conditions_met, for triggers registered before start
+        self.shard_of = {}
+        self.conditions = [{} for shard in range(processes)]
+
+        # Per shard worker process and its end of the pipe
+        self.workers = [None] * processes
+        self.connections = [None] * processes
+
+        # Requests in flight: seq -> _Request, per shard the seqs it has not answered yet (oldest first),
+        # and since when each shard has been working on its oldest one
+        self._pending = {}
+        self._outstanding = [deque() for shard in range(processes)]
+        self._since = [None] * processes
+
+        # Whether each worker finished starting. Requests wait for a starting worker without a deadline, since starting takes a while
+        self._ready = [False] * processes
+
+        # Guards workers, connections and requests, which the dispatch, scheduler and collector threads all use
+        # Sending holds a lock of its own, so a full pipe never stops the collector from draining answers
+        self._lock = Lock()
+        self._send_lock = Lock()
+        self._seq = 0
+        self._collector = None
+        self.started = False
+        self.closed = False
+
+        # Metrics (see stats)
+        self.requests = 0
+        self.restarts = 0
+
+    def _pickled(self, trigger):
+        '''
+        Return the pickled conditions_met of trigger, or None if it cannot be sharded
+        Conditions which cannot be pickled are reported, since they silently stay on the listener's GIL otherwise
+        '''
+        if trigger.conditions_met is None or asyncio.iscoroutinefunction(trigger.conditions_met):
+            return None
+
+        try:
+            return pickle.dumps(trigger.conditions_met)
+        except Exception as exc:
+            # Lambdas, closures, and methods of objects holding locks or connections stay in the listener process
+            print(f"Trigger {trigger.name} cannot be sharded ({exc!r}), so its conditions run in the listener process. "
+                  f"Use a module level function to run them on a worker")
+            return None
+
+    def start(self):
+        '''
+        Partition the listener's triggers and start the workers (once)
+        '''
+        with self._lock:
+            if self.started:
+                return
+
+            self.shard_of = {}
+            self.conditions = [{} for shard in range(self.processes)]
+            for trigger in self.listener.triggers:
+                pickled = self._pickled(trigger)
+                if pickled is None:
+                    continue
+
+                shard = len(self.shard_of) % self.processes
+                self.shard_of[trigger.index] = shard
+                self.conditions[shard][trigger.index] = pickled
+
+            for shard in range(self.processes):
+                self._spawn(shard)
+
+            self.started = True
+            self.closed = False
+
+            self._collector = Thread(target=self._collect, name="hasspyapi-shard-collector", daemon=True)
+            self._collector.start()
+
+    def _spawn(self, shard):
+        '''
+        Start (or restart) the worker of shard
+        '''
+        parent, child = self.context.Pipe()
+        process = self.context.Process(target=_serve, name=f"hasspyapi-shard-{shard}", daemon=True,
+                                       args=(child, self.conditions[shard], self.codec.name, self.listener.diff_skip_keys,
+                                             self.listener.lazy_diff, self.metrics is not None))
+        process.start()
+        child.close()
+
+        self.workers[shard] = process
+        self.connections[shard] = parent
+        self._ready[shard] = False
+
+    def _restart(self, shard, reason):
+        '''
+        Replace a crashed or hung worker. Must hold self._lock
+        '''
+        print(f"Trigger shard {shard} {reason}, restarting it")
+
+        process = self.workers[shard]
+        if process.is_alive():
+            process.kill()
+        process.join()
+        self.connections[shard].close()
+
+        self.restarts += 1
+        if self.metrics is not None:
+            self.metrics.count("trigger_shard_restarts", shard=str(shard))
+
+        self._spawn(shard)
+
+    def match(self, triggers, msg):
+        '''
+        Match the scopes of the sharded triggers among triggers against msg (a StateChangedEvent, or None)
+        Scopes keep state for duration rechecks, so this runs under the listener's lock. Only conditions_met runs on the workers (see send)
+
+        Return (results, requests): trigger index -> check result, for sharded triggers out of scope,
+        and shard -> indices of the sharded triggers to evaluate
+        '''
+        if not self.started and not self.closed:
+            self.start()
+
+        results = {}
+        requests = {}
+        for trigger in triggers:
+            shard = self.shard_of.get(trigger.index)
+            if shard is None:
+                continue
+
+            matched = trigger.check_scope(msg)
+            if not matched:
+                results[trigger.index] = matched
+            else:
+                requests.setdefault(shard, []).append(trigger.index)
+
+        return results, requests
+
+    def _encode(self, msg):
+        '''
+        Return the request header fields (whether there is an event, entity_id) and the old and new state json of msg
+        Undecoded states of a StateChangedEvent are passed on as they arrived. Other messages (ex. dicts given to fire_event) are encoded
+        '''
+        if msg is None:
+            return False, None, None
+
+        if isinstance(msg, StateChangedEvent):
+            states = [msg.state_json("old_state", self.codec), msg.state_json("new_state", self.codec)]
+        else:
+            states = [msg.get(key) for key in ("old_state", "new_state")]
+            states = [None if state is None else self.codec.dumps(state).encode() for state in states]
+
+        return True, msg.get("entity_id"), [state or b"" for state in states]
+
+    def send(self, requests, msg):
+        '''
+        Send the conditions of requests (see match) to be evaluated against msg on the workers, without waiting for them
+        Return a concurrent.futures.Future of a dictionary of trigger index -> check result
+        Results of a worker which does not answer within timeout count as not met
+        '''
+        future = Future()
+        if not requests:
+            future.set_result({})
+            return future
+
+        event, entity_id, states = self._encode(msg)
+
+        # Requests reach every worker in seq order
+        with self._send_lock:
+            with self._lock:
+                if not self.started:
+                    # The listener stopped meanwhile
+                    future.set_result({index: False for indices in requests.values() for index in indices})
+                    return future
+
+                self._seq += 1
+                self.requests += 1
+                seq = self._seq
+
+                self._pending[seq] = _Request(future, requests)
+                connections = {}
+                for shard in requests:
+                    if not self._outstanding[shard]:
+                        self._since[shard] = monotonic()
+                    self._outstanding[shard].append(seq)
+                    connections[shard] = self.connections[shard]
+
+            for shard, indices in requests.items():
+                connection = connections[shard]
+                try:
+                    connection.send_bytes(self.codec.dumps([seq, indices, event, entity_id]).encode())
+                    if event:
+                        connection.send_bytes(states[0])
+                        connection.send_bytes(states[1])
+                except (EOFError, OSError):
+                    with self._lock:
+                        # Unless a restart already replaced the worker (and failed this request)
+                        if self.connections[shard] is connection:
+                            self._fail(shard, "crashed")
+
+        return future
+
+    def evaluate(self, requests, msg):
+        '''
+        Evaluate the conditions of requests (see match) against msg on the workers, and wait for them
+        Return a dictionary of trigger index -> check result
+        '''
+        return self.send(requests, msg).result()
+
+    def _collect(self):
+        '''
+        Collector thread: resolve requests as workers answer them, and restart workers which miss their deadline, until closed
+        '''
+        while True:
+            with self._lock:
+                if not self.started:
+                    return
+
+                connections = {connection: shard for shard, connection in enumerate(self.connections)}
+                deadlines = [since + self.timeout for since, outstanding, ready in zip(self._since, self._outstanding, self._ready) if outstanding and ready]
+
+            # Wake up for the nearest deadline, and now and then for workers restarted meanwhile
+            wait_for = min([deadline - monotonic() for deadline in deadlines] + [COLLECT_INTERVAL])
+            try:
+                ready = wait(list(connections), max(0, wait_for))
+            except (OSError, ValueError):
+                # A connection was closed by a restart meanwhile
+                continue
+
+            with self._lock:
+                if not self.started:
+                    return
+
+                for connection in ready:
+                    shard = connections[connection]
+                    if self.connections[shard] is not connection:
+                        continue
+
+                    try:
+                        seq, values = self.codec.loads(connection.recv_bytes())
+                    except (EOFError, OSError):
+                        self._fail(shard, "crashed")
+                        continue
+
+                    self._answer(shard, seq, values)
+
+                now = monotonic()
+                for shard, outstanding in enumerate(self._outstanding):
+                    if outstanding and self._ready[shard] and self._since[shard] + self.timeout <= now:
+                        self._fail(shard, f"did not answer in {self.timeout} seconds")
+
+    def _answer(self, shard, seq, values):
+        '''
+        Save the answer of shard to request seq. Must hold self._lock
+        '''
+        if seq == 0:
+            # The worker is ready, and starts on its requests now
+            self._ready[shard] = True
+            self._since[shard] = monotonic()
+            return
+
+        outstanding = self._outstanding[shard]
+        if not outstanding or seq < outstanding[0]:
+            # Late answer to a request which was already failed
+            return
+
+        while outstanding[0] != seq:
+            # Workers answer in order, so an older unanswered request is lost
+            self._resolve(outstanding.popleft(), shard, None)
+
+        outstanding.popleft()
+        self._resolve(seq, shard, values)
+
+        # The worker moves on to its next request
+        self._since[shard] = monotonic()
+
+    def _resolve(self, seq, shard, values):
+        '''
+        Save the results of shard for request seq (values None for failed), and resolve the request once every shard answered. Must hold self._lock
+        '''
+        request = self._pending[seq]
+        indices = request.requests[shard]
+
+        if values is None:
+            for index in indices:
+                request.results[index] = False
+                self._observe(index, None, True)
+        else:
+            for index, (c_met, seconds, failed) in zip(indices, values):
+                request.results[index] = c_met
+                self._observe(index, seconds, failed)
+
+        request.waiting.discard(shard)
+        if not request.waiting:
+            del self._pending[seq]
+            request.future.set_result(request.results)
+
+    def _observe(self, index, seconds, failed):
+        '''
+        Record the condition time and errors of a sharded trigger, like the listener does for its own conditions
+        '''
+        if self.metrics is None:
+            return
+
+        name = self.listener.triggers[index].name
+        if failed:
+            self.metrics.count("trigger_errors", trigger=name, stage="condition")
+        if seconds is not None:
+            self.metrics.observe("trigger_condition_seconds", seconds, trigger=name)
+
+    def _fail(self, shard, reason):
+        '''
+        Count the triggers a failed worker was checking as not met (and as condition errors), and restart it. Must hold self._lock
+        '''
+        outstanding = self._outstanding[shard]
+        while outstanding:
+            self._resolve(outstanding.popleft(), shard, None)
+
+        self._restart(shard, reason)
+
+    def stats(self):
+        '''
+        Return a dictionary of shard metrics
+        '''
+        return {"shards": self.processes,
+                "sharded_triggers": len(self.shard_of),
+                "shard_requests": self.requests,
+                "shard_in_flight": len(self._pending),
+                "shard_restarts": self.restarts}
+
+    def close(self):
+        '''
+        Stop the workers. Conditions are checked in the listener process from now on, until start is called again
+        Requests still in flight count as not met
+        '''
+        with self._lock:
+            for shard, outstanding in enumerate(self._outstanding):
+                while outstanding:
+                    self._resolve(outstanding.popleft(), shard, None)
+
+            # Workers exit once they see their pipe close, so close every pipe before waiting on any worker
+            for connection in self.connections:
+                if connection is not None:
+                    connection.close()
+
+            for process in self.workers:
+                if process is None:
+                    continue
+
+                process.join(1)
+                if process.is_alive():
+                    process.kill()
+
+            self.workers = [None] * self.processes
+            self.connections = [None] * self.processes
+            self.shard_of = {}
+            self.started = False
+            self.closed = True
+
+class _Request:
+    def __init__(self, future, requests):
+        '''
+        A request in flight: its future, shard -> indices it asked for, results so far, and shards still to answer
+        '''
+        self.future = future
+        self.requests = requests
+        self.results = {}
+        self.waiting = set(requests)
@@ -1,71 +1,493 @@
-import json
+from itertools import count
+from time import perf_counter
+import traceback
+import asyncio
 import websockets
 
+from .hass_json import JsonCodec, scan_id, scan_string
+
+# Seconds to wait before reconnecting a dropped connection, doubled after every failed attempt up to RECONNECT_MAX_DELAY
+RECONNECT_DELAY = 1
+RECONNECT_MAX_DELAY = 30
+
 class HassWebSocketLayer:
-    def __init__(self, ws, ws_url, ws_headers):
+    def __init__(self, ws, ws_url, ws_headers, metrics=None, codec=None, reconnect=True):
         '''
         Layer between hass web socket and Python
+
+        One connection is multiplexed between any number of calls and subscriptions:
+        every message gets a new id, and a reader task routes each response to its awaiting call, and each event to its subscription
+
+        metrics: HassMetrics to record the receive rate and decode time of messages in (None to not record them)
+        codec: JsonCodec to encode and decode messages with (defaults to the fastest one installed)
+        reconnect: when the connection drops, connect again and renew every subscription (see _read)
+            Calls in flight when it dropped fail, since they may or may not have reached hass
         '''
         self.ws = ws
         self.ws_url = ws_url
         self.ws_headers = ws_headers
+        self.metrics = metrics
+        self.codec = codec or JsonCodec()
+        self.reconnect = reconnect
+
+        # Message ids must increase monotonically on a connection
+        self._ids = count(1)
+
+        # Message id -> future of a call awaiting its result
+        self._pending = {}
+
+        # Subscription id -> callback(msg) for its events. Subscriptions without a callback go to self.events (see recv)
+        self._subscriptions = {}
+        self.events = asyncio.Queue()
+
+        # Subscriptions are renewed under new ids on every connection, so callers keep the id they subscribed with:
+        # subscription -> its subscribe message, and subscription -> its id on the current connection
+        self._subscribed = {}
+        self._current_ids = {}
+
+        # Called with True once a dropped connection is back and resubscribed, and with False when it drops
+        # Events sent in between are lost, so subscribers can catch up (ex. resync a state mirror)
+        self.connection_callbacks = []
+
+        # Subscription id -> (prefilter, lazy) for subscriptions which look at raw frames before they are decoded (see subscribe)
+        self._frame_options = {}
+
+        # Service calls: entity_id -> number of calls in flight on it, and context id -> states changed by that context (see call_service)
+        self._calling = {}
+        self._changes = {}
+        self._changes_subscription = None
+        self._changes_lock = None
+
+        # Resolved with the reason the connection closed, once the reader stops for good. closing: close() was called
+        self._closed = asyncio.get_running_loop().create_future()
+        self._closing = False
+        self._reader = None
 
     @classmethod
-    async def authorize(cls, ws_url, ws_headers):
+    async def authorize(cls, ws_url, ws_headers, metrics=None, codec=None, reconnect=True):
         '''
         Authorize a websocket client
         '''
+        codec = codec or JsonCodec()
+
+        layer = cls(await cls._connect(ws_url, ws_headers, codec), ws_url, ws_headers, metrics, codec, reconnect)
+        layer._reader = asyncio.get_running_loop().create_task(layer._read())
+        return layer
+
+    @staticmethod
+    async def _connect(ws_url, ws_headers, codec):
+        '''
+        Open and authorize a connection
+        '''
         # Recieve first message. This is likely auth_required
         ws = await websockets.connect(ws_url, ping_interval=20, ping_timeout=20, close_timeout=10)
-        first = json.loads(await ws.recv())
+        first = codec.loads(await ws.recv())
 
         if first.get("type") == "auth_required":
-            await ws.send(json.dumps(ws_headers))
-            auth_resp = json.loads(await ws.recv())
+            await ws.send(codec.dumps(ws_headers))
+            auth_resp = codec.loads(await ws.recv())
             if auth_resp.get("type") != "auth_ok":
+                await ws.close()
                 raise RuntimeError(f"Auth failed: {auth_resp}")
         else:
             # Server did not ask for auth... there is some issue
+            await ws.close()
             raise RuntimeError(f"Server auth failed: {first}")
-        
-        return cls(ws, ws_url, ws_headers)
-    
-    async def subscribe(self):
+
+        return ws
+
+    async def _read(self):
+        '''
+        Reader task: recieve every message on the connection and route it to its call or subscription
+        When the connection drops, connect again (see _reconnect), unless it was closed on purpose or reconnect is off
+        '''
+        while True:
+            try:
+                await self._receive()
+            except asyncio.CancelledError:
+                # close() stops the reader
+                self._close(RuntimeError("Websocket reader stopped"))
+                raise
+            except Exception as exc:
+                error = exc
+
+            if self._closing or not self.reconnect:
+                self._close(error)
+                return
+
+            # Calls in flight may already have reached hass, so they fail instead of being sent again
+            self._fail_pending(ConnectionError(f"Websocket connection lost: {error!r}"))
+            self._notify(False)
+
+            try:
+                await self._reconnect()
+            except asyncio.CancelledError:
+                self._close(RuntimeError("Websocket reader stopped"))
+                raise
+            except Exception as exc:
+                self._close(exc)
+                return
+
+            # Subscribing waits on responses, which this reader recieves, so it runs as its own task
+            asyncio.get_running_loop().create_task(self._resubscribe())
+
+    async def _receive(self):
+        '''
+        Recieve and route messages until the connection drops
+        '''
+        while True:
+            raw = await self.ws.recv()
+
+            if self.metrics is None:
+                msg = self._decode(raw)
+            else:
+                start = perf_counter()
+                msg = self._decode(raw)
+                self.metrics.observe("websocket_decode_seconds", perf_counter() - start)
+                self.metrics.mark("websocket_messages")
+
+            if msg is not None:
+                self._route(msg)
+
+    async def _reconnect(self):
+        '''
+        Connect again, waiting longer after every failed attempt
+        A rejected token is not retried, since it will not be accepted later either
+        '''
+        delay = RECONNECT_DELAY
+        while True:
+            await asyncio.sleep(delay)
+            try:
+                self.ws = await self._connect(self.ws_url, self.ws_headers, self.codec)
+                break
+            except RuntimeError:
+                raise
+            except Exception as exc:
+                print(f"Websocket reconnect failed: {exc!r}, retrying in {min(delay * 2, RECONNECT_MAX_DELAY)} seconds")
+                delay = min(delay * 2, RECONNECT_MAX_DELAY)
+
+        if self.metrics is not None:
+            self.metrics.count("websocket_reconnects")
+
+    async def _resubscribe(self):
+        '''
+        Renew every subscription on the new connection, under new ids
+        '''
+        async def renew(subscription, msg):
+            if subscription not in self._current_ids:
+                # Cancelled meanwhile
+                return
+
+            msg_id = self.next_id()
+
+            # Move the callback and frame options over first, so no event of the new id is missed
+            old_id = self._current_ids[subscription]
+            self._subscriptions[msg_id] = self._subscriptions.pop(old_id, None)
+            options = self._frame_options.pop(old_id, None)
+            if options is not None:
+                self._frame_options[msg_id] = options
+            self._current_ids[subscription] = msg_id
+
+            try:
+                await self._request(msg_id, msg)
+            except Exception:
+                print(traceback.format_exc())
+
+        await asyncio.gather(*(renew(subscription, msg) for subscription, msg in list(self._subscribed.items())))
+        self._notify(True)
+
+    def _notify(self, connected):
+        '''
+        Call every connection callback with connected
+        '''
+        for callback in list(self.connection_callbacks):
+            try:
+                callback(connected)
+            except Exception:
+                print(traceback.format_exc())
+
+    def _decode(self, raw):
+        '''
+        Decode a recieved frame, or return None if its subscription's prefilter rejects it
+        Frames of subscriptions without frame options are always decoded fully
+        '''
+        if self._frame_options:
+            options = self._frame_options.get(scan_id(raw))
+            if options is not None:
+                prefilter, lazy = options
+
+                if prefilter is not None and not prefilter(raw):
+                    if self.metrics is not None:
+                        self.metrics.count("websocket_frames_skipped")
+                    return None
+
+                if lazy:
+                    return self.codec.loads_event(raw)
+
+        return self.codec.loads(raw)
+
+    def _route(self, msg):
+        '''
+        Route a recieved message to the call awaiting it, or to its subscription
+        '''
+        msg_type = msg.get("type")
+        msg_id = msg.get("id")
+
+        if msg_type == "result":
+            future = self._pending.pop(msg_id, None)
+            if future is None or future.done():
+                return
+
+            if msg.get("success", True):
+                future.set_result(msg.get("result", []))
+            else:
+                future.set_exception(RuntimeError(f"Websocket call {msg_id} failed: {msg}"))
+
+        elif msg_type == "event":
+            if msg_id not in self._subscriptions:
+                # Event of a subscription which was already cancelled
+                return
+
+            callback = self._subscriptions[msg_id]
+            if callback is None:
+                self.events.put_nowait(msg)
+                return
+
+            # A failing subscriber must not stop the reader (and every other call on the connection)
+            try:
+                callback(msg)
+            except Exception as exc:
+                print(f"Websocket subscription {msg_id} callback failed: {exc!r}")
+
+    def _fail_pending(self, error):
+        '''
+        Fail every call waiting on a response with error
+        '''
+        for future in self._pending.values():
+            if not future.done():
+                future.set_exception(error)
+        self._pending.clear()
+
+    def _close(self, error):
+        '''
+        Fail every pending call and wake up anything waiting on the connection with error
+        '''
+        self._fail_pending(error)
+
+        self.events.put_nowait(error)
+
+        if not self._closed.done():
+            self._closed.set_result(error)
+
+    def next_id(self):
+        '''
+        Return a new message id for this connection
+        '''
+        return next(self._ids)
+
+    async def request(self, msg):
+        '''
+        Send msg (without an id) and return the result of its response
+        Any number of requests can be in flight at once
+        '''
+        if self._closed.done():
+            raise self._closed.result()
+
+        return await self._request(self.next_id(), msg)
+
+    async def _request(self, msg_id, msg):
+        '''
+        Send msg with msg_id, and return the result of its response
+        '''
+        future = asyncio.get_running_loop().create_future()
+        self._pending[msg_id] = future
+
+        try:
+            await self.send({"id": msg_id, **msg})
+        except Exception:
+            self._pending.pop(msg_id, None)
+            raise
+
+        return await future
+
+    async def subscribe(self, event_type=None, callback=None, prefilter=None, lazy=False):
+        '''
+        Subscribe to events via the hass web socket, and return the subscription id
+        If event_type is given, hass only sends events of that type. Otherwise, every event on the bus is sent
+        Events are passed to callback(msg) on the connection's loop, or queued for recv() if there is no callback
+
+        prefilter: prefilter(raw) is called with every raw frame of the subscription before it is decoded, and frames it returns False for are dropped
+        lazy: decode state_changed events with their old and new states left undecoded until used (see JsonCodec.loads_event)
+        '''
+        msg = {"type": "subscribe_events"}
+        if event_type:
+            msg["event_type"] = event_type
+
+        return await self._subscribe(msg, callback, prefilter, lazy)
+
+    async def subscribe_entities(self, entity_ids=None, callback=None):
+        '''
+        Subscribe to compressed state updates of entity_ids (or every entity, if None) via the hass web socket, and return the subscription id
+        The first event holds the current state of every subscribed entity, and later events only hold changes (see CompressedStateTracker)
+        '''
+        msg = {"type": "subscribe_entities"}
+        if entity_ids is not None:
+            msg["entity_ids"] = sorted(entity_ids)
+
+        return await self._subscribe(msg, callback)
+
+    async def subscribe_template(self, template, callback=None):
         '''
-        Subscribe to all events via the hass web socket
+        Subscribe to the rendered value of a hass template, and return the subscription id
+        hass sends the rendered template right away, and again whenever an entity it reads changes (see TemplateWatch)
         '''
-        await self.ws.send(json.dumps({"id": 4, "type": "subscribe_events"}))
+        return await self._subscribe({"type": "render_template", "template": template}, callback)
 
-        resp = json.loads(await self.ws.recv())
+    async def _subscribe(self, msg, callback, prefilter=None, lazy=False):
+        '''
+        Register callback (and frame options) before sending the subscription, so no event can arrive before it
+        '''
+        if self._closed.done():
+            raise self._closed.result()
+
+        msg_id = self.next_id()
+        self._subscriptions[msg_id] = callback
+        if prefilter is not None or lazy:
+            self._frame_options[msg_id] = (prefilter, lazy)
+
+        try:
+            await self._request(msg_id, msg)
+        except Exception:
+            self._subscriptions.pop(msg_id, None)
+            self._frame_options.pop(msg_id, None)
+            raise
 
-        if resp.get("id") != 4:
-            raise RuntimeError(f"Websocket call id 4 mismatch: recv id was {resp.get("id")}")
-        if not resp.get("success", True):
-            raise RuntimeError(f"Websocket call 4 failed: {resp}")
-        return resp.get("result", [])
-    
-    async def call(self, cmd_type, msg_id):
+        # Renewed on reconnect (see _resubscribe)
+        self._subscribed[msg_id] = msg
+        self._current_ids[msg_id] = msg_id
+
+        return msg_id
+
+    async def unsubscribe(self, subscription):
         '''
-        Get data from various endpoints, ensuring correct msg_id
+        Cancel a subscription made by subscribe or subscribe_entities
         '''
-        await self.ws.send(json.dumps({"id": msg_id, "type": cmd_type}))
-        
-        resp = json.loads(await self.ws.recv())
+        self._subscribed.pop(subscription, None)
+        msg_id = self._current_ids.pop(subscription, subscription)
+
+        self._subscriptions.pop(msg_id, None)
+        self._frame_options.pop(msg_id, None)
+        await self.request({"type": "unsubscribe_events", "subscription": msg_id})
+
+    async def call_service(self, domain, service, entity_id=None, **data):
+        '''
+        Call domain.service on entity_id (a single entity_id or a list of entity_ids) with service data
+        Return the states the call changed, like the REST API does
+
+        The websocket result only holds the call's context, so changed states are collected from a state_changed subscription:
+        hass sends the events of a call before its result, and they carry the call's context
+        Only frames of entities with a call in flight are decoded
+        '''
+        await self._track_changes()
+
+        entity_ids = [entity_id] if isinstance(entity_id, str) else list(entity_id or ())
+        for called in entity_ids:
+            self._calling[called] = self._calling.get(called, 0) + 1
+
+        msg = {"type": "call_service", "domain": domain, "service": service, "service_data": data}
+        if entity_id is not None:
+            msg["target"] = {"entity_id": entity_id}
+
+        try:
+            result = await self.request(msg)
+        finally:
+            for called in entity_ids:
+                self._calling[called] -= 1
+                if not self._calling[called]:
+                    del self._calling[called]
+
+        context = ((result or {}).get("context") or {}).get("id")
+        changed = self._changes.pop(context, [])
+
+        if not self._calling:
+            # Changes of other contexts (ex. automations) on called entities are never asked for
+            self._changes.clear()
+
+        return changed
+
+    async def _track_changes(self):
+        '''
+        Subscribe to the state_changed events of called entities (once)
+        '''
+        if self._changes_subscription is not None:
+            return
+
+        # Created here, so it belongs to the connection's loop
+        if self._changes_lock is None:
+            self._changes_lock = asyncio.Lock()
+
+        async with self._changes_lock:
+            if self._changes_subscription is None:
+                self._changes_subscription = await self.subscribe("state_changed", self._collect_change, self._wants_change)
+
+    def _wants_change(self, raw):
+        entity_id = scan_string(raw, "entity_id")
+        return entity_id is None or entity_id in self._calling
+
+    def _collect_change(self, msg):
+        data = (msg.get("event") or {}).get("data") or {}
+        new_state = data.get("new_state")
+        if new_state is None or data.get("entity_id") not in self._calling:
+            return
+
+        context = (new_state.get("context") or {}).get("id")
+        self._changes.setdefault(context, []).append(new_state)
+
+    async def call(self, cmd_type, **data):
+        '''
+        Get data from various endpoints
+        '''
+        return await self.request({"type": cmd_type, **data})
+
+    async def send(self, msg):
+        '''
+        Send a json message without waiting for its response
+        '''
+        await self.ws.send(self.codec.dumps(msg))
 
-        if resp.get("id") != msg_id:
-            raise RuntimeError(f"Websocket call id {msg_id} mismatch: recv id was {resp.get("id")}")
-        if not resp.get("success", True):
-            raise RuntimeError(f"Websocket call {cmd_type} failed: {resp}")
-        return resp.get("result", [])
-    
     async def recv(self):
         '''
-        Recieve a message and jsonify
+        Recieve the next event of a subscription without a callback
         '''
-        return json.loads(await self.ws.recv())
-    
+        msg = await self.events.get()
+        if isinstance(msg, Exception):
+            # Keep the error queued for any other reader
+            self.events.put_nowait(msg)
+            raise msg
+
+        return msg
+
+    async def wait_closed(self):
+        '''
+        Wait until the connection closes for good
+        Return if it was closed on purpose (see close), and raise the reason otherwise
+        '''
+        error = await asyncio.shield(self._closed)
+        if not self._closing:
+            raise error
+
+    async def close(self):
+        '''
+        Stop the reader and close the connection
+        '''
+        self._closing = True
+        if self._reader:
+            self._reader.cancel()
+        await self.ws.close()
+        self._close(RuntimeError("Websocket connection closed"))
+
     async def __aenter__(self):
         return self
 
     async def __aexit__(self, exc_type, exc, tb):
-        await self.ws.close()
\ No newline at end of file
+        await self.close()
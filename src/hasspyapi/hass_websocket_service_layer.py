@@ -0,0 +1,42 @@
+class HassWebSocketServiceLayer:
+    def __init__(self, connection, loop):
+        '''
+        Calls hass services over an authorized websocket instead of REST, saving the HTTP round trip on every call
+        Has the same service methods as HassApiLayer, so HassCommand can use either
+
+        connection: a (shared) HassWebSocketLayer
+        loop: the HassEventLoop which owns connection
+        '''
+        self.connection = connection
+        self.loop = loop
+
+    def call_service(self, domain, service, entity_id=None, **data):
+        '''
+        Call domain.service on entity_id (a single entity_id or a list of entity_ids) with service data
+        Return the states the call changed, like HassApiLayer (see HassWebSocketLayer.call_service)
+        '''
+        return self.loop.run(self.connection.call_service(domain, service, entity_id, **data))
+
+    def turn_on(self, entity_id, device_type, **attributes):
+        '''
+        Call the turn_on service and pass in any available attributes (ex. hs_color, brightness etc.)
+        '''
+        return self.call_service(device_type, "turn_on", entity_id, **attributes)
+
+    def turn_off(self, entity_id, device_type):
+        '''
+        Call the turn_off service
+        '''
+        return self.call_service(device_type, "turn_off", entity_id)
+
+    def toggle(self, entity_id, device_type, **attributes):
+        '''
+        Call the toggle service and pass in any available attributes (ex. hs_color, brightness etc.)
+        '''
+        return self.call_service(device_type, "toggle", entity_id, **attributes)
+
+    def google_assistant(self, command):
+        '''
+        Send a text command to Google Assistant SDK (if already set up in hass)
+        '''
+        return self.call_service("google_assistant_sdk", "send_text_command", command=command)
@@ -1,38 +1,197 @@
+from weakref import WeakSet
+import traceback
 import asyncio
 
+from .hass_api_layer import HassApiLayer
 from .hass_command import HassCommand
+from .hass_command_queue import CommandQueue
+from .hass_device import Device
+from .hass_device_registry import DeviceRegistry
 from .hass_event_listener import HassEventListener
+from .hass_event_loop import HassEventLoop
+from .hass_json import JsonCodec
+from .hass_metrics import HassMetrics
+from .hass_plan import HassPlan
+from .hass_registry_cache import AREA_FIELDS, DEVICE_FIELDS, DEVICE_ROW_KEYS, ENTITY_FIELDS, RegistryCache, registry_hash, trim
+from .hass_state_store import HassStateStore
 from .hass_websocket_layer import HassWebSocketLayer
+from .hass_websocket_service_layer import HassWebSocketServiceLayer
+
+# Registry update events which change devices
+REGISTRY_EVENTS = ("area_registry_updated", "device_registry_updated", "entity_registry_updated")
+
+# Seconds to wait after a registry update before rebuilding devices, so a burst of updates (ex. a new integration) costs one rebuild
+REGISTRY_DEBOUNCE = 0.5
 
 class Home:
-    def __init__(self, url, api_key):
+    # HassCommand class returned by please()
+    command_class = HassCommand
+
+    def __init__(self, url, api_key, pool_size=10, timeout=10, retries=3, backoff=0.3, mirror_states=False, state_max_age=None, transport="rest",
+                 registry_cache=None, live_registry=True, metrics=False, json_codec="auto",
+                 queue_commands=False, entity_rate=None, global_rate=None, max_in_flight=4, skip_redundant=False):
         '''
         Initializes the API via url and api_key on HomeAssistant server
         Builds internal dictionary of devices
+
+        pool_size, timeout, retries and backoff configure the REST transport shared by every HassCommand (see HassApiLayer)
+
+        If mirror_states, keep an in-memory mirror of all states (see HassStateStore), so get_state/get_attributes are served from memory
+        The mirror is kept current by listeners created via listener(). Without a running listener, states are read from hass as usual,
+        unless state_max_age is given: then the mirror is also trusted for state_max_age seconds after its last sync or update
+
+        transport: how HassCommands call services, either "rest" or "websocket" (over the shared websocket, see HassWebSocketServiceLayer)
+
+        registry_cache: a directory to cache registries in (see RegistryCache). With a cache, devices are loaded from disk,
+            and the registries are downloaded in the background to check whether the cache is still current
+        live_registry: keep devices current by listening for area/device/entity registry updates, instead of requiring a restart
+
+        metrics: record trigger timings, REST latency, websocket receive rate and loop lag in self.metrics (see HassMetrics)
+        json_codec: json library for the REST and websocket transports, "orjson", "msgspec", "json" or "auto" (see JsonCodec)
+
+        queue_commands: send turn_on/turn_off/toggle/set_attributes through a CommandQueue, which coalesces rapid-fire calls per entity
+            Queued calls return QueuedCommands right away, unless called with wait="accepted" or wait="applied" (see HassCommand._call)
+        entity_rate, global_rate, max_in_flight: rate limits (calls per second) and in flight limit of the queue (see CommandQueue)
+
+        skip_redundant: do not call turn_on/turn_off on devices whose known state already matches (see HassCommand._drop_redundant)
+            Off by default, since a mirror which lags behind a device would drop calls that were needed
         '''
 
+        self._setup(url, api_key, registry_cache, metrics, json_codec)
+
+        # One pooled REST transport per home, shared by every HassCommand built from it
+        self.api_layer = HassApiLayer(url, api_key, pool_size=pool_size, timeout=timeout, retries=retries, backoff=backoff, metrics=self.metrics, codec=self.codec)
+
+        # Optional state mirror, seeded now with one bulk call
+        self.state_store = None
+        if mirror_states:
+            self.state_store = HassStateStore(self.api_layer, max_age=state_max_age)
+            self.state_store.sync()
+
+        # One long-lived websocket per home, shared by registry queries and every listener
+        # It lives on a background loop, so synchronous code can use it from any thread
+        self.loop = HassEventLoop()
+        self.ws = self.loop.run(HassWebSocketLayer.authorize(self.ws_url, self.ws_headers, self.metrics, self.codec))
+
+        if self.metrics:
+            self.loop.submit(self.metrics.watch_loop_lag())
+
+        if transport == "rest":
+            self.service_layer = self.api_layer
+        elif transport == "websocket":
+            self.service_layer = HassWebSocketServiceLayer(self.ws, self.loop)
+        else:
+            raise RuntimeError(f"Unknown transport {transport}, expected rest or websocket")
+
+        self.skip_redundant = skip_redundant
+
+        self.command_queue = None
+        if queue_commands:
+            self.command_queue = CommandQueue(self.service_layer, self.state_store, entity_rate=entity_rate, global_rate=global_rate,
+                                              max_in_flight=max_in_flight)
+
+        cached = self.registry_cache.load() if self.registry_cache else None
+
+        if live_registry:
+            # Subscribe before loading, so no registry update is missed
+            self.loop.run(self._subscribe_registry_updates())
+
+        if cached:
+            self._load_cached_devices(cached)
+
+            # Check the cache is still current in the background
+            self.loop.submit(self._refresh_registries())
+        else:
+            self.loop.run(self._refresh_registries())
+
+    def _setup(self, url, api_key, registry_cache, metrics, json_codec):
+        '''
+        Setup shared with AsyncHome: credentials, metrics and codec, websocket address, and registry bookkeeping
+        '''
         self.url = url
         self.api_key = api_key
 
+        self.metrics = HassMetrics() if metrics else None
+        self.codec = JsonCodec(json_codec)
+
         self.ws_url = f"ws://{url}/api/websocket"
         self.ws_headers = {
             "type": "auth",
             "access_token": api_key
         }
 
-        self.devices = self._get_devices()
+        # Trimmed registries (area_id -> area, id -> device, entity_id -> entity) and their hash, kept to patch devices on registry updates
+        self._areas = {}
+        self._device_entries = {}
+        self._entities = {}
+        self._registry_hash = None
+        # Created by the first registry coroutine, so it belongs to the loop they run on (see _registry_guard)
+        self._registry_lock = None
+        # Pending debounced rebuild (see _schedule_rebuild)
+        self._rebuild_task = None
+
+        # Listeners on the shared websocket, to wait for on close
+        self._listeners = WeakSet()
+
+        self.registry_cache = RegistryCache(registry_cache, url) if registry_cache else None
+
+    def _set_registry(self, registry):
+        '''
+        Swap in a new DeviceRegistry
+        HassCommands built on the old registry keep their devices, and move to the new registry when filtered (see HassCommand.filter)
+        '''
+        self.registry = registry
+        self.devices = registry.devices
+
+        # Shared root command, so memoized filters are reused across please() calls
+        self._please = self.command_class(self)
 
     def please(self):
         '''
         Return a corresponding HassCommand object
         '''
-        return HassCommand(self.url, self.api_key, self.devices)
+        return self._please
+
+    def plan(self):
+        '''
+        Return an empty HassPlan, to apply target states to many devices with as few calls as possible
+        '''
+        return HassPlan(self)
     
-    def listener(self):
+    def listener(self, event_types=("state_changed",), subscribe_entities=False, workers=1, max_queue=1000, overflow="block", history=None, processes=0):
         '''
         Return a corresponding HassEventListener object
+        event_types and subscribe_entities choose what the listener subscribes to, workers, max_queue and overflow configure its handler pool (see HassEventListener)
+        history: a StateHistory the listener keeps recent states in, for conditions to query
+        processes: number of worker processes conditions are evaluated on (see TriggerShards). Not available with mirror_states or history
+            Only module level condition functions are sent to the workers. Lambdas and closures cannot be pickled,
+            so they are reported and checked in this process instead. Guard the script with if __name__ == "__main__"
         '''
-        return HassEventListener(self.ws_url, self.ws_headers)
+        listener = HassEventListener(self.ws_url, self.ws_headers, state_store=self.state_store, event_types=event_types, subscribe_entities=subscribe_entities,
+                                     connection=self.ws, loop=self.loop, workers=workers, max_queue=max_queue, overflow=overflow, metrics=self.metrics, history=history, processes=processes)
+        self._listeners.add(listener)
+
+        return listener
+
+    def close(self):
+        '''
+        Close the shared websocket and REST connections, and stop the background loop
+        '''
+        self.loop.run(self._close_connection())
+        self.loop.stop()
+        self.api_layer.close()
+
+    async def _close_connection(self):
+        '''
+        Close the shared websocket, and wait for the listeners on it to stop, so the loop does not stop under them
+        '''
+        if self._rebuild_task is not None:
+            self._rebuild_task.cancel()
+
+        await self.ws.close()
+
+        tasks = [listener._task for listener in self._listeners if listener._task is not None]
+        await asyncio.gather(*tasks, return_exceptions=True)
 
     def _strip_area_prefix(self, friendly_name, area_name):
         '''
@@ -48,7 +207,7 @@ class Home:
         
     async def _get_ws_data(self):
         '''
-        Connect to hass via websocket to get area/device/entity registries.
+        Query the area/device/entity registries over the shared websocket (all three at once)
         areas: Contains area names and their area_ids
         devices: Contains devices (friendly names) and their area_ids, along with (useless) device_id
         entities: Contains device_ids and their (useful) entity_ids
@@ -56,16 +215,155 @@ class Home:
         NOTE: entities DO have area_id, but they are often all null
         '''
 
-        async with await HassWebSocketLayer.authorize(self.ws_url, self.ws_headers) as ws:
-            areas = await ws.call("config/area_registry/list", 1)
-            devices = await ws.call("config/device_registry/list", 2)
-            entities = await ws.call("config/entity_registry/list", 3)
+        return await asyncio.gather(self.ws.call("config/area_registry/list"),
+                                    self.ws.call("config/device_registry/list"),
+                                    self.ws.call("config/entity_registry/list"))
+
+    def _trimmed_registries(self):
+        '''
+        Return the trimmed (areas, devices, entities) lists currently kept by the home
+        '''
+        return list(self._areas.values()), list(self._device_entries.values()), list(self._entities.values())
+
+    def _set_registries(self, areas, devices, entities):
+        '''
+        Keep trimmed registries, so single entries can be patched later
+        '''
+        self._areas = {area["area_id"]: area for area in trim(areas, AREA_FIELDS)}
+        self._device_entries = {device["id"]: device for device in trim(devices, DEVICE_FIELDS)}
+        self._entities = {ent["entity_id"]: ent for ent in trim(entities, ENTITY_FIELDS)}
+
+    def _load_cached_devices(self, cached):
+        '''
+        Load registries and built devices from a registry cache, without building them again
+        '''
+        self._set_registries(cached["areas"], cached["devices"], cached["entities"])
+        self._registry_hash = cached["hash"]
+
+        self._set_registry(DeviceRegistry([Device(**dict(zip(DEVICE_ROW_KEYS, row))) for row in cached["rows"]]))
 
-            return areas, devices, entities
+    def _registry_guard(self):
+        '''
+        Return the lock serializing registry refreshes and patches, creating it on the running loop the first time
+        '''
+        if self._registry_lock is None:
+            self._registry_lock = asyncio.Lock()
+
+        return self._registry_lock
+
+    async def _refresh_registries(self):
+        '''
+        Download all registries, and rebuild devices if they changed since they were last built (or cached)
+        '''
+        async with self._registry_guard():
+            areas, devices, entities = await self._get_ws_data()
+
+            self._set_registries(areas, devices, entities)
+            trimmed = self._trimmed_registries()
+            if await asyncio.get_running_loop().run_in_executor(None, registry_hash, *trimmed) != self._registry_hash:
+                await self._rebuild_devices()
+
+    async def _rebuild_devices(self):
+        '''
+        Build devices from the kept registries, swap them in, and write them to the registry cache
+        Hashing and building run on an executor thread, so large registries never stall the loop (and every call and event on it)
+        '''
+        areas, devices, entities = self._trimmed_registries()
+
+        self._registry_hash, registry = await asyncio.get_running_loop().run_in_executor(None, self._hash_and_build, areas, devices, entities)
+        self._set_registry(registry)
+
+        if self.registry_cache:
+            await asyncio.get_running_loop().run_in_executor(None, self.registry_cache.save,
+                                                             self._registry_hash, areas, devices, entities, registry.devices)
+
+    def _hash_and_build(self, areas, devices, entities):
+        return registry_hash(areas, devices, entities), self._build_devices(areas, devices, entities)
+
+    def _schedule_rebuild(self):
+        '''
+        Rebuild devices REGISTRY_DEBOUNCE seconds from now, unless a rebuild is already pending
+        '''
+        if self._rebuild_task is None:
+            self._rebuild_task = asyncio.get_running_loop().create_task(self._rebuild_soon())
+
+    async def _rebuild_soon(self):
+        await asyncio.sleep(REGISTRY_DEBOUNCE)
+
+        try:
+            async with self._registry_guard():
+                # Updates patched from now on need a rebuild of their own
+                self._rebuild_task = None
+                await self._rebuild_devices()
+        except Exception:
+            print(traceback.format_exc())
+
+    async def _subscribe_registry_updates(self):
+        '''
+        Subscribe to area/device/entity registry updates on the shared websocket
+        Updates sent while the websocket was reconnecting are lost, so registries are downloaded again once it is back
+        '''
+        for event_type in REGISTRY_EVENTS:
+            await self.ws.subscribe(event_type, self._on_registry_updated)
+
+        self.ws.connection_callbacks.append(self._on_connection)
+
+    def _on_connection(self, connected):
+        '''
+        Connection callback of the shared websocket (see _subscribe_registry_updates)
+        '''
+        if connected:
+            asyncio.get_running_loop().create_task(self._refresh_registries_safely())
+
+    async def _refresh_registries_safely(self):
+        try:
+            await self._refresh_registries()
+        except Exception:
+            print(traceback.format_exc())
+
+    def _on_registry_updated(self, msg):
+        '''
+        Subscription callback for registry updates. Patching needs more websocket calls, so it runs as its own task
+        '''
+        asyncio.get_running_loop().create_task(self._patch_registry(msg.get("event")))
+
+    async def _patch_registry(self, event):
+        '''
+        Apply a registry update event, only downloading what it changed, then schedule a rebuild of devices (see _schedule_rebuild)
+        '''
+        event_type = event.get("event_type")
+        data = event.get("data", {})
+
+        try:
+            async with self._registry_guard():
+                if event_type == "entity_registry_updated":
+                    entity_id = data.get("entity_id")
+
+                    # Entities can be renamed, which removes the old entity_id
+                    self._entities.pop(data.get("old_entity_id"), None)
+
+                    if data.get("action") == "remove":
+                        self._entities.pop(entity_id, None)
+                    else:
+                        entry = await self.ws.call("config/entity_registry/get", entity_id=entity_id)
+                        self._entities[entity_id] = trim([entry], ENTITY_FIELDS)[0]
+
+                elif event_type == "device_registry_updated":
+                    # There is no single device query, so only the device registry is downloaded again
+                    devices = await self.ws.call("config/device_registry/list")
+                    self._device_entries = {device["id"]: device for device in trim(devices, DEVICE_FIELDS)}
+
+                elif event_type == "area_registry_updated":
+                    areas = await self.ws.call("config/area_registry/list")
+                    self._areas = {area["area_id"]: area for area in trim(areas, AREA_FIELDS)}
+
+            self._schedule_rebuild()
+        except Exception:
+            print(traceback.format_exc())
     
     def _build_devices(self, areas, devices, entities):
         '''
-        Build a list of {entity_id, name, area, area_id, type} for each device
+        Build a DeviceRegistry of Devices {entity_id, name, area, area_id, type}
         '''
         # Map of area_ids to area names
         area_map = {area["area_id"]: area.get("name", "Unknown") for area in areas}
@@ -73,64 +371,65 @@ class Home:
         # Map of device_ids to device entries
         device_map = {device["id"]: device for device in devices}
 
-        # Map of area names to device dictionaries
         result = []
         for ent in entities:
-            # Ignore hidden/dummy entities
-            if ent.get("entity_category") == 'config':
-                continue
-            if ent.get("hidden_by") is not None:
-                continue
-            if ent.get("disabled_by") is not None:
-                continue
-
-            entity_id = ent.get("entity_id")
-            
-            device_id = ent.get("device_id")
-            device = device_map.get(device_id)
-
-            if device and device.get("model") == "Room":
-                # Do not include rooms, since they will duplicate devices in calls
-                continue
-            
+            device = self._build_device(ent, device_map, area_map)
             if device:
-                area_id = device.get("area_id")
-            else:
-                # Device does not exist, fall back to area_id from entity
-                area_id = ent.get("area_id")
-
-            area_name = area_map.get(area_id)
-
-            # Now the one issue is the device display name
-            # Selection is listed in order of preference
-            # 1. The user changed the name manually in hass (saved in "name")
-            # 2. There is an existing friendly name (saved in "original_name")
-
-            display_name = ent.get("name") or ent.get("original_name")
-
-            if display_name and "DEPRECATED" in display_name:
-                # Some names contain "DEPRECATED" instead of being null. Override to original_name (friendly name) instead
-                display_name = ent.get("original_name")
-
-            if display_name and area_name:
-                # Make sure display name does not have room name prefix
-                display_name = self._strip_area_prefix(display_name, area_name)
-
-            # Determine device type via entity_id naming conventions
-            device_type = None
-            if "." in entity_id:
-                device_type = entity_id.split(".")[0]
-
-            # Push this device to results
-            result.append({"entity_id": entity_id,
-                           "name": display_name,
-                           "area_id": area_id,
-                           "area": area_name,
-                           "type": device_type
-                           })
-
-        return result
-    
-    def _get_devices(self):
-        areas, devices, entities = asyncio.run(self._get_ws_data())
-        return self._build_devices(areas, devices, entities)
\ No newline at end of file
+                result.append(device)
+
+        return DeviceRegistry(result)
+
+    def _build_device(self, ent, device_map, area_map):
+        '''
+        Build a Device {entity_id, name, area, area_id, type} for one entity registry entry, or None if the entity should be ignored
+        '''
+        # Ignore hidden/dummy entities
+        if ent.get("entity_category") == 'config':
+            return None
+        if ent.get("hidden_by") is not None:
+            return None
+        if ent.get("disabled_by") is not None:
+            return None
+
+        entity_id = ent.get("entity_id")
+        
+        device_id = ent.get("device_id")
+        device = device_map.get(device_id)
+
+        if device and device.get("model") == "Room":
+            # Do not include rooms, since they will duplicate devices in calls
+            return None
+        
+        if device:
+            area_id = device.get("area_id")
+        else:
+            # Device does not exist, fall back to area_id from entity
+            area_id = ent.get("area_id")
+
+        area_name = area_map.get(area_id)
+
+        # Now the one issue is the device display name
+        # Selection is listed in order of preference
+        # 1. The user changed the name manually in hass (saved in "name")
+        # 2. There is an existing friendly name (saved in "original_name")
+
+        display_name = ent.get("name") or ent.get("original_name")
+
+        if display_name and "DEPRECATED" in display_name:
+            # Some names contain "DEPRECATED" instead of being null. Override to original_name (friendly name) instead
+            display_name = ent.get("original_name")
+
+        if display_name and area_name:
+            # Make sure display name does not have room name prefix
+            display_name = self._strip_area_prefix(display_name, area_name)
+
+        # Determine device type via entity_id naming conventions
+        device_type = None
+        if "." in entity_id:
+            device_type = entity_id.split(".")[0]
+
+        return Device(entity_id=entity_id,
+                      name=display_name,
+                      area_id=area_id,
+                      area=area_name,
+                      type=device_type)
@@ -0,0 +1,33 @@
+import sys
+import os
+import time
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(ROOT, "src"), os.path.join(ROOT, "benchmarks")]
+
+from fake_hass import FakeHass
+
+@pytest.fixture
+def fake():
+    '''
+    A fresh fake hass server per test, so calls and states never leak between tests
+    It serves on a daemon thread, and is left running so connections still open at the end of a test close quietly
+    '''
+    return FakeHass(entities=24).start()
+
+def wait_until(predicate, timeout=2):
+    '''
+    Poll predicate until it is true, and return whether it became true within timeout seconds
+    '''
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+
+    return True
+
+def entity_ids(fake, domain):
+    return [entity["entity_id"] for entity in fake.entities if entity["entity_id"].startswith(domain + ".")]
@@ -0,0 +1,80 @@
+from conftest import entity_ids, wait_until
+
+from hasspyapi.home import Home
+
+def lights(fake):
+    return [fake.states[entity_id]["state"] for entity_id in entity_ids(fake, "light")]
+
+def services(fake):
+    return [call["service"] for _, call in fake.calls]
+
+def test_mirror_reads_after_write(fake):
+    home = Home(fake.url, fake.token, mirror_states=True, live_registry=False, state_max_age=30)
+    light = home.please().filter(type="light")
+
+    light.turn_on()
+    assert light.get_state() == "on"
+
+    light.turn_off()
+    assert light.get_state() == "off"
+    home.close()
+
+def test_mirror_without_listener_reads_hass(fake):
+    home = Home(fake.url, fake.token, mirror_states=True, live_registry=False)
+    light = home.please().filter(type="light")
+    light.get_state()
+
+    # Changed behind our back, with nothing keeping the mirror current
+    fake.set_state(entity_ids(fake, "light")[0], "on")
+    assert light.get_state() == "on"
+    home.close()
+
+def test_no_skipping_without_live_listener(fake):
+    home = Home(fake.url, fake.token, mirror_states=True, live_registry=False, skip_redundant=True, state_max_age=30)
+    light = home.please().filter(type="light")
+    light.turn_off()
+
+    fake.calls = []
+    light.turn_off()
+    assert services(fake) == ["turn_off"]
+    assert len(home.plan().turn_off(light).calls()) == 1
+    home.close()
+
+def test_skipping_with_live_listener(fake):
+    home = Home(fake.url, fake.token, mirror_states=True, live_registry=False, skip_redundant=True)
+    listener = home.listener()
+    listener.start(interval=None)
+    assert wait_until(lambda: home.state_store.live)
+
+    light = home.please().filter(type="light")
+    light.turn_off()
+    fake.calls = []
+    light.turn_off()
+    home.plan().turn_off(light).apply()
+    assert fake.calls == []
+
+    light.turn_on()
+    assert services(fake) == ["turn_on"]
+    assert set(lights(fake)) == {"on"}
+    home.close()
+
+def test_plan_without_skip_redundant_sends_everything(fake):
+    home = Home(fake.url, fake.token, mirror_states=True, live_registry=False)
+    listener = home.listener()
+    listener.start(interval=None)
+    assert wait_until(lambda: home.state_store.live)
+
+    fake.calls = []
+    home.plan().turn_off(home.please().filter(type="light")).apply()
+    assert services(fake) == ["turn_off"]
+    home.close()
+
+def test_plan_goes_through_queue(fake):
+    home = Home(fake.url, fake.token, live_registry=False, queue_commands=True)
+    light = home.please().filter(type="light")
+
+    results = home.plan().turn_on(light).apply(wait="accepted")
+    assert results
+    assert home.command_queue.stats()["submitted"] == 1
+    assert set(lights(fake)) == {"on"}
+    home.close()
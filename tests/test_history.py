@@ -0,0 +1,78 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from conftest import entity_ids
+
+from hasspyapi.async_home import AsyncHome
+from hasspyapi.hass_api_layer import HassApiLayer
+
+START = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+def recording_api(responses):
+    '''
+    A HassApiLayer whose GET requests are recorded as (endpoint, params), answered from responses(endpoint)
+    '''
+    api = HassApiLayer("127.0.0.1:1", "token")
+    requests = []
+
+    def get(endpoint, params=None):
+        requests.append((endpoint, dict(params or {})))
+        return responses(endpoint)
+
+    api._get = get
+    return api, requests
+
+def test_history_minimal_only_without_attributes():
+    api, requests = recording_api(lambda endpoint: [[{"entity_id": "sensor.a", "state": "1", "attributes": {}}, {"state": "2"}]])
+
+    states = list(api.history("sensor.a", START, START + timedelta(hours=1)))
+    assert [state["entity_id"] for state in states] == ["sensor.a", "sensor.a"]
+    assert "minimal_response" in requests[-1][1] and "no_attributes" in requests[-1][1]
+
+    list(api.history("sensor.a", START, START + timedelta(hours=1), attributes=True))
+    assert "minimal_response" not in requests[-1][1] and "no_attributes" not in requests[-1][1]
+
+def test_logbook_filters_by_every_entity():
+    api, requests = recording_api(lambda endpoint: [])
+
+    list(api.logbook(START, START + timedelta(days=2), ["light.a", "light.b"], chunk=timedelta(days=1)))
+    assert [params["entity"] for _, params in requests] == ["light.a,light.b", "light.a,light.b"]
+
+    list(api.logbook(START, START + timedelta(hours=1)))
+    assert "entity" not in requests[-1][1]
+
+def test_async_home(fake):
+    async def main():
+        home = await AsyncHome.connect(fake.url, fake.token, mirror_states=True)
+        listener = home.listener()
+        with pytest.raises(RuntimeError):
+            listener.start()
+
+        entity_id = entity_ids(fake, "sensor")[0]
+        command = home.please().filter(entity_id=entity_id)
+        assert await command.get_state() == "off"
+
+        del fake.states[entity_id]
+        with pytest.raises(KeyError):
+            await command.get_state()
+
+        calls = []
+        async def call(message_type, **kwargs):
+            calls.append((message_type, kwargs))
+            if message_type.startswith("history"):
+                return {entity_id: [{"s": "1", "lu": START.timestamp()}, {"s": "2", "lu": START.timestamp() + 60}]}
+            return [{"when": START.timestamp(), "entity_id": entity_id}]
+
+        home.ws.call = call
+        states = [state async for state in command.history(START, START + timedelta(hours=1))]
+        assert [(state["entity_id"], state["state"]) for state in states] == [(entity_id, "1"), (entity_id, "2")]
+        assert calls[-1][1]["minimal_response"] and calls[-1][1]["no_attributes"]
+
+        entries = [entry async for entry in command.logbook(START, START + timedelta(hours=1))]
+        assert entries[0]["when"] == START.isoformat()
+
+        await home.close()
+
+    asyncio.run(main())
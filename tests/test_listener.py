@@ -0,0 +1,119 @@
+from conftest import entity_ids, wait_until
+
+from hasspyapi import hass_websocket_layer
+from hasspyapi.hass_event import StateChangedEvent
+from hasspyapi.hass_event_listener import HassEventListener
+from hasspyapi.hass_handler_pool import DispatchQueue
+from hasspyapi.home import Home
+
+class Clock:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += int(seconds * 1e9)
+
+def changed(entity_id, old, new):
+    return StateChangedEvent({"entity_id": entity_id,
+                              "old_state": {"entity_id": entity_id, "state": old, "attributes": {}},
+                              "new_state": {"entity_id": entity_id, "state": new, "attributes": {}}})
+
+def offline_listener(clock):
+    # Never started: events are fired by hand, and deadlines run on the virtual clock
+    return HassEventListener("ws://unused", {}, clock=clock, workers=0)
+
+def test_duration_trigger_fires_once_after_duration():
+    clock = Clock()
+    listener = offline_listener(clock)
+    fired = []
+
+    @listener.trigger_when(entity_id="light.hall", to_state="on", duration=10)
+    def on(msg):
+        fired.append(msg.entity_id)
+
+    listener.fire_event(changed("light.hall", "off", "on"))
+    clock.advance(9)
+    listener.scheduler.run_due()
+    assert fired == []
+
+    clock.advance(1)
+    listener.scheduler.run_due()
+    assert fired == ["light.hall"]
+
+    # Still met, but it already fired
+    listener.fire_event(changed("light.hall", "on", "on"))
+    clock.advance(20)
+    listener.scheduler.run_due()
+    assert fired == ["light.hall"]
+
+def test_duration_trigger_cancelled_when_no_longer_met():
+    clock = Clock()
+    listener = offline_listener(clock)
+    fired = []
+    met = [True]
+
+    @listener.trigger_when(lambda msg: met[0], duration=5)
+    def on(msg):
+        fired.append(msg)
+
+    listener.fire_event(None)
+    clock.advance(3)
+    met[0] = False
+    listener.fire_event(None)
+    clock.advance(3)
+    listener.scheduler.run_due()
+    assert fired == []
+
+    # Met again, but not any more when the deadline expires: the last check wins
+    met[0] = True
+    listener.fire_event(None)
+    met[0] = False
+    clock.advance(5)
+    listener.scheduler.run_due()
+    assert fired == []
+
+def test_dispatch_queue_drops_oldest():
+    queue = DispatchQueue(max_queue=2, overflow="drop_oldest")
+    for state in ("1", "2", "3"):
+        queue.put(changed("sensor.a", "0", state))
+
+    assert queue.dropped == 1
+    assert [queue.get().raw_new_state["state"] for _ in range(queue.qsize())] == ["2", "3"]
+
+def test_dispatch_queue_coalesces_per_entity():
+    queue = DispatchQueue(max_queue=2, overflow="coalesce")
+    queue.put(changed("sensor.a", "0", "1"))
+    queue.put(changed("sensor.b", "0", "1"))
+    queue.put(changed("sensor.a", "1", "2"))
+
+    assert queue.coalesced == 1 and queue.dropped == 0
+    assert [(msg.entity_id, msg.raw_new_state["state"]) for msg in (queue.get(), queue.get())] == [("sensor.a", "2"), ("sensor.b", "1")]
+
+def test_reconnects_and_resubscribes(fake, monkeypatch):
+    monkeypatch.setattr(hass_websocket_layer, "RECONNECT_DELAY", 0.05)
+    home = Home(fake.url, fake.token, mirror_states=True, transport="websocket")
+    listener = home.listener()
+    light = entity_ids(fake, "light")[0]
+    fired = []
+
+    @listener.trigger_when(entity_id=light, to_state="on")
+    def on(msg):
+        fired.append(msg.entity_id)
+
+    listener.start(interval=None)
+    assert wait_until(lambda: home.state_store.live)
+
+    async def drop():
+        for ws, *_ in list(fake._event_subscriptions):
+            ws.writer.close()
+
+    fake.run(drop())
+    assert wait_until(lambda: not home.state_store.live)
+    assert wait_until(lambda: home.state_store.live)
+
+    home.please().filter(entity_id=light).turn_on()
+    assert wait_until(lambda: fired == [light])
+    home.close()